@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Copyright (c) 2014
+Harvard FAS Research Computing
+All rights reserved.
+
+Benchmark job report loading with synthetic sacct output
+"""
+
+import sys, os
+import tempfile
+from slymedb import benchmark
+
+from argparse import ArgumentParser
+from argparse import RawDescriptionHelpFormatter
+
+def main():
+    '''Command line options.'''
+    program_desc="""
+Measure how fast synthetic sacct output is parsed by Slurm.getJobReports and
+saved by Store.save.  For each number of jobs and each database, three phases
+are reported: parse (getJobReports only), load (into empty tables) and reload
+(the same reports again, as an overlapping incremental load would).  Each size
+runs in its own process so that the peak RSS is for that run alone.
+
+SQLite is always measured, in a file in --sqlite-dir.  Give a MySQL connect
+string with --mysql, or in SLYMEDB_BENCH_MYSQL, to measure a local MySQL server
+as well; its tables are dropped and recreated.
+
+Save the results with --save-baseline and compare later runs with --baseline.  A
+run that is slower, uses more statements per row or more memory than the
+baseline by more than --tolerance exits with status 1.
+
+No baseline is shipped, since the numbers depend on the machine, the database
+and the slyme version.  Record one with the real slyme installed, on the machine
+that will run the comparisons, e.g.
+
+    benchreports.py --jobs 1e4,1e5 --save-baseline baseline-sqlite.json
+
+and rerun with --baseline baseline-sqlite.json after a change.  Use the same
+--jobs and --seed for both.  Statements per row don't depend on the machine, so
+the test suite (BenchmarkTest) checks them for each SQLite save path instead.
+    """
+    parser = ArgumentParser(description=program_desc, \
+        formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs",default="1e4,1e5",\
+        help="Comma separated numbers of jobs to generate, e.g. 1e4,1e5,1e6,1e7")
+    parser.add_argument("--seed",type=int,default=0,help="Random seed for the synthetic sacct output")
+    parser.add_argument("--sqlite-dir",help="Directory for the SQLite database (default is the system temp directory)")
+    parser.add_argument("--mysql",default=os.environ.get("SLYMEDB_BENCH_MYSQL"),\
+        help="Connect string for a scratch MySQL database to benchmark as well")
+    parser.add_argument("--batch-size",type=int,default=1000,help="Store batch size")
+    parser.add_argument("--compact",action="store_true",help="Benchmark the compact schema")
+    parser.add_argument("--no-rollups",action="store_true",help="Benchmark without rollup maintenance")
+    parser.add_argument("--dedupe-mb",type=float,default=0,help="Store dedupe buffer size")
+    parser.add_argument("--baseline",help="Compare with the results in this baseline file")
+    parser.add_argument("--save-baseline",help="Write the results to this baseline file")
+    parser.add_argument("--tolerance",type=float,default=0.25,\
+        help="Fraction by which a result may be worse than the baseline")
+    args = parser.parse_args()
+
+    options = {'batchsize' : args.batch_size, 'rollups' : not args.no_rollups, 'compact' : args.compact}
+    if args.dedupe_mb:
+        options['dedupebytes'] = int(args.dedupe_mb * 1024 * 1024)
+
+    fd,path = tempfile.mkstemp(prefix='slymedb-bench-',suffix='.db',dir=args.sqlite_dir)
+    os.close(fd)
+    connectstrings = ['sqlite:///%s' % path]
+    if args.mysql:
+        connectstrings.append(args.mysql)
+
+    results = []
+    try:
+        for jobs in args.jobs.split(','):
+            for connectstring in connectstrings:
+                results += benchmark.measure(connectstring,int(float(jobs)),seed=args.seed,**options)
+    finally:
+        os.remove(path)
+    benchmark.report(results)
+
+    if args.save_baseline:
+        benchmark.savebaseline(results,args.save_baseline)
+        sys.stderr.write("Saved the results to %s\n" % args.save_baseline)
+    if args.baseline:
+        regressions = benchmark.compare(results,benchmark.loadbaseline(args.baseline),args.tolerance)
+        for message in regressions:
+            sys.stderr.write("Regression %s\n" % message)
+        if len(regressions) > 0:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Copyright (c) 2014
+Harvard FAS Research Computing
+All rights reserved.
+
+Export job reports to Parquet, Arrow or gzipped CSV files for analysis
+"""
+
+import sys, os
+import datetime
+import getpass
+from slymedb import Store
+from slymedb.export import Exporter
+
+from argparse import ArgumentParser
+from argparse import RawDescriptionHelpFormatter
+
+def main():
+    '''Command line options.'''
+    SLYMEDB_HOST = os.environ.get("SLYMEDB_HOST","db-internal")
+    SLYMEDB_DB   = os.environ.get("SLYMEDB_DB","sacct")
+    SLYMEDB_USER = os.environ.get("SLYMEDB_USER","slymedb")
+    SLYMEDB_PASSWD = os.environ.get("SLYMEDB_PASSWD","slymedb")
+
+    program_desc="""
+Export the job reports that ended (or started, with --column Start) in a date range
+to a directory of Parquet, Arrow IPC or gzipped CSV files, instead of pulling
+jobreport into pandas with SELECT *.  Rows are streamed from a server side cursor
+and written --chunk-rows at a time, so memory use stays bounded.  Each month gets
+its own month=YYYY-MM directory of part files, e.g.
+
+   exportreports.py --starttime 2014-01-01 --endtime 2015-01-01 /scratch/jobreports
+
+   pandas.read_parquet('/scratch/jobreports')
+
+Column types come from the jobreport table, and are listed in the manifest.json
+for CSV readers.  The manifest also records every part written, so an export that
+was interrupted continues where it stopped when it is run again with the same
+arguments.  Use --restart to start over.
+
+Parquet and Arrow need the pyarrow package.
+
+Environment variables SLYMEDB_HOST, SLYMEDB_DB, SLYMEDB_USER, and SLYMEDB_PASSWD
+can be used to set the host, database, user, and password information, respectively.
+    """
+    parser = ArgumentParser(description=program_desc, \
+        formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-u","--user",help="Database username",default=SLYMEDB_USER)
+    parser.add_argument("-p","--password",help="Database password",default=SLYMEDB_PASSWD)
+    parser.add_argument("--host",help="Database hostname",default=SLYMEDB_HOST)
+    parser.add_argument("-d","--database",help="Database",default=SLYMEDB_DB)
+    parser.add_argument("--compact",action="store_true",help="The database uses the compact schema")
+    parser.add_argument("--partitioned",choices=["Start","End"],help="The database is partitioned on this column")
+    parser.add_argument("--format",choices=["parquet","arrow","csv"],default="parquet",help="File format")
+    parser.add_argument("--compression",default="snappy",help="Parquet compression codec")
+    parser.add_argument("--starttime",required=True,help="First day to export, YYYY-MM-DD")
+    parser.add_argument("--endtime",help="Day after the last one to export, YYYY-MM-DD (default today)")
+    parser.add_argument("--column",choices=["Start","End"],default="End",\
+        help="Select and split the job reports by this column")
+    parser.add_argument("--columns",help="Comma separated jobreport columns to export (default all)")
+    parser.add_argument("--where",\
+        help="Pipe separated column filters, with commas for lists, e.g. \
+              --where=\"User=akitzmiller|State=FAILED,TIMEOUT\"")
+    parser.add_argument("--chunk-rows",type=int,default=100000,help="Rows per part file")
+    parser.add_argument("--restart",action="store_true",help="Ignore the manifest of an earlier export")
+    parser.add_argument("directory",help="Directory to export to")
+    args = parser.parse_args()
+
+    starttime = datetime.datetime.strptime(args.starttime,"%Y-%m-%d")
+    endtime = datetime.datetime.combine(datetime.date.today(),datetime.time())
+    if args.endtime:
+        endtime = datetime.datetime.strptime(args.endtime,"%Y-%m-%d")
+
+    filters = {}
+    if args.where:
+        for condition in args.where.split('|'):
+            kv = condition.split('=',1)
+            if len(kv) != 2:
+                parser.error("Can't parse filter %s" % condition)
+            if ',' in kv[1]:
+                filters[kv[0]] = kv[1].split(',')
+            else:
+                filters[kv[0]] = kv[1]
+    columns = None
+    if args.columns:
+        columns = args.columns.split(',')
+
+    password = args.password
+    if not password:
+        password = getpass.getpass('Database password: ')
+    connectstring = "mysql://%s:%s@%s/%s" % (args.user,password,args.host,args.database)
+    try:
+        store = Store(connectstring,compact=args.compact,partitioned=args.partitioned)
+    except Exception, e:
+        sys.stderr.write("Unable to connect to database: %s\n" % str(e))
+        return 1
+
+    try:
+        exporter = Exporter(store,args.directory,format=args.format,column=args.column,
+                            chunksize=args.chunk_rows,columns=columns,compression=args.compression)
+        rows = exporter.run(starttime,endtime,restart=args.restart,**filters)
+    except (ImportError,ValueError), e:
+        sys.stderr.write("%s\n" % e)
+        return 1
+    sys.stderr.write("Exported %d job reports to %s\n" % (rows,args.directory))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,15 +13,36 @@ Created on May 6, 2014
 """
 
 import sys, os, traceback
+import time
 import datetime
-from time import sleep
 import getpass
+import cProfile
+import pstats
+import signal
 from slyme import JobReport, Slurm
-from slyme.util import ShError
 from slymedb import Store
+from slymedb.loader import Loader, AdaptiveWindows, Poller, describe
+from slymedb.dumps import DumpLoader
+from slymedb.metrics import Metrics
 
 from argparse import ArgumentParser
 from argparse import RawDescriptionHelpFormatter
+from sqlalchemy import create_engine, select, func
+
+def resumestart(store,cluster=None):
+    '''
+    Where --since-last-entry and --daemon start for a cluster (default the 
+    store's): its first window in the watermark table, or without 
+    watermarks, its max(Start) in the database less one day.
+    '''
+    if cluster is None:
+        cluster = store.cluster
+    watermarks = store.watermarks(cluster)
+    if len(watermarks) > 0:
+        return watermarks[0][0]
+    jr = store.jobreport_table.c
+    maxstart = store.connection.execute(select([func.max(jr.Start)]).where(jr.Cluster == cluster)).scalar()
+    return maxstart + datetime.timedelta(days=-1)
 
 def main(): # IGNORE:C0111
     '''Command line options.'''
@@ -33,13 +54,77 @@ def main(): # IGNORE:C0111
     program_desc="""
 Load sacct job reports into a MySQL database.
 If a job report is seen multiple times in the sacct output, the database will contain
-the last one it saw.
+the last one it saw.  Repeats are collapsed in memory (up to --dedupe-mb) before 
+they are written, so only the last one costs a database write.  Reports that are
+identical to the stored ones (by the RowHash fingerprint) are not written at all, 
+so overlapping and frequent incremental loads are cheap.  Run --migrate once to 
+add the RowHash column to an existing database.
 
 To load historical data it is best to limit results to jobs in finished states, e.g.
    loadreports.py --sacct-parameters="state=BOOT_FAIL,CANCELLED,COMPLETED,FAILED,NODE_FAIL,PREEMPTED,TIMEOUT"
 
-The --since-last-entry keeps the datatables complete.  To avoid sacct timeouts 
-for large requests, this option splits the request into muliple days if necessary
+The --since-last-entry keeps the datatables complete.  Every window that is loaded 
+is recorded in the watermark table, and the next run fetches only what is missing.
+A recorded window is not fetched again, so jobs still running when it was fetched
+would never be updated; use a finished state list in --sacct-parameters with it.  To avoid sacct 
+timeouts for large requests, the request is split into windows that grow or 
+shrink with the number of jobs and the time sacct takes, and a window is split 
+in half when sacct fails on it.  Windows are fetched by --fetchers concurrent 
+sacct calls, started no faster than --sacct-rate per minute, and saved by 
+--writers database writers.  On databases other than MySQL, writers that update 
+the rollups take turns, so more than one only helps with --no-rollups.
+
+The jobreport_daily and jobreport_monthly tables sum jobs, CPU time and waste per 
+user and partition.  They are updated as reports are saved; after loading with 
+--no-rollups, or after --migrate adds them to an existing database, run 
+--rebuild-rollups.
+
+With --partitioned, job reports are kept in monthly partitions of Start or End 
+(native partitions on MySQL) and old months can be moved out with --archive.
+Alternatively, --compact stores the repeated strings (user, partition, state, 
+job name, node list and cancelled by) once in lookup tables and keeps integer ids 
+in jobreport_compact; jobreport becomes a view with the usual columns.
+
+For loading years of history, --bulk stages the reports in a compressed file and 
+loads it with LOAD DATA LOCAL INFILE (the server must allow local_infile), then 
+merges it into the jobreport table with one statement.
+
+Saved sacct -P output can be loaded without slurmdbd with --dump-files, e.g. for a 
+backfill or after losing the database.  The files (gzipped or not) are split into 
+chunks of --chunk-mb on job boundaries, parsed by --processes processes and saved 
+in file order, so a job that is in more than one file keeps its last report.  
+Gzipped files are split as they are decompressed, so they are read through once 
+by this process.  --bulk can be used with it.
+
+Each run can report where its time went: --metrics-json and --metrics-prom write 
+the time spent waiting for the sacct rate limit, fetching (sacct and slyme parsing), 
+building value dicts, in the database and committing, along with the row counts and 
+the slowest windows.  --profile writes a cProfile dump for pstats or snakeviz.
+
+Job reports that don't fit the jobreport columns (a value of the wrong type, too 
+long, out of range, missing or that slyme can't parse, like a MaxRSS of 16?) are 
+checked a batch at a time and written to the rejected table with reason codes such 
+as type:MaxRSS_kB, while the rest of the batch is saved.  --reprocess-rejected tries 
+them again, e.g. after --migrate, and with --null-invalid saves them with the bad 
+values as NULL.
+
+With --daemon, loadreports keeps running with one pooled database engine and loads 
+whatever the watermark table is missing every --poll-seconds, up to --lag-seconds ago, 
+so the database stays near real time.  A lost connection (e.g. a database failover) 
+is replaced and the cycle retried.  SIGTERM or SIGINT finishes the windows in 
+progress and exits.  Only jobs in finished states are loaded (the list above), 
+unless --sacct-parameters gives a state.
+
+Job reports are keyed on cluster and JobID, so one database can hold several 
+clusters.  --cluster stores a load under a cluster name (and passes it to sacct 
+as --clusters); without it, job reports have an empty cluster name.  With 
+--since-last-entry or --daemon, --clusters loads several clusters at once, e.g.
+   loadreports.py --daemon --clusters odyssey:4,cannon:2
+Each cluster has its own watermarks, its own sacct windows and fetchers (the 
+number after the colon, default --fetchers) started no faster than --sacct-rate,
+while the --writers and the database connections are shared.  Start each cluster 
+with a plain load using --cluster.  Run --migrate once to add the cluster column 
+to an existing database; its job reports get the --cluster name, or none.
 
 Environment variables SLYMEDB_HOST, SLYMEDB_DB, SLYMEDB_USER, and SLYMEDB_PASSWD 
 can be used to set the host, database, user, and password information, respectively.
@@ -53,14 +138,107 @@ can be used to set the host, database, user, and password information, respectiv
     parser.add_argument("--host",help="Database hostname",default=SLYMEDB_HOST)
     parser.add_argument("-d","--database",help="Database",default=SLYMEDB_DB)
     parser.add_argument("--drop-tables",action="store_true",help="If tables exist, drop them first")
+    parser.add_argument("--migrate",action="store_true",\
+        help="Create missing tables and add missing indexes before loading")
     parser.add_argument("--since-last-entry",action="store_true",\
-        help="Set starttime parameter to just above the latest Start value")
+        help="Load every window since the first one in the watermark table that hasn't been loaded")
+    parser.add_argument("--batch-size",type=int,default=1000,\
+        help="Number of job reports written per database batch")
+    parser.add_argument("--batch-bytes",type=int,\
+        help="Also close a batch when it reaches approximately this many bytes")
+    parser.add_argument("--transaction",choices=["batch","window"],default="batch",\
+        help="Commit once per batch, or once per sacct time window with --since-last-entry")
+    parser.add_argument("--fetchers",type=int,default=2,\
+        help="Number of sacct windows fetched at once with --since-last-entry")
+    parser.add_argument("--writers",type=int,default=1,\
+        help="Number of database writer threads with --since-last-entry.  With rollups, writers other than MySQL's take turns")
+    parser.add_argument("--queue-depth",type=int,default=4,\
+        help="Number of fetched windows that may wait for a writer")
+    parser.add_argument("--sacct-rate",type=float,default=2,\
+        help="Maximum number of sacct calls started per minute, 0 for no limit")
+    parser.add_argument("--window-hours",type=float,default=24,\
+        help="Initial sacct window length with --since-last-entry")
+    parser.add_argument("--min-window-minutes",type=float,default=15,\
+        help="Windows that sacct fails on are split down to this length")
+    parser.add_argument("--max-window-hours",type=float,default=168,\
+        help="Longest sacct window")
+    parser.add_argument("--target-jobs",type=int,default=20000,\
+        help="Windows are resized to return about this many jobs")
+    parser.add_argument("--target-seconds",type=float,default=120,\
+        help="Windows are resized to take about this many seconds of sacct time")
+    parser.add_argument("--bulk",action="store_true",\
+        help="Backfill mode: stage the reports to a file and LOAD DATA it, instead of saving in batches")
+    parser.add_argument("--staging-dir",\
+        help="Directory for --bulk staging files (default is the system temp directory)")
+    parser.add_argument("--bulk-batch-size",type=int,default=50000,\
+        help="Batch size for --bulk on databases without LOAD DATA")
+    parser.add_argument("--dump-files",nargs="+",metavar="FILE",\
+        help="Load saved sacct -P output from these files instead of running sacct")
+    parser.add_argument("--processes",type=int,\
+        help="Number of processes parsing --dump-files (default is the number of cores)")
+    parser.add_argument("--chunk-mb",type=float,default=64,\
+        help="Size of the chunks --dump-files are split into, uncompressed")
+    parser.add_argument("--dedupe-mb",type=float,default=64,\
+        help="Memory used to collapse job reports repeated in the sacct output before writing, 0 to write every one")
+    parser.add_argument("--no-rollups",action="store_true",\
+        help="Don't update the daily and monthly rollup tables while loading")
+    parser.add_argument("--rebuild-rollups",action="store_true",\
+        help="Recompute the daily and monthly rollup tables from the jobreport table and exit")
+    parser.add_argument("--partitioned",choices=["Start","End"],\
+        help="Store job reports in monthly partitions of this column (use --migrate to convert existing tables)")
+    parser.add_argument("--compact",action="store_true",\
+        help="Store user, partition, state, job name and node list strings as lookup table ids behind a jobreport view (use --migrate to convert existing tables)")
+    parser.add_argument("--reprocess-rejected",action="store_true",\
+        help="Validate the rows in the rejected table again, save the ones that pass and exit")
+    parser.add_argument("--null-invalid",action="store_true",\
+        help="With --reprocess-rejected, save rejected rows with their invalid values as NULL")
+    parser.add_argument("--archive",metavar="YYYY-MM",\
+        help="Detach the partition for this month into a jobreport_archive_YYYYMM table and exit")
+    parser.add_argument("--archive-dir",\
+        help="With --archive, also export the partition to a gzipped file in this directory")
+    parser.add_argument("--metrics-json",metavar="PATH",\
+        help="Write stage timings, counts, commit latencies and the slowest windows to this JSON file")
+    parser.add_argument("--metrics-prom",metavar="PATH",\
+        help="Write the same metrics to this Prometheus textfile (e.g. in the node_exporter textfile directory)")
+    parser.add_argument("--profile",metavar="PATH",\
+        help="Run the load under cProfile, including the loader threads, and dump the stats to this file")
+    parser.add_argument("--daemon",action="store_true",\
+        help="Keep running, loading the windows since the last load every --poll-seconds")
+    parser.add_argument("--poll-seconds",type=float,default=300,\
+        help="Seconds between --daemon load cycles")
+    parser.add_argument("--lag-seconds",type=float,default=60,\
+        help="--daemon loads windows up to this many seconds ago, to give slurmdbd time to catch up")
+    parser.add_argument("--pool-recycle",type=int,default=3600,\
+        help="With --daemon, replace pooled database connections older than this many seconds")
+    parser.add_argument("--cluster",default="",\
+        help="Cluster name the job reports are stored under, also passed to sacct")
+    parser.add_argument("--clusters",metavar="NAME[:FETCHERS],...",\
+        help="Load these clusters at once with --since-last-entry or --daemon, each with its own fetchers")
     parser.add_argument("--sacct-parameters",
         help="Pipe-separated list of sacct parameters, e.g. \
               --sacct-parameters=\"user=akitzmiller|starttime=2014-05-01\"")
     
     # Process arguments
     args = parser.parse_args()
+    if args.bulk and (args.since_last_entry or args.daemon):
+        parser.error("--bulk loads a single sacct request and can't be used with --since-last-entry or --daemon")
+    if args.daemon and args.profile:
+        parser.error("--profile can't be used with --daemon")
+    if args.dump_files and (args.since_last_entry or args.daemon or args.sacct_parameters):
+        parser.error("--dump-files can't be used with --since-last-entry, --daemon or --sacct-parameters")
+    if args.clusters and not (args.since_last_entry or args.daemon):
+        parser.error("--clusters needs --since-last-entry or --daemon")
+    if args.clusters and args.cluster:
+        parser.error("--cluster and --clusters can't be used together")
+    
+    # Cluster name to loader options
+    clusters = {}
+    if args.clusters:
+        for item in args.clusters.split(','):
+            name,_,fetchers = item.partition(':')
+            clusters[name] = {}
+            if fetchers:
+                clusters[name]['fetchers'] = int(fetchers)
     
     # If password not supplied, prompt for it
     password = args.password
@@ -70,9 +248,18 @@ can be used to set the host, database, user, and password information, respectiv
     
     # Check the connection to the database
     connectstring = "mysql://%s:%s@%s/%s" % (args.user,password,args.host,args.database)
+    if args.bulk:
+        connectstring += "?local_infile=1"
    
+    if args.daemon:
+        # One pool for the life of the daemon, with a connection per writer
+        connectstring = create_engine(connectstring,pool_recycle=args.pool_recycle,pool_size=args.writers + 2)
+    
+    metrics = Metrics()
     try:
-        store = Store(connectstring)
+        store = Store(connectstring,batchsize=args.batch_size,batchbytes=args.batch_bytes,
+                      rollups=not args.no_rollups,partitioned=args.partitioned,compact=args.compact,
+                      dedupebytes=int(args.dedupe_mb * 1024 * 1024),metrics=metrics,cluster=args.cluster)
         sys.stderr.write("Connected to database successfully\n")
     except Exception, e:
         sys.stderr.write("Unable to connect to database: %s\n" % str(e))
@@ -83,6 +270,34 @@ can be used to set the host, database, user, and password information, respectiv
         store.drop()
         store.create()
     
+    # Add anything missing from existing tables
+    if args.migrate:
+        store.migrate()
+    
+    if args.rebuild_rollups:
+        store.rebuildrollups()
+        sys.stderr.write("Rebuilt the rollup tables\n")
+        return 0
+    
+    if args.reprocess_rejected:
+        counts = store.reprocess(nullify=args.null_invalid)
+        sys.stderr.write("Saved %d rejected job reports, %d are still rejected\n" % 
+                         (counts['inserted'] + counts['updated'] + counts['unchanged'],counts['rejected']))
+        return 0
+    
+    if args.archive:
+        month = datetime.datetime.strptime(args.archive,"%Y-%m")
+        path = None
+        if args.archive_dir:
+            path = os.path.join(args.archive_dir,"jobreport-%s.tsv.gz" % args.archive)
+        store.archive(month,path=path)
+        sys.stderr.write("Archived %s\n" % args.archive)
+        return 0
+    
+    # Make the partitions for this month and next ahead of time
+    today = datetime.datetime.today()
+    store.ensurepartitions(today,today + datetime.timedelta(days=31))
+    
     # Parse the sacct parameters into a dict
     sacctparams = {}
     if args.sacct_parameters is not None:
@@ -95,64 +310,144 @@ can be used to set the host, database, user, and password information, respectiv
                 sacctparams[kv[0]] = True
             else:
                 raise Exception("Can't parse sacct parameter %s" % param)
+    if args.cluster:
+        sacctparams.setdefault('clusters',args.cluster)
             
-    # Find max(Start) in the database and set starttime to Start + 1
-    # If there is no table or value do nothing
-    count = 0
-    if args.since_last_entry:
+    # One day at a time, Sweet Jesus, unless sacct can take more
+    planneroptions = dict(size=datetime.timedelta(hours=args.window_hours),
+                          minsize=datetime.timedelta(minutes=args.min_window_minutes),
+                          maxsize=datetime.timedelta(hours=args.max_window_hours),
+                          targetjobs=args.target_jobs,
+                          targetseconds=args.target_seconds)
+    loaderoptions = dict(fetchers=args.fetchers,
+                         writers=args.writers,
+                         queuedepth=args.queue_depth,
+                         rate=args.sacct_rate,
+                         atomic=(args.transaction == "window"),
+                         clusters=clusters)
+    
+    # Resume from the watermark table: fetch whatever hasn't been loaded 
+    # since the first recorded window, for each cluster.
+    if args.since_last_entry or args.daemon:
         try:
-            result = store.connection.execute("select max(Start) as maxstart from jobreport")
-            row = result.first()
-            maxstart = row["maxstart"]
-            
-            startdate = maxstart + datetime.timedelta(days=-1)
-            enddate = startdate + datetime.timedelta(days=1)
+            start = dict((name,resumestart(store,name)) for name in clusters)
+            if len(clusters) == 0:
+                start = {None : resumestart(store)}
         except Exception, e:
-            sys.stderr.write("Error getting max Start.  No starttime will be set \
-               %s\n" % e.message)
+            sys.stderr.write("Error getting the last loaded window (try --migrate).  No starttime will be set \
+               %s\n" % e)
             exit(1)
-            
-        # One day at a time, Sweet Jesus
-        while enddate < datetime.datetime.today():
-            sacctparams["starttime"] = str(startdate)
-            sacctparams["endtime"] = str(enddate)
-            sys.stderr.write("--starttime %s, --endtime %s\n" % (sacctparams['starttime'],sacctparams['endtime']))
-            jrs = Slurm.getJobReports(**sacctparams)
-            try:
-                for jr in jrs:
-                    store.save([jr])
-                    count += 1
-                    if count % 100 == 0:
-                        store.session.commit()
-                        store.session.expire_all()
-                        sys.stderr.write("Loaded %d job reports\n" % count)
-            except ShError, e:
-                if "print.c:179" in str(e):
-                    pass
-                else:
-                    raise e
-            except Exception as e:
-                sys.stderr.write("Error saving jobreport %s\n" % e)
-            sys.stderr.write("Loaded %d\n" % count)
-                    
-            startdate = startdate +  datetime.timedelta(days=1)
-            enddate = enddate +  datetime.timedelta(days=1)
-            sleep(30)
+    
+    if args.daemon:
+        def aftercycle(counts):
+            if args.metrics_json:
+                metrics.writejson(args.metrics_json)
+            if args.metrics_prom:
+                metrics.writeprometheus(args.metrics_prom)
+        poller = Poller(store,start,sacctparams,
+                        interval=args.poll_seconds,
+                        lag=args.lag_seconds,
+                        planner=planneroptions,
+                        loader=loaderoptions,
+                        after=aftercycle)
+        def shutdown(signum,frame):
+            sys.stderr.write("Received signal %d, finishing the current windows\n" % signum)
+            poller.stop()
+        signal.signal(signal.SIGTERM,shutdown)
+        signal.signal(signal.SIGINT,shutdown)
+        poller.run()
+        store.connection.close()
+        store.engine.dispose()
+        return 0
+    
+    profiler = None
+    profiles = []
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    
+    count = 0
+    duplicates = 0
+    unchanged = 0
+    rejected = 0
+    if args.since_last_entry:
+        now = datetime.datetime.today()
+        planners = {}
+        for cluster,clusterstart in start.items():
+            ranges = store.gaps(clusterstart,now,cluster)
+            if len(ranges) > 0:
+                store.ensurepartitions(ranges[0][0],now)
+            planners[cluster] = AdaptiveWindows(ranges,**planneroptions)
+        
+        loader = Loader(store,sacctparams,profile=bool(args.profile),**loaderoptions)
+        counts = loader.run(planners)
+        profiles = loader.profiles
+        count += counts['inserted'] + counts['updated']
+        duplicates += counts.get('duplicates',0)
+        unchanged += counts['unchanged']
+        rejected += counts.get('rejected',0)
+        for cluster,window in loader.failed:
+            sys.stderr.write("Failed to load %s\n" % describe(cluster,window))
+        store.compactwatermarks()
+        
+    elif args.dump_files:
+        start = time.time()
+        loader = DumpLoader(store,processes=args.processes,chunkbytes=int(args.chunk_mb * 1024 * 1024))
+        try:
+            counts = loader.run(args.dump_files,bulk=args.bulk)
+            count += counts['inserted'] + counts['updated']
+            duplicates += counts.get('duplicates',0)
+            unchanged += counts['unchanged']
+            rejected += counts.get('rejected',0)
+        except Exception as e:
+            sys.stderr.write("Error loading dump files %s\n%s" % (e,traceback.format_exc()))
+        seconds = time.time() - start
+        sys.stderr.write("Loaded %d job reports from %d files in %.1f seconds, %.0f rows/sec\n" % 
+                         (count,len(args.dump_files),seconds,count / max(seconds,0.001)))
+        
+    elif args.bulk:
+        jrs = metrics.iterate(Slurm.getJobReports(**sacctparams),'fetch')
+        start = time.time()
+        try:
+            counts = store.bulksave(jrs,stagingdir=args.staging_dir,batchsize=args.bulk_batch_size)
+            count += counts['inserted'] + counts['updated']
+            duplicates += counts.get('duplicates',0)
+            unchanged += counts['unchanged']
+            rejected += counts.get('rejected',0)
+        except Exception as e:
+            sys.stderr.write("Error bulk loading jobreports %s\n%s" % (e,traceback.format_exc()))
+        seconds = time.time() - start
+        sys.stderr.write("Bulk loaded %d job reports in %.1f seconds, %.0f rows/sec\n" % 
+                         (count,seconds,count / max(seconds,0.001)))
         
     else:                      
-        jrs = Slurm.getJobReports(**sacctparams)
-        for jr in jrs:
-            try:
-                store.save([jr])
-                count += 1
-                if count % 100 == 0:
-                    store.session.commit()
-                    store.session.expire_all()
-                    sys.stderr.write("Loaded %d job reports\n" % count)
-            except Exception as e:
-                sys.stderr.write("Error saving jobreport %s\n%s" % (e,traceback.format_exc()))
+        jrs = metrics.iterate(Slurm.getJobReports(**sacctparams),'fetch')
+        try:
+            counts = store.save(jrs)
+            count += counts['inserted'] + counts['updated']
+            duplicates += counts.get('duplicates',0)
+            unchanged += counts['unchanged']
+            rejected += counts.get('rejected',0)
+        except Exception as e:
+            sys.stderr.write("Error saving jobreports %s\n%s" % (e,traceback.format_exc()))
         
-    sys.stderr.write("Finished loading %d job reports\n" % count)
+    if profiler is not None:
+        profiler.disable()
+        stats = pstats.Stats(profiler)
+        for profile in profiles:
+            stats.add(profile)
+        stats.dump_stats(args.profile)
+        sys.stderr.write("Wrote the profile to %s\n" % args.profile)
+    if args.metrics_json:
+        metrics.writejson(args.metrics_json)
+    if args.metrics_prom:
+        metrics.writeprometheus(args.metrics_prom)
+    if args.verbose:
+        for stage,v in sorted(metrics.summary()['stages'].items()):
+            sys.stderr.write("%-12s %10.1f seconds %8d calls\n" % (stage,v['seconds'],v['calls']))
+    
+    sys.stderr.write("Finished loading %d job reports, %d were already stored unchanged, %d repeated reports were dropped and %d were rejected\n" % 
+                     (count,unchanged,duplicates,rejected))
     return 0
 #     except KeyboardInterrupt:
 #         ### handle keyboard interrupt ###
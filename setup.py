@@ -20,11 +20,14 @@ setup(
     url='http://pypi.python.org/pypi/slymedb/',
     packages = find_packages(),
     long_description=open('README.txt').read(),
-    scripts = ['bin/loadreports.py'],
+    scripts = ['bin/loadreports.py','bin/benchreports.py','bin/exportreports.py'],
     install_requires=[
         "SQLAlchemy > 0.9.0",
         "slyme >= 0.1.0"
     ],
+    extras_require={
+        "export" : ["pyarrow"],
+    },
     classifiers=[
         "Development Status :: 3 - Alpha",
         "Topic :: Utilities",
@@ -0,0 +1,251 @@
+'''
+Ingestion benchmarks with synthetic sacct output.
+
+sacctlines generates sacct lines in the JobID|User|JobName|...|Elapsed
+format that loadreports reads, with step rows and the oddities seen in
+real output.  measure runs them through Slurm.getJobReports and
+Store.save in a child process and reports rows/sec, peak RSS and the
+number of SQL statements per row.  Results can be saved as a baseline
+and later runs compared against it.
+'''
+import os
+import sys
+import time
+import json
+import random
+import datetime
+import resource
+import multiprocessing
+from sqlalchemy import event
+from slyme import Slurm
+from slymedb.store import Store
+
+
+partitions = ['general','serial_requeue','interact','bigmem','unrestricted','gpu']
+
+jobnames = ['bash','dusage.sbatch','agalmatest.sbatch','run.sh','trinity','bwa_mem','matlab','R',
+            "samtools view IMR_PO_051214.bam | awk '{print }' | sort -u -z > regions"]
+
+# State and percentage of jobs; CANCELLED gets ' by <uid>' appended
+states = [('COMPLETED',70),('FAILED',10),('CANCELLED',8),('TIMEOUT',5),('RUNNING',3),
+          ('NODE_FAIL',1),('PREEMPTED',2),('BOOT_FAIL',1)]
+
+
+def interval(seconds,fraction=False):
+    """
+    sacct time interval text: [D-]HH:MM:SS, or MM:SS.mmm for short
+    TotalCPU style values if fraction is True
+    """
+    if fraction and seconds < 3600:
+        return '%02d:%06.3f' % (int(seconds) // 60,seconds % 60)
+    seconds = int(seconds)
+    days,seconds = divmod(seconds,86400)
+    text = '%02d:%02d:%02d' % (seconds // 3600,seconds % 3600 // 60,seconds % 60)
+    if days > 0:
+        text = '%d-%s' % (days,text)
+    return text
+
+
+def sacctlines(jobs,seed=0,start=datetime.datetime(2014,5,1)):
+    """
+    Generate the sacct lines for jobs jobs, the same for the same seed.
+    Most jobs are followed by a .batch step row that has the MaxRSS.  A
+    few have pipes in the JobName, MaxRSS values that are empty, 0 or
+    '16?', multi day times, 'None assigned' node lists or no End yet.
+    """
+    rng = random.Random(seed)
+    users = ['user%03d' % i for i in range(500)]
+    choices = []
+    for state,percent in states:
+        choices += [state] * percent
+    jobid = 10000000
+    submit = start
+    for i in xrange(jobs):
+        jobid += rng.randint(1,3)
+        submit += datetime.timedelta(seconds=rng.randint(0,20))
+        user = rng.choice(users)
+        name = rng.choice(jobnames)
+        partition = rng.choice(partitions)
+        state = rng.choice(choices)
+        ncpus = rng.choice([1,1,1,1,2,4,8,16,32,64])
+        nnodes = max(1,ncpus // 32)
+        elapsed = min(int(rng.expovariate(1.0 / 3600)),7 * 86400)
+        jobstart = submit + datetime.timedelta(seconds=rng.randint(0,600))
+        end = (jobstart + datetime.timedelta(seconds=elapsed)).strftime('%Y-%m-%dT%H:%M:%S')
+        node = 'holy2a%02d%03d' % (rng.randint(1,20),rng.randint(101,408))
+        if nnodes > 1:
+            node = 'holy2a[%02d101-%02d1%02d]' % (rng.randint(1,20),rng.randint(1,20),nnodes)
+        if state == 'RUNNING':
+            end = 'Unknown'
+        elif state == 'CANCELLED':
+            state = 'CANCELLED by %d' % rng.randint(0,600000)
+            if rng.random() < 0.3:
+                # Cancelled while pending
+                elapsed,ncpus,node = 0,0,'None assigned'
+                end = jobstart.strftime('%Y-%m-%dT%H:%M:%S')
+
+        cputime = elapsed * ncpus
+        totalcpu = cputime * rng.random()
+        reqmem = rng.choice(['%dMn' % rng.choice([2000,4000,20000,300000]),'%dMc' % rng.choice([1000,2000,4000])])
+        times = '|'.join([interval(cputime),interval(totalcpu,True),interval(totalcpu * 0.9,True),interval(totalcpu * 0.1,True)])
+        dates = '%s|%s' % (jobstart.strftime('%Y-%m-%dT%H:%M:%S'),end)
+        yield '|'.join([str(jobid),user,name,state,partition,str(ncpus),str(nnodes),
+                        times,reqmem,'',dates,node,interval(elapsed)])
+
+        if ncpus > 0 and state != 'RUNNING':
+            maxrss = rng.choice(['%dK' % rng.randint(1000,30000000)] * 6 +
+                                ['%dM' % rng.randint(1,100000),'%dG' % rng.randint(1,200),'','0','16?'])
+            yield '|'.join(['%d.batch' % jobid,'','batch',state.split(' ')[0],'','1','1',
+                            interval(elapsed),interval(totalcpu,True),interval(totalcpu * 0.9,True),
+                            interval(totalcpu * 0.1,True),reqmem,maxrss,dates,node.split('[')[0],interval(elapsed)])
+
+
+def getjobreports(jobs,seed=0):
+    """
+    Slurm.getJobReports for sacctlines(jobs,seed)
+    """
+    return Slurm.getJobReports(execfunc=lambda args=[]: sacctlines(jobs,seed))
+
+
+class StatementCounter(object):
+    """
+    Counts the statements an engine sends to the database.  An executemany
+    counts once.
+    """
+    def __init__(self,engine):
+        self.statements = 0
+        event.listen(engine,'before_cursor_execute',self.count)
+
+    def count(self,conn,cursor,statement,parameters,context,executemany):
+        self.statements += 1
+
+
+def run(connectstring,jobs,seed=0,**storeoptions):
+    """
+    Parse, load and reload jobs synthetic jobs into a freshly created Store
+    and return a list of result dicts, one for each phase.  The reload saves
+    the same reports again, which is what an overlapping incremental load
+    mostly does.
+    """
+    results = []
+    def result(phase,rows,seconds,statements=None):
+        r = {'phase' : phase, 'jobs' : jobs, 'rows' : rows, 'seconds' : seconds,
+             'rows_per_sec' : rows / max(seconds,1e-6), 'statements' : statements,
+             'statements_per_row' : None,
+             'peak_rss_mb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+        if statements is not None:
+            r['statements_per_row'] = float(statements) / max(rows,1)
+        results.append(r)
+
+    start = time.time()
+    rows = sum(1 for jr in getjobreports(jobs,seed))
+    result('parse',rows,time.time() - start)
+
+    store = Store(connectstring,**storeoptions)
+    store.drop()
+    store.create()
+    counter = StatementCounter(store.engine)
+    for phase in ('load','reload'):
+        counter.statements = 0
+        start = time.time()
+        counts = store.save(getjobreports(jobs,seed))
+        seconds = time.time() - start
+        result(phase,counts['inserted'] + counts['updated'] + counts['unchanged'],seconds,counter.statements)
+
+    backend = store.engine.dialect.name
+    store.drop()
+    store.connection.close()
+    store.engine.dispose()
+    for r in results:
+        r['backend'] = backend
+    return results
+
+
+def _child(queue,args,kwargs):
+    try:
+        queue.put(run(*args,**kwargs))
+    except Exception as e:
+        queue.put(e)
+
+
+def measure(connectstring,jobs,seed=0,**storeoptions):
+    """
+    run in a child process, so that peak RSS is for this run alone
+    """
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_child,args=(queue,(connectstring,jobs,seed),storeoptions))
+    child.start()
+    results = queue.get()
+    child.join()
+    if isinstance(results,Exception):
+        raise results
+    return results
+
+
+def _key(result):
+    return '%s/%d/%s' % (result['backend'],result['jobs'],result['phase'])
+
+
+def savebaseline(results,path):
+    """
+    Write results to a baseline JSON file, replacing the entries for the
+    same backend, number of jobs and phase
+    """
+    baseline = {}
+    if os.path.exists(path):
+        baseline = loadbaseline(path)
+    for r in results:
+        baseline[_key(r)] = r
+    out = open(path,'w')
+    try:
+        json.dump(baseline,out,indent=2,sort_keys=True,separators=(',',': '))
+        out.write('\n')
+    finally:
+        out.close()
+
+
+def loadbaseline(path):
+    """
+    Dict of baseline results by backend/jobs/phase
+    """
+    f = open(path)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def compare(results,baseline,tolerance=0.25):
+    """
+    List of messages for results that are worse than their baseline by
+    more than tolerance: slower rows/sec, more statements per row or a
+    higher peak RSS.  Results without a baseline are skipped.
+    """
+    regressions = []
+    for r in results:
+        base = baseline.get(_key(r))
+        if base is None:
+            continue
+        if r['rows_per_sec'] < base['rows_per_sec'] * (1 - tolerance):
+            regressions.append('%s: %.0f rows/sec, baseline %.0f' % (_key(r),r['rows_per_sec'],base['rows_per_sec']))
+        if r['statements_per_row'] is not None and base['statements_per_row'] is not None and \
+                r['statements_per_row'] > base['statements_per_row'] * (1 + tolerance) + 1e-6:
+            regressions.append('%s: %.4f statements per row, baseline %.4f' %
+                               (_key(r),r['statements_per_row'],base['statements_per_row']))
+        if r['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append('%s: %.0f MB peak RSS, baseline %.0f' % (_key(r),r['peak_rss_mb'],base['peak_rss_mb']))
+    return regressions
+
+
+def report(results,out=sys.stdout):
+    """
+    Write results as a table
+    """
+    out.write('%-8s %10s %-7s %12s %10s %12s %10s\n' %
+              ('backend','jobs','phase','rows/sec','seconds','stmts/row','peak MB'))
+    for r in results:
+        perrow = '-'
+        if r['statements_per_row'] is not None:
+            perrow = '%.4f' % r['statements_per_row']
+        out.write('%-8s %10d %-7s %12.0f %10.1f %12s %10.0f\n' %
+                  (r['backend'],r['jobs'],r['phase'],r['rows_per_sec'],r['seconds'],perrow,r['peak_rss_mb']))
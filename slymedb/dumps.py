@@ -0,0 +1,204 @@
+'''
+Offline loading of saved sacct -P output, e.g. for backfills and disaster
+recovery.
+
+Dump files are split into chunks of about chunkbytes that end on a job
+boundary, so a job and its step rows are always parsed together.
+Uncompressed files are memory mapped to find the boundaries and read the
+chunks.  A gzipped file can't be read from the middle, so it is 
+decompressed as it is split and its chunks are handed to the pool as 
+text.  The chunks are parsed by Slurm.getJobReports in a pool of
+processes, which also build the value dicts and their fingerprints, and
+the rows are fed, in file order, to one batched Store.save (or 
+bulksave), so a job seen in more than one dump keeps its last report.
+'''
+import os
+import sys
+import mmap
+import gzip
+import time
+import collections
+import multiprocessing
+from slyme import Slurm
+from slymedb.store import Store, readvalues, fingerprintvalues
+
+
+def _jobboundary(data,pos,size):
+    """
+    Offset of the first line at or after pos that starts a job, rather
+    than continuing a line or being a step (JobID with a dot) of the job
+    before it
+    """
+    if pos > 0 and data[pos - 1] != '\n':
+        pos = data.find('\n',pos)
+        if pos < 0:
+            return size
+        pos += 1
+    while pos < size:
+        bar = data.find('|',pos,pos + 64)
+        if bar < 0 or '.' not in data[pos:bar]:
+            return pos
+        pos = data.find('\n',pos)
+        if pos < 0:
+            return size
+        pos += 1
+    return size
+
+
+def _startsjob(line):
+    """
+    True if a dump line starts a job rather than being one of its steps
+    """
+    bar = line.find('|',0,64)
+    return bar < 0 or '.' not in line[:bar]
+
+
+def _gzipchunks(path,chunkbytes):
+    """
+    Generate (path, start, end, text) chunks of about chunkbytes of a
+    gzipped dump file, split on job boundaries as it is decompressed.
+    start and end are offsets in the decompressed text.
+    """
+    f = gzip.open(path,'rb')
+    try:
+        start = 0
+        size = 0
+        buffered = []
+        for line in f:
+            if size >= chunkbytes and _startsjob(line):
+                yield (path,start,start + size,''.join(buffered))
+                start += size
+                size = 0
+                buffered = []
+            buffered.append(line)
+            size += len(line)
+        if size > 0:
+            yield (path,start,start + size,''.join(buffered))
+    finally:
+        f.close()
+
+
+def chunks(path,chunkbytes):
+    """
+    Generate (path, start, end, text) chunks of about chunkbytes that split
+    a dump file on job boundaries.  text is None for an uncompressed file,
+    whose byte range is read by the parsing process, and the decompressed
+    chunk for a gzipped one.
+    """
+    if path.endswith('.gz'):
+        for chunk in _gzipchunks(path,chunkbytes):
+            yield chunk
+        return
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+    f = open(path,'rb')
+    try:
+        data = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        try:
+            start = 0
+            while start < size:
+                end = _jobboundary(data,min(start + chunkbytes,size),size)
+                yield (path,start,end,None)
+                start = end
+        finally:
+            data.close()
+    finally:
+        f.close()
+
+
+def lines(path,start,end,text=None):
+    """
+    Lines of a chunk of a dump file, without sacct header lines
+    """
+    if text is None:
+        f = open(path,'rb')
+        try:
+            data = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+            try:
+                text = data[start:end]
+            finally:
+                data.close()
+        finally:
+            f.close()
+    for line in text.splitlines():
+        if not line.startswith('JobID|'):
+            yield line
+
+
+def parse(args):
+    """
+    Parse one chunk and return the value dicts of its job reports, with
+    the names values and their fingerprint.  Runs in a pool process.
+    """
+    chunk,names = args
+    text = lines(*chunk)
+    rows = []
+    for jobreport in Slurm.getJobReports(execfunc=lambda args=[]: text):
+        row = readvalues(jobreport,names)
+        row[Store.hashcolumn] = fingerprintvalues(row,names)
+        rows.append(row)
+    return rows
+
+
+class DumpLoader(object):
+    """
+    Loads dump files into a Store, parsing them in a process pool
+    """
+    def __init__(self,store,processes=None,chunkbytes=64 * 1024 * 1024,log=sys.stderr):
+        """
+        processes defaults to the number of cores
+        """
+        self.store = store
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunkbytes = chunkbytes
+        self.log = log
+
+    def run(self,paths,bulk=False):
+        """
+        Load the job reports in paths with Store.save, or bulksave if bulk
+        is True, in the Store's cluster, and return the counts
+        """
+        if bulk:
+            return self.store.bulksave(self.reports(paths))
+        return self.store.save(self.reports(paths))
+
+    def reports(self,paths):
+        """
+        Generate value dicts for the job reports in paths, in order.  Up to
+        two chunks per process are parsed ahead of the one being written, 
+        which bounds the gzipped text held in memory as well.
+        """
+        names = self.store.reportcolumns
+        metrics = self.store.metrics
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            pending = collections.deque()
+            todo = ((chunk,names) for path in paths for chunk in chunks(path,self.chunkbytes))
+            for args in todo:
+                # Keep the range for the log, not the text
+                pending.append((args[0][:3],pool.apply_async(parse,(args,))))
+                if len(pending) < 2 * self.processes:
+                    continue
+                for row in self._chunkrows(pending.popleft(),metrics):
+                    yield row
+            while len(pending) > 0:
+                for row in self._chunkrows(pending.popleft(),metrics):
+                    yield row
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _chunkrows(self,item,metrics):
+        """
+        Wait for a parsed chunk and return its value dicts
+        """
+        chunk,result = item
+        start = time.time()
+        rows = result.get()
+        if metrics is not None:
+            metrics.add('parse_wait',time.time() - start)
+            metrics.count('dump_chunks')
+        self.log.write("Parsed %d job reports from %s bytes %s to %s\n" % (len(rows),chunk[0],chunk[1],chunk[2]))
+        return rows
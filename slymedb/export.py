@@ -0,0 +1,287 @@
+'''
+Streaming export of job reports to Parquet, Arrow IPC or gzipped CSV files.
+
+An Exporter reads a date range from Store.fetch, which pages through a
+server side cursor, and writes it in chunks of chunksize rows, so memory
+use is bounded by one chunk whatever the size of the range.  Each month
+of the date column gets its own month=YYYY-MM directory of part files,
+which pyarrow and pandas read as a single partitioned dataset.
+
+Each month is paged through in order of the date column, then Cluster
+and JobID, so the date column's index serves both the month's range and
+the pages.  A manifest.json in the export directory records every part 
+written and those values for the last row in it.  Running the same 
+export again resumes after the last recorded part.
+
+Parquet and Arrow need pyarrow, which is optional; CSV does not.
+'''
+import os
+import sys
+import csv
+import gzip
+import json
+import datetime
+import tempfile
+from sqlalchemy import types
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Part file extension for each format
+extensions = {
+    'parquet' : 'parquet',
+    'arrow'   : 'arrow',
+    'csv'     : 'csv.gz',
+}
+
+
+def months(starttime,endtime):
+    """
+    Generate (month, lower, upper) for each month that starttime to endtime
+    overlaps, where lower and upper are the part of the range in it
+    """
+    month = datetime.datetime(starttime.year,starttime.month,1)
+    while month < endtime:
+        nextmonth = (month + datetime.timedelta(days=32)).replace(day=1)
+        yield month,max(month,starttime),min(nextmonth,endtime)
+        month = nextmonth
+
+
+def columntypes(table,columns=None):
+    """
+    List of (name, type) for columns (default all) of table, where type is
+    string, int32, int64, float64 or timestamp
+    """
+    result = []
+    for column in table.columns:
+        if columns is not None and column.name not in columns:
+            continue
+        coltype = column.type
+        if isinstance(coltype,types.String):
+            kind = 'string'
+        elif isinstance(coltype,types.BigInteger):
+            kind = 'int64'
+        elif isinstance(coltype,types.Integer):
+            kind = 'int32'
+        elif isinstance(coltype,types.Float):
+            kind = 'float64'
+        elif isinstance(coltype,types.DateTime):
+            kind = 'timestamp'
+        else:
+            raise ValueError("Can't export column %s of type %s" % (column.name,coltype))
+        result.append((column.name,kind))
+    return result
+
+
+def arrowschema(coltypes):
+    """
+    pyarrow schema for a columntypes list.  Timestamps are in 
+    milliseconds, the coarsest unit Parquet stores.
+    """
+    arrowtypes = {
+        'string'    : pyarrow.string(),
+        'int32'     : pyarrow.int32(),
+        'int64'     : pyarrow.int64(),
+        'float64'   : pyarrow.float64(),
+        'timestamp' : pyarrow.timestamp('ms'),
+    }
+    return pyarrow.schema([pyarrow.field(name,arrowtypes[kind]) for name,kind in coltypes])
+
+
+class Exporter(object):
+    """
+    Exports the job reports in a range of Start or End to a directory
+    """
+    def __init__(self,store,directory,format='parquet',column='End',chunksize=100000,
+                 columns=None,compression='snappy',log=sys.stderr):
+        """
+        format is parquet, arrow or csv.  Rows are selected and split into
+        months by column, Start or End.  columns defaults to every jobreport
+        column but the RowHash fingerprint; column and the Cluster and JobID
+        key are always exported, since resuming starts after the last row.
+        compression is the Parquet codec; CSV is always gzipped.
+        """
+        if format not in extensions:
+            raise ValueError("Unknown export format %s" % format)
+        if format in ('parquet','arrow') and pyarrow is None:
+            raise ImportError("pyarrow is needed for %s export (pip install pyarrow), or use csv" % format)
+        if column not in ('Start','End'):
+            raise ValueError("Exports can only be split by Start or End, not %s" % column)
+        if columns is None:
+            columns = store.contentcolumns
+        columns = [k for k in (column,) + store.keycolumns if k not in columns] + list(columns)
+        self.store = store
+        self.directory = directory
+        self.format = format
+        self.column = column
+        self.chunksize = chunksize
+        self.coltypes = columntypes(store.jobreport_table,columns)
+        self.columns = [name for name,kind in self.coltypes]
+        self.compression = compression
+        self.log = log
+        self.schema = None
+        if pyarrow is not None and format != 'csv':
+            self.schema = arrowschema(self.coltypes)
+
+    def run(self,starttime,endtime,restart=False,**filters):
+        """
+        Export the job reports with column from starttime up to endtime that
+        match the Store.fetch filters.  An export of the same range, filters
+        and format that was interrupted is resumed after its last part,
+        unless restart is True.  Returns the number of rows written by this
+        run.
+        """
+        manifest = self._manifest(starttime,endtime,filters)
+        path = os.path.join(self.directory,'manifest.json')
+        if os.path.exists(path) and not restart:
+            existing = self._load(path)
+            for key in ('format','column','columns','starttime','endtime','filters'):
+                if existing[key] != manifest[key]:
+                    raise ValueError("%s has a different %s; export to another directory or restart" % (path,key))
+            manifest = existing
+        elif not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        total = 0
+        for month,lower,upper in months(starttime,endtime):
+            name = month.strftime('%Y-%m')
+            progress = manifest['months'].setdefault(name,{'parts' : [], 'rows' : 0, 'done' : False})
+            if progress['done']:
+                continue
+            total += self._exportmonth(manifest,name,progress,lower,upper,filters,path)
+        return total
+
+    def _exportmonth(self,manifest,name,progress,lower,upper,filters,path):
+        """
+        Write the parts of one month that aren't in the manifest yet
+        """
+        kwargs = dict(filters)
+        kwargs[self.column + '__ge'] = lower
+        kwargs[self.column + '__lt'] = upper
+        after = None
+        if len(progress['parts']) > 0:
+            when,cluster,jobid = progress['parts'][-1]['last']
+            after = (datetime.datetime.strptime(when,'%Y-%m-%d %H:%M:%S.%f'),cluster,jobid)
+        monthdir = os.path.join(self.directory,'month=%s' % name)
+        if not os.path.isdir(monthdir):
+            os.makedirs(monthdir)
+
+        rows = 0
+        chunk = []
+        for record in self.store.fetch(columns=self.columns,orderby=self.column,after=after,**kwargs):
+            chunk.append(record)
+            if len(chunk) >= self.chunksize:
+                rows += self._part(manifest,name,progress,monthdir,chunk,path)
+                chunk = []
+        if len(chunk) > 0:
+            rows += self._part(manifest,name,progress,monthdir,chunk,path)
+        progress['done'] = True
+        self._save(manifest,path)
+        self.log.write("Exported %d job reports for %s\n" % (progress['rows'],name))
+        return rows
+
+    def _part(self,manifest,name,progress,monthdir,chunk,path):
+        """
+        Write a chunk of records as the next part of a month and record it
+        in the manifest
+        """
+        filename = 'part-%05d.%s' % (len(progress['parts']),extensions[self.format])
+        partpath = os.path.join(monthdir,filename)
+        fd,tmppath = tempfile.mkstemp(prefix='.part-',dir=monthdir)
+        os.close(fd)
+        try:
+            getattr(self,'_write' + self.format)(tmppath,chunk)
+            os.rename(tmppath,partpath)
+        except:
+            os.remove(tmppath)
+            raise
+        progress['parts'].append({'file' : 'month=%s/%s' % (name,filename), 'rows' : len(chunk),
+                                  'last' : [getattr(chunk[-1],self.column).strftime('%Y-%m-%d %H:%M:%S.%f'),
+                                            chunk[-1].Cluster,chunk[-1].JobID]})
+        progress['rows'] += len(chunk)
+        self._save(manifest,path)
+        return len(chunk)
+
+    def _table(self,chunk):
+        """
+        pyarrow Table of a chunk of records, typed from the jobreport columns
+        """
+        columns = zip(*chunk)
+        arrays = [pyarrow.array(list(values),type=field.type) for values,field in zip(columns,self.schema)]
+        return pyarrow.Table.from_arrays(arrays,schema=self.schema)
+
+    def _writeparquet(self,path,chunk):
+        pyarrow.parquet.write_table(self._table(chunk),path,compression=self.compression)
+
+    def _writearrow(self,path,chunk):
+        table = self._table(chunk)
+        sink = pyarrow.OSFile(path,'wb')
+        try:
+            writer = pyarrow.RecordBatchFileWriter(sink,self.schema)
+            writer.write_table(table)
+            writer.close()
+        finally:
+            sink.close()
+
+    def _writecsv(self,path,chunk):
+        out = gzip.open(path,'wb')
+        try:
+            writer = csv.writer(out)
+            writer.writerow(self.columns)
+            for record in chunk:
+                writer.writerow([self._csvvalue(value) for value in record])
+        finally:
+            out.close()
+
+    def _csvvalue(self,value):
+        """
+        CSV text for a value; NULL is empty
+        """
+        if value is None:
+            return ''
+        if isinstance(value,datetime.datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        if isinstance(value,float):
+            return repr(value)
+        if isinstance(value,unicode):
+            return value.encode('utf-8')
+        return value
+
+    def _manifest(self,starttime,endtime,filters):
+        """
+        Empty manifest for an export
+        """
+        return {
+            'format' : self.format,
+            'column' : self.column,
+            'columns' : [[name,kind] for name,kind in self.coltypes],
+            'starttime' : starttime.strftime('%Y-%m-%d %H:%M:%S'),
+            'endtime' : endtime.strftime('%Y-%m-%d %H:%M:%S'),
+            'filters' : dict((k,repr(v)) for k,v in filters.items()),
+            'months' : {},
+        }
+
+    def _load(self,path):
+        f = open(path)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def _save(self,manifest,path):
+        """
+        Replace the manifest atomically, so an interrupted export never
+        leaves one that lists a part that wasn't written
+        """
+        fd,tmppath = tempfile.mkstemp(prefix='.manifest-',dir=self.directory)
+        out = os.fdopen(fd,'w')
+        try:
+            json.dump(manifest,out,indent=2,sort_keys=True,separators=(',',': '))
+            out.write('\n')
+        finally:
+            out.close()
+        os.rename(tmppath,path)
@@ -0,0 +1,569 @@
+'''
+Pipelined loading of sacct job reports into a Store.
+
+A pool of fetcher threads runs Slurm.getJobReports for different time
+windows, spaced out by a RateLimiter so that slurmdbd isn't overloaded.
+Fetched reports go onto a bounded queue that is drained by one or more
+writer threads, each with its own Store connection.
+
+Windows come from a planner.  FixedWindows hands out a precomputed list;
+AdaptiveWindows sizes each window from the job counts and sacct latency
+of the windows before it and splits windows that sacct fails on.
+
+One Loader can also load several clusters at once.  Each cluster has its
+own planner, fetchers and rate limiter, so a slow or failing slurmdbd only
+holds up its own cluster, while the writers, and the Store's pooled 
+engine, are shared.
+
+A Poller runs a Loader over whatever the watermark table is missing,
+over and over, to keep a long running Store near real time.
+'''
+import sys
+import time
+import datetime
+import threading
+import traceback
+import cProfile
+import Queue
+# strptime imports this on first use, which isn't thread safe; without it
+# a fetcher can parse a report's dates as None
+import _strptime
+from sqlalchemy.exc import DBAPIError
+from slyme import Slurm
+from slyme.util import ShError
+from slymedb.metrics import untimed
+
+
+def describe(cluster,window):
+    """
+    sacct options for a window of cluster (None for the Store's), for 
+    log messages
+    """
+    text = "--starttime %s, --endtime %s" % window
+    if cluster is not None:
+        text += ", --clusters %s" % cluster
+    return text
+
+
+def windows(start,end,size):
+    """
+    Generate (starttime,endtime) tuples of length size covering start to end.
+    The last window is clipped to end.
+    """
+    while start < end:
+        yield (start,min(start + size,end))
+        start = start + size
+
+
+class FixedWindows(object):
+    """
+    Planner for a fixed sequence of (starttime,endtime) windows
+    """
+    def __init__(self,windowlist):
+        self.windows = iter(windowlist)
+        self.lock = threading.Lock()
+
+    def next(self):
+        """
+        Next window to fetch, or None when there are no more
+        """
+        with self.lock:
+            return next(self.windows,None)
+
+    def done(self,window,jobs,seconds):
+        """
+        Called with the number of jobs and sacct seconds for a fetched window
+        """
+        pass
+
+    def split(self,window):
+        """
+        Replace a window that sacct failed on with smaller ones.  Returns 
+        False if the window won't be split.
+        """
+        return False
+
+
+class AdaptiveWindows(object):
+    """
+    Planner that covers a list of (starttime,endtime) ranges with windows
+    sized to return about targetjobs jobs in about targetseconds of sacct 
+    time.  The size starts at size, changes by at most a factor of two
+    per window and stays between minsize and maxsize.  A window that sacct
+    fails on is split in half unless it is already minsize.
+    """
+    def __init__(self,ranges,size=datetime.timedelta(days=1),
+                 minsize=datetime.timedelta(minutes=15),maxsize=datetime.timedelta(days=7),
+                 targetjobs=20000,targetseconds=120):
+        self.ranges = list(ranges)
+        self.pending = []
+        self.size = size
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.targetjobs = targetjobs
+        self.targetseconds = targetseconds
+        self.lock = threading.Lock()
+
+    def next(self):
+        """
+        Next window to fetch, or None when the ranges are covered.  Split 
+        windows are handed out first.
+        """
+        with self.lock:
+            if len(self.pending) > 0:
+                return self.pending.pop(0)
+            if len(self.ranges) == 0:
+                return None
+            start,end = self.ranges[0]
+            windowend = min(start + self.size,end)
+            if windowend >= end:
+                self.ranges.pop(0)
+            else:
+                self.ranges[0] = (windowend,end)
+            return (start,windowend)
+
+    def done(self,window,jobs,seconds):
+        """
+        Resize from the number of jobs and sacct seconds for a fetched window
+        """
+        scale = 2.0
+        if jobs > 0:
+            scale = min(scale,float(self.targetjobs) / jobs)
+        if seconds > 0:
+            scale = min(scale,float(self.targetseconds) / seconds)
+        scale = max(scale,0.5)
+        length = _seconds(window[1] - window[0])
+        size = datetime.timedelta(seconds=length * scale)
+        with self.lock:
+            self.size = max(self.minsize,min(self.maxsize,size))
+
+    def split(self,window):
+        """
+        Replace a window that sacct failed on with its two halves and shrink
+        the window size.  Returns False if the window is already minsize.
+        """
+        length = window[1] - window[0]
+        if length <= self.minsize:
+            return False
+        middle = window[0] + datetime.timedelta(seconds=_seconds(length) / 2)
+        with self.lock:
+            self.pending[0:0] = [(window[0],middle),(middle,window[1])]
+            self.size = max(self.minsize,min(self.size,middle - window[0]))
+        return True
+
+
+def _seconds(delta):
+    """
+    Total seconds in a timedelta
+    """
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls, across threads, so that no more than rate calls start
+    per minute.  A rate of None or 0 does not limit.
+    """
+    def __init__(self,rate):
+        if rate:
+            self.interval = 60.0 / rate
+        else:
+            self.interval = 0
+        self.lock = threading.Lock()
+        self.next = 0
+
+    def wait(self):
+        """
+        Block until the caller may start its call
+        """
+        with self.lock:
+            now = time.time()
+            start = max(now,self.next)
+            self.next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class Loader(object):
+    """
+    Loads the job reports for a series of sacct time windows into a Store,
+    overlapping sacct, parsing and database writes.
+    """
+    def __init__(self,store,sacctparams=None,fetchers=2,writers=1,queuedepth=4,
+                 rate=None,atomic=True,getjobreports=Slurm.getJobReports,log=sys.stderr,
+                 metrics=None,profile=False,clusters=None):
+        """
+        fetchers sacct calls run at once, starting no more than rate per minute.
+        At most queuedepth fetched windows wait for one of the writers.  If atomic
+        is True, each window is saved in a single transaction.
+
+        sacctparams are passed to getjobreports along with the window's
+        starttime and endtime.
+        
+        clusters is a dict of cluster names to dicts that may set that 
+        cluster's fetchers, rate and extra sacctparams, for loading several
+        clusters at once (see run).  Clusters not in it get fetchers and rate.
+        
+        metrics, which defaults to the Store's, is given the time spent 
+        waiting for the rate limiter, fetching (sacct and slyme parsing,
+        which are interleaved), waiting on the queue and saving, and the 
+        rows and seconds of each window.  If profile is True, each thread
+        runs under cProfile and the profiles are left in self.profiles.
+        """
+        self.store = store
+        self.sacctparams = sacctparams or {}
+        self.fetchers = fetchers
+        self.writers = writers
+        self.queue = Queue.Queue(maxsize=queuedepth)
+        self.rate = rate
+        self.ratelimiter = RateLimiter(rate)
+        self.clusters = clusters or {}
+        self.atomic = atomic
+        self.getjobreports = getjobreports
+        self.log = log
+        self.metrics = metrics
+        if metrics is None:
+            self.metrics = store.metrics
+        self.profile = profile
+        self.profiles = []
+
+        self.lock = threading.Lock()
+        self.counts = {'inserted' : 0, 'updated' : 0, 'unchanged' : 0, 'rejected' : 0}
+        self.failed = []
+        self.stopping = threading.Event()
+        self.livewriters = 0
+
+    def run(self,windows):
+        """
+        Load every window from the planner windows, or from a list of 
+        (starttime,endtime) tuples.  Each window is recorded in the Store's 
+        watermark table once it is saved.  Returns the combined save counts.
+        Windows that could not be fetched or saved are left in self.failed
+        as (cluster,window) pairs.
+        
+        To load several clusters at once, windows is a dict of cluster names
+        to planners or lists.  Each cluster's windows are fetched by its own
+        fetchers, with its own rate limiter and with clusters=<name> added 
+        to sacctparams, and saved by the shared writers with that Cluster 
+        and in that cluster's watermarks.  A None cluster is the Store's, 
+        with sacctparams as they are.
+        """
+        if not isinstance(windows,dict):
+            windows = {None : windows}
+        self.planners = {}
+        fetchers = []
+        for cluster,planner in sorted(windows.items()):
+            if not hasattr(planner,'split'):
+                planner = FixedWindows(planner)
+            self.planners[cluster] = planner
+            options = self.clusters.get(cluster,{})
+            params = dict(self.sacctparams)
+            ratelimiter = self.ratelimiter
+            if cluster is not None:
+                params['clusters'] = cluster
+                ratelimiter = RateLimiter(options.get('rate',self.rate))
+            params.update(options.get('sacctparams',{}))
+            source = (cluster,planner,params,ratelimiter)
+            fetchers += [threading.Thread(target=self._profiled,args=(self._fetcher,source))
+                         for i in range(options.get('fetchers',self.fetchers))]
+        writers = [threading.Thread(target=self._profiled,args=(self._writer,)) for i in range(self.writers)]
+        self.livewriters = len(writers)
+        for thread in fetchers + writers:
+            thread.daemon = True
+            thread.start()
+        # Join with a timeout so that the main thread still handles signals
+        for thread in fetchers:
+            while thread.is_alive():
+                thread.join(1)
+        for thread in writers:
+            self._put(None)
+        for thread in writers:
+            while thread.is_alive():
+                thread.join(1)
+        return self.counts
+
+    def stop(self):
+        """
+        Stop starting new windows.  Windows already being fetched are still
+        saved, so run returns soon after with the watermarks consistent.
+        """
+        self.stopping.set()
+
+    def _put(self,item):
+        """
+        Put item on the queue, waiting while it is full unless every writer
+        has exited.  False if it couldn't be queued.
+        """
+        while True:
+            try:
+                self.queue.put(item,timeout=1)
+                return True
+            except Queue.Full:
+                with self.lock:
+                    if self.livewriters == 0:
+                        return False
+
+    def _next(self,planner):
+        """
+        Next window from planner, or None once stopped
+        """
+        if self.stopping.is_set():
+            return None
+        return planner.next()
+
+    def fetch(self,window,params=None,ratelimiter=None):
+        """
+        List of job reports for a single window and the ShError that sacct
+        stopped with, if any.  params and ratelimiter default to the 
+        Loader's sacctparams and rate limiter.
+        """
+        if params is None:
+            params = self.sacctparams
+        if ratelimiter is None:
+            ratelimiter = self.ratelimiter
+        params = dict(params)
+        params['starttime'] = str(window[0])
+        params['endtime'] = str(window[1])
+        with self._timer('ratelimit'):
+            ratelimiter.wait()
+        self.log.write("%s\n" % describe(params.get('clusters'),window))
+        jrs = []
+        try:
+            for jr in self.getjobreports(**params):
+                jrs.append(jr)
+        except ShError, e:
+            return jrs,e
+        return jrs,None
+
+    def _timer(self,stage):
+        """
+        Context manager that times stage if there are metrics
+        """
+        if self.metrics is None:
+            return untimed()
+        return self.metrics.timer(stage)
+
+    def _count(self,counter):
+        if self.metrics is not None:
+            self.metrics.count(counter)
+
+    def _profiled(self,target,*args):
+        """
+        Run target with args, under cProfile if profile is set
+        """
+        if not self.profile:
+            target(*args)
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(target,*args)
+        finally:
+            with self.lock:
+                self.profiles.append(profiler)
+
+    def _fetcher(self,source):
+        cluster,planner,params,ratelimiter = source
+        window = self._next(planner)
+        while window is not None:
+            try:
+                start = time.time()
+                jrs,error = self.fetch(window,params,ratelimiter)
+                seconds = time.time() - start
+                if self.metrics is not None:
+                    self.metrics.add('fetch',seconds)
+                if error is not None:
+                    if planner.split(window):
+                        self.log.write("Splitting %s after sacct error %s\n" % (describe(cluster,window),error))
+                        self._count('split_windows')
+                        window = self._next(planner)
+                        continue
+                    # Keep what was read before the print.c:179 error, but
+                    # the rest of the window is missing
+                    if "print.c:179" not in str(error):
+                        raise error
+                planner.done(window,len(jrs),seconds)
+                with self._timer('queue_full'):
+                    queued = self._put((cluster,window,jrs,seconds,error is not None))
+                if not queued:
+                    raise RuntimeError("no writer is left to save it")
+            except Exception as e:
+                self.log.write("Error fetching %s: %s\n%s" % (describe(cluster,window),e,traceback.format_exc()))
+                self._count('failed_windows')
+                with self.lock:
+                    self.failed.append((cluster,window))
+            window = self._next(planner)
+
+    def _writerstore(self):
+        """
+        A clone of the Store for a writer, or None if it can't connect, in
+        which case no more windows are started
+        """
+        try:
+            store = self.store.clone()
+        except Exception as e:
+            self.log.write("Writer can't connect, stopping: %s\n%s" % (e,traceback.format_exc()))
+            self.stop()
+            return None
+        store.metrics = self.metrics
+        if self.metrics is not None:
+            self.metrics.watch(store.engine)
+        return store
+
+    def _writer(self):
+        """
+        Save windows from the queue until the None that ends the run.  
+        Windows that can't be saved, even for want of a connection, are 
+        added to failed, so the queue is always drained.
+        """
+        store = self._writerstore()
+        try:
+            with self._timer('queue_empty'):
+                item = self.queue.get()
+            while item is not None:
+                if store is None:
+                    store = self._writerstore()
+                self._save(store,item)
+                with self._timer('queue_empty'):
+                    item = self.queue.get()
+        finally:
+            with self.lock:
+                self.livewriters -= 1
+            if store is not None:
+                store.connection.close()
+
+    def _save(self,store,item):
+        """
+        Save one fetched window with a writer's store.  A window that sacct
+        stopped partway through is saved, but left out of the watermarks 
+        and added to failed, so it is fetched again.
+        """
+        cluster,window,jrs,fetchseconds,partial = item
+        try:
+            if store is None:
+                raise RuntimeError("the writer has no database connection")
+            start = time.time()
+            counts = store.save(jrs,atomic=self.atomic,window=None if partial else window,cluster=cluster)
+            seconds = time.time() - start
+            if self.metrics is not None:
+                self.metrics.add('save',seconds)
+                self.metrics.window(window,len(jrs),fetchseconds + seconds)
+                self.metrics.count('windows')
+            with self.lock:
+                for k,v in counts.items():
+                    self.counts[k] = self.counts.get(k,0) + v
+                total = self.counts['inserted'] + self.counts['updated']
+            self.log.write("Loaded %d job reports for %s, %d total\n" % (len(jrs),describe(cluster,window),total))
+            if partial:
+                self.log.write("sacct stopped early on %s; it is not marked as loaded\n" % describe(cluster,window))
+                self._count('failed_windows')
+                with self.lock:
+                    self.failed.append((cluster,window))
+        except Exception as e:
+            self.log.write("Error saving %s: %s\n%s" % (describe(cluster,window),e,traceback.format_exc()))
+            self._count('failed_windows')
+            with self.lock:
+                self.failed.append((cluster,window))
+
+
+# sacct states of jobs that have ended, the Poller's default state filter
+finishedstates = ('BOOT_FAIL','CANCELLED','COMPLETED','FAILED','NODE_FAIL','PREEMPTED','TIMEOUT')
+
+
+class Poller(object):
+    """
+    Keeps a Store near real time by loading, every interval seconds, the 
+    windows from start to lag seconds ago that aren't in the watermark 
+    table.  Runs until stop is called, e.g. from a signal handler.
+    """
+    def __init__(self,store,start,sacctparams=None,interval=300,lag=60,retrydelay=30,
+                 planner=None,loader=None,after=None,log=sys.stderr,now=datetime.datetime.now):
+        """
+        start may also be a dict of cluster names to starts, to keep 
+        several clusters loaded, each from its own watermarks (see 
+        Loader.run).  planner and loader are dicts of keyword arguments for
+        AdaptiveWindows and Loader.  after, if given, is called with the counts of each cycle,
+        or None if the cycle failed.  A cycle that fails, e.g. while the 
+        database fails over, is logged and tried again retrydelay seconds 
+        later with a new connection.
+        
+        A loaded window is not fetched again, so sacctparams without a 
+        state only fetch jobs in finishedstates; a job that is still 
+        running is loaded by the window it ends in.
+        """
+        self.store = store
+        self.start = start
+        self.sacctparams = dict(sacctparams or {})
+        self.sacctparams.setdefault('state',','.join(finishedstates))
+        self.interval = interval
+        self.lag = lag
+        self.retrydelay = retrydelay
+        self.planner = planner or {}
+        self.loader = loader or {}
+        self.after = after
+        self.log = log
+        self.now = now
+        self.stopping = threading.Event()
+        self.current = None
+        self.cycles = 0
+
+    def run(self):
+        """
+        Load cycles until stopped
+        """
+        while not self.stopping.is_set():
+            delay = self.interval
+            try:
+                counts = self.cycle()
+            except Exception as e:
+                self.log.write("Load cycle failed: %s\n%s" % (e,traceback.format_exc()))
+                counts = None
+                delay = self.retrydelay
+                if isinstance(e,DBAPIError) and e.connection_invalidated:
+                    self._reconnect()
+            if self.after is not None:
+                self.after(counts)
+            self.stopping.wait(delay)
+        self.log.write("Stopped after %d load cycles\n" % self.cycles)
+
+    def cycle(self):
+        """
+        Load every window that is missing up to now less lag and return
+        the Loader's counts
+        """
+        end = self.now() - datetime.timedelta(seconds=self.lag)
+        starts = self.start
+        if not isinstance(starts,dict):
+            starts = {None : starts}
+        planners = {}
+        first = end
+        for cluster,start in starts.items():
+            ranges = self.store.gaps(start,end,cluster)
+            if len(ranges) > 0:
+                planners[cluster] = AdaptiveWindows(ranges,**self.planner)
+                first = min(first,ranges[0][0])
+        self.cycles += 1
+        if len(planners) == 0:
+            return {'inserted' : 0, 'updated' : 0}
+        self.store.ensurepartitions(first,end)
+        self.current = Loader(self.store,self.sacctparams,log=self.log,**self.loader)
+        if self.stopping.is_set():
+            self.current.stop()
+        counts = self.current.run(planners)
+        for cluster,window in self.current.failed:
+            self.log.write("Failed to load %s\n" % describe(cluster,window))
+        self.store.compactwatermarks()
+        return counts
+
+    def stop(self):
+        """
+        Finish the windows in progress and return from run
+        """
+        self.stopping.set()
+        if self.current is not None:
+            self.current.stop()
+
+    def _reconnect(self):
+        try:
+            self.store.reconnect()
+        except Exception as e:
+            self.log.write("Unable to reconnect: %s\n" % e)
@@ -0,0 +1,214 @@
+'''
+Timers, counters and histograms for a load.
+
+A Metrics object is shared by a Store, its clones and a Loader.  Stages
+are timed with the timer context manager (or add for time measured
+elsewhere), so a slow run can be broken down into sacct, value dict,
+database and rate limiting time.  At the end of a run the summary can be
+written as JSON or as a Prometheus textfile for node_exporter.
+'''
+import os
+import time
+import json
+import heapq
+import tempfile
+import threading
+from contextlib import contextmanager
+from sqlalchemy import event
+
+
+@contextmanager
+def untimed():
+    """
+    Stand-in for Metrics.timer when there are no metrics
+    """
+    yield
+
+
+class Histogram(object):
+    """
+    Cumulative bucket counts, sum and count of observed values, like a
+    Prometheus histogram
+    """
+    def __init__(self,buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self,value):
+        self.sum += value
+        self.count += 1
+        for i,le in enumerate(self.buckets):
+            if value <= le:
+                self.counts[i] += 1
+
+    def asdict(self):
+        return {'buckets' : [[le,n] for le,n in zip(self.buckets,self.counts)],
+                'sum' : self.sum, 'count' : self.count}
+
+
+class Metrics(object):
+    """
+    Thread safe stage timers, counters, histograms and the slowest windows
+    """
+    # Default buckets, in seconds or rows
+    latencybuckets = (0.001,0.005,0.01,0.05,0.1,0.5,1,5,10,60)
+    rowbuckets = (0,10,100,1000,10000,100000,1000000)
+
+    def __init__(self,slowest=10):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.histograms = {}
+        self.slowest = slowest
+        self.windows = []
+        self.engines = set()
+
+    @contextmanager
+    def timer(self,stage):
+        """
+        Add the time spent in the with block to stage
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage,time.time() - start)
+
+    def add(self,stage,seconds,calls=1):
+        """
+        Add seconds and calls to stage
+        """
+        with self.lock:
+            total = self.stages.setdefault(stage,[0.0,0])
+            total[0] += seconds
+            total[1] += calls
+
+    def iterate(self,iterable,stage):
+        """
+        Generate the items of iterable, adding the time spent getting each
+        one to stage, e.g. the sacct and parsing time of getJobReports
+        """
+        seconds = 0.0
+        n = 0
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    seconds += time.time() - start
+                n += 1
+                yield item
+        finally:
+            self.add(stage,seconds,n)
+
+    def count(self,counter,n=1):
+        """
+        Add n to counter
+        """
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter,0) + n
+
+    def observe(self,name,value,buckets=None):
+        """
+        Add a value to the histogram name, created with buckets (default
+        latencybuckets) the first time
+        """
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(buckets or self.latencybuckets)
+            self.histograms[name].observe(value)
+
+    def window(self,window,rows,seconds):
+        """
+        Record a loaded window, keeping the slowest ones
+        """
+        self.observe('rows_per_window',rows,self.rowbuckets)
+        with self.lock:
+            item = (seconds,str(window[0]),str(window[1]),rows)
+            if len(self.windows) < self.slowest:
+                heapq.heappush(self.windows,item)
+            else:
+                heapq.heappushpop(self.windows,item)
+
+    def watch(self,engine):
+        """
+        Time every statement engine executes as the database stage
+        """
+        if engine in self.engines:
+            return
+        self.engines.add(engine)
+        def before(conn,cursor,statement,parameters,context,executemany):
+            conn.info.setdefault('metrics_start',[]).append(time.time())
+        def after(conn,cursor,statement,parameters,context,executemany):
+            self.add('database',time.time() - conn.info['metrics_start'].pop())
+            self.count('statements')
+        event.listen(engine,'before_cursor_execute',before)
+        event.listen(engine,'after_cursor_execute',after)
+
+    def summary(self):
+        """
+        Dict of everything recorded, with the wall clock seconds so far
+        """
+        with self.lock:
+            return {
+                'seconds' : time.time() - self.started,
+                'stages' : dict((k,{'seconds' : v[0], 'calls' : v[1]}) for k,v in self.stages.items()),
+                'counters' : dict(self.counters),
+                'histograms' : dict((k,h.asdict()) for k,h in self.histograms.items()),
+                'slowest_windows' : [{'starttime' : w[1], 'endtime' : w[2], 'rows' : w[3], 'seconds' : w[0]}
+                                     for w in sorted(self.windows,reverse=True)],
+            }
+
+    def writejson(self,path):
+        """
+        Write the summary to path as JSON
+        """
+        self._write(path,json.dumps(self.summary(),indent=2,sort_keys=True,separators=(',',': ')) + '\n')
+
+    def writeprometheus(self,path,prefix='slymedb'):
+        """
+        Write the summary to path in the Prometheus text format, replacing
+        the file atomically as the node_exporter textfile collector expects
+        """
+        summary = self.summary()
+        lines = []
+        def metric(name,kind,help,samples):
+            lines.append('# HELP %s_%s %s' % (prefix,name,help))
+            lines.append('# TYPE %s_%s %s' % (prefix,name,kind))
+            for suffix,labels,value in samples:
+                label = ''
+                if labels:
+                    label = '{%s}' % ','.join('%s="%s"' % kv for kv in labels)
+                lines.append('%s_%s%s%s %r' % (prefix,name,suffix,label,float(value)))
+
+        stages = sorted(summary['stages'].items())
+        metric('stage_seconds_total','counter','Seconds spent in each load stage',
+               [('',[('stage',k)],v['seconds']) for k,v in stages])
+        metric('stage_calls_total','counter','Number of times each load stage ran',
+               [('',[('stage',k)],v['calls']) for k,v in stages])
+        for name,value in sorted(summary['counters'].items()):
+            metric('%s_total' % name,'counter','Number of %s' % name.replace('_',' '),[('',[],value)])
+        for name,h in sorted(summary['histograms'].items()):
+            samples = [('_bucket',[('le',repr(float(le)))],n) for le,n in h['buckets']]
+            samples += [('_bucket',[('le','+Inf')],h['count']),('_sum',[],h['sum']),('_count',[],h['count'])]
+            metric(name,'histogram','Distribution of %s' % name.replace('_',' '),samples)
+        metric('run_seconds','gauge','Wall clock seconds of the last run',[('',[],summary['seconds'])])
+        metric('last_run_timestamp_seconds','gauge','When the last run finished',[('',[],time.time())])
+        self._write(path,'\n'.join(lines) + '\n')
+
+    def _write(self,path,text):
+        fd,tmppath = tempfile.mkstemp(prefix='.metrics-',dir=os.path.dirname(os.path.abspath(path)))
+        out = os.fdopen(fd,'w')
+        try:
+            out.write(text)
+        finally:
+            out.close()
+        os.chmod(tmppath,0644)
+        os.rename(tmppath,path)
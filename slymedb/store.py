@@ -3,11 +3,108 @@ Created on May 19, 2014
 
 @author: aaronkitzmiller
 '''
+import os
 import re
-from sqlalchemy.engine import create_engine
-from sqlalchemy import MetaData, Column, Table, types
+import sys
+import gzip
+import hashlib
+import shutil
+import sqlite3
+import tempfile
+import datetime
+import time
+import operator
+import threading
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from sqlalchemy.engine import create_engine, Engine
+from sqlalchemy import MetaData, Column, Table, Index, UniqueConstraint, types, select, text, bindparam, \
+    and_, or_, func, union_all, inspect
 from sqlalchemy.dialects import mysql
+from sqlalchemy.exc import OperationalError, IntegrityError
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateColumn
+from slymedb.metrics import untimed
+
+
+class Unreadable(object):
+    """
+    Stands in for a JobReport value that raised when it was read, e.g. a 
+    MaxRSS of 16?, so that the row is rejected instead of the whole load
+    """
+    def __init__(self,error):
+        self.error = error
+    
+    def __str__(self):
+        return 'Unreadable(%s)' % self.error
+
+
+def readvalues(jobreport,names):
+    """
+    Dict of the named values of a JobReport.  A value that raises when it
+    is read is an Unreadable.
+    """
+    try:
+        return { name:jobreport[name] for name in names }
+    except Exception:
+        row = {}
+        for name in names:
+            try:
+                row[name] = jobreport[name]
+            except Exception as e:
+                row[name] = Unreadable(repr(e))
+        return row
+
+
+# LOAD DATA escapes for the default ESCAPED BY '\\'
+stageescapes = [('\\','\\\\'),('\t','\\t'),('\n','\\n'),('\r','\\r'),('\0','\\0')]
+
+
+def stagevalue(value):
+    """
+    Text for a single value in a LOAD DATA file, and in a fingerprint
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value,datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value,float):
+        return repr(value)
+    if isinstance(value,unicode):
+        value = value.encode('utf-8')
+    value = str(value)
+    for char,escape in stageescapes:
+        value = value.replace(char,escape)
+    return value
+
+
+def fingerprintvalues(row,names):
+    """
+    md5 of the named values of a value dict.  Needs no Store, so dump 
+    parsing processes can fingerprint the rows they read.
+    """
+    return hashlib.md5('\t'.join(stagevalue(row[name]) for name in names)).hexdigest()
+
+
+def _tostring(value):
+    return str(value)
+
+def _tointeger(value):
+    if isinstance(value,float):
+        if value != int(value):
+            raise ValueError("%r is not a whole number" % value)
+        return int(value)
+    return int(value)
+
+def _todatetime(value):
+    if not isinstance(value,basestring):
+        raise TypeError("%r is not a date" % value)
+    for format in ('%Y-%m-%d %H:%M:%S','%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value,format)
+        except ValueError:
+            pass
+    raise ValueError("%r is not a date" % value)
 
 
 class Store(object):
@@ -16,20 +113,86 @@ class Store(object):
     persistence operations
     """
     
-    def __init__(self,connectstring):
+    def __init__(self,connectstring,batchsize=1000,batchbytes=None,retries=2,rollups=True,
+                 partitioned=None,compact=False,dedupebytes=None,metrics=None,cluster=''):
         """
         Create the engine and connection.  Define the jobreport table
+
+        batchsize is the number of job reports sent to the database in a 
+        single executemany when the dialect supports a native upsert.  If
+        batchbytes is set, a batch is also closed once its approximate 
+        size reaches that many bytes.  Each batch is committed in its own
+        transaction, which is rolled back and retried up to retries times
+        if the database reports an operational error.
+        
+        connectstring may also be an existing Engine, so that several Stores
+        (e.g. one per writer thread) share its connection pool.
+        
+        If rollups is True, the daily and monthly rollup tables are updated
+        in the same transaction as each batch of job reports.  So that two
+        writers can't both count a job as new, Stores that share an engine
+        through clone then write one transaction at a time.  On MySQL they
+        don't take turns; the stored rows are read with SELECT ... FOR 
+        UPDATE instead, so only writers of the same jobs wait for each 
+        other.
+        
+        If partitioned is 'Start' or 'End', job reports are stored in monthly
+        ranges of that column: native RANGE partitions on MySQL, and 
+        jobreport_pYYYYMM tables behind a jobreport view elsewhere.  Rows 
+        without a value go in the pnull partition.  The (Cluster, JobID) 
+        unique key becomes (Cluster, JobID, partitioned) on MySQL, which 
+        requires it.
+        
+        If compact is True, the dictcolumns are stored as integer ids into
+        lookup_<column> tables, in a jobreport_compact table, and jobreport
+        is a view that joins them back into the usual shape.  A compact
+        Store can't also be partitioned.
+        
+        If dedupebytes is set, save and bulksave pass job reports through 
+        dedupe with a buffer of about that many bytes, so a job that is 
+        repeated in the stream is only written once.
+        
+        metrics is an optional slymedb.metrics.Metrics that is given the 
+        time spent building value dicts, preparing, writing and in the 
+        database, commit latencies and the save counts.
+        
+        Job reports are keyed on (Cluster, JobID), so several clusters can 
+        share the tables.  cluster is the Cluster value given to job reports
+        that don't have one, and the watermarks used by default; the empty 
+        default suits a database of a single cluster.
         """       
+        if partitioned not in (None,'Start','End'):
+            raise ValueError("Store can only be partitioned on Start or End, not %s" % partitioned)
+        if compact and partitioned is not None:
+            raise ValueError("A compact Store can't be partitioned")
+        self.batchsize = batchsize
+        self.compact = compact
+        self.dedupebytes = dedupebytes
+        self.metrics = metrics
+        self.rollups = rollups
+        self.partitioned = partitioned
+        self.cluster = cluster
+        self.batchbytes = batchbytes
+        self.retries = retries
+        self.retrydelay = 1
+        self._intransaction = False
+        self._writelock = threading.RLock()
         # configure Session class with desired options
-        self.engine = create_engine(connectstring)
+        if isinstance(connectstring,Engine):
+            self.engine = connectstring
+        else:
+            self.engine = create_engine(connectstring)
         Session = sessionmaker(bind=self.engine)
 
         # work with the session
         self.session = Session()
         self.metadata = MetaData()
         
+        # Columns that identify a job report for upserts
+        self.keycolumns = ('Cluster','JobID')
+        
         self.jobreport_table = Table('jobreport', self.metadata, 
-            Column('JobID',      types.String(20), nullable=False, unique=True),
+            Column('JobID',      types.String(20), nullable=False),
             Column('User',       types.String(50)),
             Column('JobName',    types.String(255)),
             Column('State',      types.String(20)),
@@ -56,79 +219,1990 @@ class Store(object):
             Column('Mem_Wasted', types.Integer),
             Column('MaxVMSize_MB',  types.BigInteger),
             Column('AveVMSize_MB',  types.BigInteger),
+            Column('Cluster',    types.String(50), nullable=False, server_default=''),
+            # Fingerprint of the other columns, so unchanged reports aren't rewritten
+            Column(self.hashcolumn, types.String(32)),
         )
+        self.contentcolumns = [c.name for c in self.jobreport_table.columns if c.name != self.hashcolumn]
+        # Columns read from a JobReport, and fingerprinted; Cluster comes from the load
+        self.reportcolumns = [name for name in self.contentcolumns if name != 'Cluster']
+        self._checks = self._columnchecks()
+        
+        key = self.keycolumns
+        if partitioned is not None:
+            key += (partitioned,)
+        self.jobreport_table.append_constraint(UniqueConstraint(*key,name='uq_jobreport_key'))
+        
+        # Indexes for --since-last-entry and per user / partition / date reports
+        jr = self.jobreport_table.c
+        Index('ix_jobreport_Start', jr.Start)
+        Index('ix_jobreport_End', jr.End)
+        Index('ix_jobreport_User', jr.User)
+        Index('ix_jobreport_Partition', jr.Partition)
+        Index('ix_jobreport_State', jr.State)
+        Index('ix_jobreport_User_Start', jr.User, jr.Start)
+        Index('ix_jobreport_Partition_Start', jr.Partition, jr.Start)
         
+        # Lookup tables and the table of ids behind a compact jobreport view
+        self.lookup_tables = {}
+        self.compact_table = None
+        if compact:
+            self._compacttables()
+        self._ids = dict((name,{}) for name in self.dictcolumns)
+        
+        # Job reports that failed validation, as text, with the reason codes
         self.rejected_table = Table('rejected', self.metadata, 
-            Column('JobID',      types.String(20), nullable=False, unique=True),
-            Column('User',       types.String(50)),
-            Column('JobName',    types.String(255)),
-            Column('State',      types.String(20)),
-            Column('Partition',  types.String(255)),
-            Column('NCPUS',      types.Integer),
-            Column('NNodes',     types.Integer),
-            Column('CPUTime',    types.Float),
-            Column('TotalCPU',   types.Float),
-            Column('UserCPU',    types.Float),
-            Column('SystemCPU',  types.Float),
-            Column('MaxRSS_kB',  types.BigInteger),
-            Column('MaxRSS_MB',  types.BigInteger),
-            Column('ReqMem_bytes_per_node',  types.BigInteger),
-            Column('ReqMem_bytes_per_core',  types.BigInteger),
-            Column('ReqMem_bytes',           types.BigInteger),
-            Column('ReqMem_MB_total',           types.BigInteger),
-            Column('Start',      types.DateTime),
-            Column('End',        types.DateTime),
-            Column('NodeList',   types.String(255)),
-            Column('ReqMem_bytes_total',     types.BigInteger),
-            Column('CPU_Efficiency',         types.Float),
-            Column('CPU_Wasted', types.Float),
-            Column('CancelledBy',types.String(20)),
-            Column('Mem_Wasted', types.Integer),
-            Column('MaxVMSize_MB',  types.BigInteger),
-            Column('AveVMSize_MB',  types.BigInteger),
+            Column('id',         types.Integer, primary_key=True),
+            *([Column(name, types.Text) for name in self.contentcolumns] + [
+            Column('Reason',     types.String(255)),
+            Column('Rejected',   types.DateTime)])
+        )
+        Index('ix_rejected_JobID', self.rejected_table.c.JobID, mysql_length=20)
+        
+        # sacct time windows that have been completely loaded
+        self.watermark_table = Table('watermark', self.metadata,
+            Column('Cluster',     types.String(50), nullable=False, server_default=''),
+            Column('WindowStart', types.DateTime, nullable=False, index=True),
+            Column('WindowEnd',   types.DateTime, nullable=False),
+            Column('Jobs',        types.Integer),
+            Column('Loaded',      types.DateTime),
         )
         
+        # Per cluster, user and partition sums by day and by month of End (or Start,
+        # for jobs without an End).  CPU efficiency is TotalCPU / CPUTime.
+        self.daily_table = Table('jobreport_daily', self.metadata, *self._rollupcolumns('Day'))
+        self.monthly_table = Table('jobreport_monthly', self.metadata, *self._rollupcolumns('Month'))
+        
+        # Per month tables for partitioned stores without native partitioning
+        self.partitionmetadata = MetaData()
+        self._partitioncache = None
+        self._recordclasses = {}
+        
         self.metadata.bind = self.engine
         self.connection = self.engine.connect()
+        if metrics is not None:
+            metrics.watch(self.engine)
+        
+    def clone(self):
+        """
+        A new Store with the same settings sharing this Store's engine, but
+        with its own connection.  Use one per thread.
+        """
+        store = Store(self.engine,batchsize=self.batchsize,batchbytes=self.batchbytes,
+                      retries=self.retries,rollups=self.rollups,partitioned=self.partitioned,
+                      compact=self.compact,dedupebytes=self.dedupebytes,metrics=self.metrics,
+                      cluster=self.cluster)
+        store._ids = self._ids
+        store._writelock = self._writelock
+        return store
+    
+    # jobreport column with the md5 of a report's other column values
+    hashcolumn = 'RowHash'
+    
+    # String columns stored as lookup table ids by a compact Store
+    dictcolumns = ('User','Partition','State','CancelledBy','JobName','NodeList')
+    
+    # Values cached per dictcolumn before the cache is cleared
+    idcachesize = 100000
+    
+    # Python types each kind of column takes as is, and the conversion 
+    # tried on other values
+    validtypes = {
+        'string'   : (str,unicode),
+        'integer'  : (int,long),
+        'float'    : (float,int,long),
+        'datetime' : (datetime.datetime,),
+    }
+    converters = {
+        'string'   : _tostring,
+        'integer'  : _tointeger,
+        'float'    : float,
+        'datetime' : _todatetime,
+    }
+    
+    # Earliest DateTime MySQL accepts
+    mindatetime = datetime.datetime(1000,1,1)
+    
+    def _compacttables(self):
+        """
+        Define a lookup_<column> table for each of the dictcolumns and the
+        jobreport_compact table with <column>_id in their place
+        """
+        columns = []
+        for c in self.jobreport_table.columns:
+            if c.name in self.dictcolumns:
+                # Binary on MySQL so that values differing only in case get their own ids
+                valuetype = c.type.with_variant(mysql.VARCHAR(c.type.length,binary=True),'mysql')
+                self.lookup_tables[c.name] = Table('lookup_%s' % c.name.lower(), self.metadata,
+                    Column('id',    types.Integer, primary_key=True),
+                    Column('value', valuetype, nullable=False, unique=True),
+                )
+                columns.append(Column(c.name + '_id', types.Integer))
+            else:
+                columns.append(c.copy())
+        self.compact_table = Table('jobreport_compact', self.metadata, 
+            *(columns + [UniqueConstraint(*self.keycolumns,name='uq_jobreport_compact_key')]))
+        
+        name = self.jobreport_table.name
+        for ix in self.jobreport_table.indexes:
+            cols = [self.compact_table.c[self._compactname(c.name)] for c in ix.columns]
+            Index(ix.name.replace(name,self.compact_table.name,1),*cols)
+    
+    def _compactname(self,name):
+        """
+        Name of the jobreport_compact column for a jobreport column
+        """
+        if name in self.dictcolumns:
+            return name + '_id'
+        return name
+    
+    # Columns summed into the rollup tables
+    rollupsums = ('CPUTime','TotalCPU','CPU_Wasted','Mem_Wasted')
+    
+    # Columns that group the rollup tables, besides the date
+    rollupgroups = ('Cluster','User','Partition')
+    
+    def _rollupcolumns(self,period):
+        """
+        Columns for a rollup table keyed on the period date column
+        """
+        return [
+            Column(period,       types.Date, nullable=False),
+            Column('Cluster',    types.String(50), nullable=False, default=''),
+            Column('User',       types.String(50), nullable=False, default=''),
+            Column('Partition',  types.String(255), nullable=False, default=''),
+            Column('Jobs',       types.Integer, nullable=False, default=0),
+            Column('CPUTime',    types.Float, nullable=False, default=0),
+            Column('TotalCPU',   types.Float, nullable=False, default=0),
+            Column('CPU_Wasted', types.Float, nullable=False, default=0),
+            Column('Mem_Wasted', types.BigInteger, nullable=False, default=0),
+            UniqueConstraint(period,'Cluster','User','Partition'),
+        ]
         
     def create(self):
         """
         Actually creates the database tables.  Be careful
         """
-        self.metadata.create_all(checkfirst=True)
+        if self._isview():
+            tables = [t for t in self.metadata.sorted_tables if t is not self.jobreport_table]
+            self.metadata.create_all(tables=tables,checkfirst=True)
+            if self._viewlayout():
+                self._partitiontable('pnull').create(bind=self.engine,checkfirst=True)
+            self._createview()
+        else:
+            self.metadata.create_all(checkfirst=True)
+            if self.partitioned is not None and len(self.partitions()) == 0:
+                self._partitionmysql()
+        
+    def migrate(self):
+        """
+        Bring an existing database up to the current table definitions.
+        Missing tables are created and missing indexes are added to tables
+        that already exist.  An existing jobreport table is converted to
+        the partitioned layout if the Store is partitioned, or to the 
+        compact layout if it is compact.  An empty rejected table from
+        before rejected rows were stored as text is replaced.  Tables keyed
+        on JobID alone are rekeyed on (Cluster, JobID), the job reports, 
+        watermarks and rejected rows from before the Cluster column are 
+        given the Store's cluster, and the rollups are rebuilt.  Safe to 
+        run repeatedly.
+        """
+        inspector = inspect(self.engine)
+        precluster = self._precluster(inspector)
+        if self._isview() and self.jobreport_table.name in inspector.get_table_names():
+            if self.compact:
+                self._compacttable()
+            else:
+                self._partitiontables()
+        self._rejectedtable(inspector)
+        rebuild = self._rolluptables(inspector)
+        
+        # Columns first, since the view needs them
+        inspector = inspect(self.engine)
+        tables = self.metadata.sorted_tables
+        if self._isview():
+            tables = [t for t in tables if t is not self.jobreport_table] + \
+                [self._partitiontable(name) for name in self.partitions()]
+        names = inspector.get_table_names()
+        for table in tables:
+            if table.name in names:
+                self._addcolumns(inspector,table)
+        for table in tables:
+            if table.name in names:
+                self._rekey(table)
+        if precluster:
+            self._assigncluster([t for t in tables if t.name in names])
+            rebuild = True
+        self.create()
+        
+        inspector = inspect(self.engine)
+        for table in tables:
+            existing = set(ix['name'] for ix in inspector.get_indexes(table.name))
+            missing = [ix for ix in table.indexes if ix.name not in existing]
+            if len(missing) == 0:
+                continue
+            if self.engine.dialect.name == 'mysql':
+                # One ALTER so the table is only rebuilt once
+                quote = self.engine.dialect.identifier_preparer.quote
+                adds = ['ADD INDEX %s (%s)' % (quote(ix.name),', '.join(quote(c.name) for c in ix.columns))
+                        for ix in missing]
+                self.engine.execute('ALTER TABLE %s %s' % (quote(table.name),', '.join(adds)))
+            else:
+                for ix in missing:
+                    ix.create(bind=self.engine)
+        if rebuild:
+            self.rebuildrollups()
+        
+    def _rejectedtable(self,inspector):
+        """
+        Drop a rejected table with the old typed columns so that create 
+        makes the text one.  It was never written by the Store, so one 
+        that has rows is left for the administrator.
+        """
+        table = self.rejected_table
+        if table.name not in inspector.get_table_names():
+            return
+        if 'Reason' in set(c['name'] for c in inspector.get_columns(table.name)):
+            return
+        quote = self.engine.dialect.identifier_preparer.quote
+        if self.engine.execute('SELECT COUNT(*) FROM %s' % quote(table.name)).scalar() > 0:
+            raise ValueError("The rejected table has rows but not the Reason column; rename it and migrate again")
+        self.engine.execute('DROP TABLE %s' % quote(table.name))
+    
+    def _precluster(self,inspector):
+        """
+        True if the database has job report or watermark tables from 
+        before the Cluster column
+        """
+        names = set(inspector.get_table_names())
+        tables = [self.jobreport_table.name,self.watermark_table.name]
+        if self.compact:
+            tables.append(self.compact_table.name)
+        if self._viewlayout():
+            tables += [self._partitiontable(name).name for name in self.partitions()]
+        for name in tables:
+            if name in names and 'Cluster' not in set(c['name'] for c in inspector.get_columns(name)):
+                return True
+        return False
+    
+    def _assigncluster(self,tables):
+        """
+        Give the rows of tables that have no cluster, since they are from
+        before the Cluster column, the Store's cluster.  The rollups are 
+        rebuilt instead.
+        """
+        for table in tables:
+            if 'Cluster' not in table.c or table in (self.daily_table,self.monthly_table):
+                continue
+            self.connection.execute(table.update().where(or_(table.c.Cluster == None,table.c.Cluster == ''))
+                                    .values(Cluster=self.cluster))
+    
+    def _rolluptables(self,inspector):
+        """
+        Drop rollup tables that don't have every rollupgroups column, so
+        that create makes them again.  True if migrate should rebuild them.
+        """
+        names = inspector.get_table_names()
+        dropped = False
+        for table in (self.daily_table,self.monthly_table):
+            if table.name not in names:
+                continue
+            existing = set(c['name'] for c in inspector.get_columns(table.name))
+            if not existing.issuperset(self.rollupgroups):
+                table.drop(bind=self.engine)
+                dropped = True
+        return dropped
+    
+    def _rekey(self,table):
+        """
+        Replace the unique keys of table that lack any of the columns of 
+        table's (Cluster, JobID...) key, e.g. one on JobID alone, with that
+        key.  MySQL changes the keys in place.  SQLite can't drop a UNIQUE 
+        constraint, so elsewhere the table is copied into a new one.
+        """
+        keys = [c for c in table.constraints if isinstance(c,UniqueConstraint) and 'Cluster' in c.columns]
+        if len(keys) == 0:
+            return
+        key = keys[0]
+        columns = key.columns.keys()
+        uniques = self._uniquekeys(inspect(self.connection),table.name)
+        quote = self.engine.dialect.identifier_preparer.quote
+        if self.engine.dialect.name == 'mysql':
+            sql = self._rekeysql(table.name,uniques,columns,key.name or 'uq_%s_key' % table.name,quote)
+            if sql is not None:
+                self.connection.execute(sql)
+            return
+        if all(set(columns).issubset(cols) for name,cols in uniques):
+            return
         
+        if self._isview():
+            # create makes the view again
+            self.connection.execute('DROP VIEW IF EXISTS %s' % quote(self.jobreport_table.name))
+        copy = Table(table.name + '_rekey',MetaData(),*[Column(c.name,c.type) for c in table.columns])
+        self.connection.execute('ALTER TABLE %s RENAME TO %s' % (quote(table.name),quote(copy.name)))
+        for ix in inspect(self.connection).get_indexes(copy.name):
+            self.connection.execute('DROP INDEX %s' % quote(ix['name']))
+        table.create(bind=self.connection)
+        names = [c.name for c in table.columns]
+        self.connection.execute(table.insert().from_select(names,select([copy.c[n] for n in names])))
+        copy.drop(bind=self.connection)
+    
+    def _uniquekeys(self,inspector,name):
+        """
+        (name, columns) of the unique indexes of table name, and of its 
+        unique constraints on backends that list them separately
+        """
+        uniques = [(ix['name'],ix['column_names']) for ix in inspector.get_indexes(name) if ix.get('unique')]
+        if self.engine.dialect.name != 'mysql':
+            uniques += [(uc['name'],uc['column_names']) for uc in inspector.get_unique_constraints(name)]
+        return uniques
+    
+    def _rekeysql(self,tablename,uniques,columns,keyname,quote):
+        """
+        MySQL ALTER TABLE that drops the keys of uniques, a list of (name,
+        columns), that lack any of columns and adds a keyname unique key on
+        columns, or None if no key needs to be dropped
+        """
+        stale = [name for name,cols in uniques if not set(columns).issubset(cols)]
+        if len(stale) == 0:
+            return None
+        alters = ['DROP INDEX %s' % quote(name) for name in stale]
+        if not any(list(cols) == list(columns) for name,cols in uniques if name not in stale):
+            alters.append('ADD UNIQUE KEY %s (%s)' % (quote(keyname),', '.join(quote(c) for c in columns)))
+        return 'ALTER TABLE %s %s' % (quote(tablename),', '.join(alters))
+    
+    def _addcolumns(self,inspector,table):
+        """
+        Add the columns of table that the database table doesn't have.  New
+        columns are empty (NULL, or the server default).
+        """
+        existing = set(c['name'] for c in inspector.get_columns(table.name))
+        missing = [c for c in table.columns if c.name not in existing]
+        if len(missing) == 0:
+            return
+        quote = self.engine.dialect.identifier_preparer.quote
+        adds = ['ADD COLUMN %s' % CreateColumn(c).compile(dialect=self.engine.dialect) for c in missing]
+        if self.engine.dialect.name == 'mysql':
+            self.engine.execute('ALTER TABLE %s %s' % (quote(table.name),', '.join(adds)))
+        else:
+            for add in adds:
+                self.engine.execute('ALTER TABLE %s %s' % (quote(table.name),add))
+    
     def drop(self):
         """
-        Drop the database table
+        Drop the database table.  jobreport is dropped whether it is a view
+        or a table, so a Store can drop one made with other settings.
+        """
+        for ids in self._ids.values():
+            ids.clear()
+        quote = self.engine.dialect.identifier_preparer.quote
+        inspector = inspect(self.connection)
+        name = self.jobreport_table.name
+        if name in inspector.get_view_names():
+            self.connection.execute('DROP VIEW %s' % quote(name))
+        elif name in inspector.get_table_names():
+            self.connection.execute('DROP TABLE %s' % quote(name))
+        if self._viewlayout():
+            for name in self.partitions():
+                self._partitiontable(name).drop(bind=self.engine,checkfirst=True)
+        tables = [t for t in self.metadata.sorted_tables if t is not self.jobreport_table]
+        self.metadata.drop_all(tables=tables,checkfirst=True)
+    
+    def _isview(self):
+        """
+        True if jobreport is a view over the compact or per month tables
+        """
+        return self.compact or self._viewlayout()
+    
+    def _viewlayout(self):
+        """
+        True if partitions are separate tables behind a jobreport view
+        """
+        return self.partitioned is not None and self.engine.dialect.name != 'mysql'
+    
+    def _partitionname(self,when):
+        """
+        Name of the monthly partition for a Start or End value
+        """
+        if when is None:
+            return 'pnull'
+        return 'p%04d%02d' % (when.year,when.month)
+    
+    def _months(self,starttime,endtime):
+        """
+        First days of the months from starttime to endtime, inclusive
+        """
+        month = datetime.datetime(starttime.year,starttime.month,1)
+        while month <= endtime:
+            yield month
+            month = (month + datetime.timedelta(days=32)).replace(day=1)
+    
+    def partitions(self):
+        """
+        Sorted names of the existing monthly partitions, with pnull first
+        """
+        if self._viewlayout():
+            prefix = self.jobreport_table.name + '_'
+            tablere = re.compile(r'^%sp(\d{6}|null)$' % prefix)
+            names = [t[len(prefix):] for t in inspect(self.connection).get_table_names() if tablere.match(t)]
+        elif self.partitioned is not None:
+            result = self.connection.execute(text(
+                "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name AND PARTITION_NAME IS NOT NULL"),
+                name=self.jobreport_table.name)
+            names = [r[0] for r in result if r[0] != 'pfuture']
+        else:
+            return []
+        self._partitioncache = set(names)
+        return sorted(names,key=lambda n: (n != 'pnull',n))
+    
+    def ensurepartitions(self,starttime,endtime):
+        """
+        Create the monthly partitions from starttime to endtime that don't
+        exist yet.  Each batch calls this for its own months before it is
+        written; on MySQL, a row for a month without a partition would go in
+        the first partition after it, or pfuture.
+        """
+        if self.partitioned is None:
+            return
+        names = [self._partitionname(m) for m in self._months(starttime,endtime)]
+        if self._partitioncache is not None and self._partitioncache.issuperset(names):
+            return
+        # Writers sharing the engine would otherwise add the same partition
+        with self._writelock:
+            existing = set(self.partitions())
+            missing = [name for name in names if name not in existing]
+            if len(missing) == 0:
+                return
+            if self._viewlayout():
+                for name in missing:
+                    self._partitiontable(name).create(bind=self.connection,checkfirst=True)
+                self._createview()
+            else:
+                for name in missing:
+                    self._addmysqlpartition(name)
+            self._partitioncache.update(missing)
+    
+    def _partitiontable(self,name):
+        """
+        Table object for the jobreport_<name> per month table
+        """
+        tablename = '%s_%s' % (self.jobreport_table.name,name)
+        if tablename not in self.partitionmetadata.tables:
+            table = Table(tablename,self.partitionmetadata,
+                *([c.copy() for c in self.jobreport_table.columns] +
+                  [UniqueConstraint(*self.keycolumns)]))
+            for ix in self.jobreport_table.indexes:
+                Index(ix.name.replace(self.jobreport_table.name,tablename,1),*[table.c[c.name] for c in ix.columns])
+        return self.partitionmetadata.tables[tablename]
+    
+    def _createview(self):
+        """
+        (Re)create the jobreport view as the union of the per month tables,
+        or for a compact Store, as jobreport_compact joined to the lookups
+        """
+        quote = self.engine.dialect.identifier_preparer.quote
+        if self.compact:
+            query = str(self._compactselect().compile(dialect=self.engine.dialect))
+        else:
+            cols = ', '.join(quote(c.name) for c in self.jobreport_table.columns)
+            selects = ['SELECT %s FROM %s' % (cols,quote(self._partitiontable(name).name)) for name in self.partitions()]
+            query = ' UNION ALL '.join(selects)
+        view = quote(self.jobreport_table.name)
+        self.connection.execute('DROP VIEW IF EXISTS %s' % view)
+        self.connection.execute('CREATE VIEW %s AS %s' % (view,query))
+    
+    def _compactselect(self):
+        """
+        Select of jobreport_compact with the lookup values in place of the
+        ids, in jobreport column order
+        """
+        compact = self.compact_table
+        source = compact
+        cols = []
+        for c in self.jobreport_table.columns:
+            if c.name in self.dictcolumns:
+                lookup = self.lookup_tables[c.name].alias('l_%s' % c.name.lower())
+                source = source.outerjoin(lookup,lookup.c.id == compact.c[c.name + '_id'])
+                cols.append(lookup.c.value.label(c.name))
+            else:
+                cols.append(compact.c[c.name])
+        return select(cols).select_from(source)
+    
+    def _compacttable(self):
+        """
+        Move the rows of a wide jobreport table into the lookup tables and
+        jobreport_compact, and replace it with the view
+        """
+        quote = self.engine.dialect.identifier_preparer.quote
+        name = self.jobreport_table.name
+        old = Table(name + '_wide',MetaData(),*self._oldcolumns())
+        self.connection.execute('ALTER TABLE %s RENAME TO %s' % (quote(name),quote(old.name)))
+        tables = [t for t in self.metadata.sorted_tables if t is not self.jobreport_table]
+        self.metadata.create_all(bind=self.connection,tables=tables,checkfirst=True)
+        
+        compact = self.compact_table
+        source = old
+        cols = []
+        for c in old.columns:
+            if c.name in self.dictcolumns:
+                lookup = self.lookup_tables[c.name]
+                self.connection.execute(lookup.insert().from_select(['value'],
+                    select([c]).where(c != None).where(~c.in_(select([lookup.c.value]))).distinct()))
+                alias = lookup.alias('l_%s' % c.name.lower())
+                source = source.outerjoin(alias,alias.c.value == c)
+                cols.append(alias.c.id)
+            else:
+                cols.append(c)
+        self.connection.execute(compact.insert().from_select(
+            [self._compactname(c.name) for c in old.columns],select(cols).select_from(source)))
+        old.drop(bind=self.connection)
+    
+    def _oldcolumns(self):
+        """
+        Columns of the existing jobreport table that are still jobreport 
+        columns, for copying its rows into a new layout
+        """
+        existing = set(c['name'] for c in inspect(self.connection).get_columns(self.jobreport_table.name))
+        return [Column(c.name,c.type) for c in self.jobreport_table.columns if c.name in existing]
+    
+    def _partitiontables(self):
+        """
+        Move the rows of an unpartitioned jobreport table into per month
+        tables and replace it with the view
+        """
+        quote = self.engine.dialect.identifier_preparer.quote
+        name = self.jobreport_table.name
+        col = self.jobreport_table.c[self.partitioned]
+        old = Table(name + '_unpartitioned',MetaData(),*self._oldcolumns())
+        cols = [c.name for c in old.columns]
+        
+        self.connection.execute('ALTER TABLE %s RENAME TO %s' % (quote(name),quote(old.name)))
+        bounds = self.connection.execute(select([func.min(old.c[col.name]),func.max(old.c[col.name])])).first()
+        names = ['pnull']
+        if bounds[0] is not None:
+            names += [self._partitionname(m) for m in self._months(bounds[0],bounds[1])]
+        for pname in names:
+            table = self._partitiontable(pname)
+            table.create(bind=self.connection,checkfirst=True)
+            query = select([old.c[c] for c in cols])
+            if pname == 'pnull':
+                query = query.where(old.c[col.name] == None)
+            else:
+                start = datetime.datetime(int(pname[1:5]),int(pname[5:7]),1)
+                end = (start + datetime.timedelta(days=32)).replace(day=1)
+                query = query.where(and_(old.c[col.name] >= start,old.c[col.name] < end))
+            self.connection.execute(table.insert().from_select(cols,query))
+        old.drop(bind=self.connection)
+    
+    def _partitionmysql(self):
+        """
+        Partition the MySQL jobreport table by month of the partition column,
+        first replacing the unique keys that lack the column, which MySQL 
+        requires, with a (Cluster, JobID, column) one
+        """
+        quote = self.engine.dialect.identifier_preparer.quote
+        name = self.jobreport_table.name
+        sql = self._rekeysql(name,self._uniquekeys(inspect(self.engine),name),
+                             self.keycolumns + (self.partitioned,),'uq_jobreport_key',quote)
+        if sql is not None:
+            self.connection.execute(sql)
+        self.connection.execute(
+            "ALTER TABLE %s PARTITION BY RANGE (TO_DAYS(%s)) ("
+            "PARTITION pnull VALUES LESS THAN (TO_DAYS('1970-01-01')), "
+            "PARTITION pfuture VALUES LESS THAN MAXVALUE)" % (quote(name),quote(self.partitioned)))
+    
+    def _addmysqlpartition(self,name):
+        """
+        Split the partition that covers the month of partition name so that
+        the month gets its own partition
+        """
+        quote = self.engine.dialect.identifier_preparer.quote
+        start = datetime.datetime(int(name[1:5]),int(name[5:7]),1)
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+        result = self.connection.execute(text(
+            "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name AND PARTITION_NAME != 'pnull' "
+            "AND (PARTITION_DESCRIPTION = 'MAXVALUE' OR PARTITION_DESCRIPTION > TO_DAYS(:start)) "
+            "ORDER BY PARTITION_ORDINAL_POSITION LIMIT 1"),
+            name=self.jobreport_table.name,start=start)
+        containing,description = result.first()
+        self.connection.execute(
+            "ALTER TABLE %s REORGANIZE PARTITION %s INTO ("
+            "PARTITION %s VALUES LESS THAN (TO_DAYS('%s')), "
+            "PARTITION %s VALUES LESS THAN (%s))" % (
+                quote(self.jobreport_table.name),containing,
+                name,end.strftime('%Y-%m-%d'),
+                containing,description))
+    
+    def archive(self,month,path=None,detach=True):
+        """
+        Archive the partition for the month of the date month.  If path is
+        given, its rows are written there as a gzipped LOAD DATA file (see
+        stage).  If detach is True, the partition is moved out of jobreport
+        into a jobreport_archive_YYYYMM table.  Rollups are left alone.
+        """
+        if self.partitioned is None:
+            raise ValueError("Only a partitioned Store can archive partitions")
+        name = self._partitionname(month)
+        if name not in self.partitions():
+            raise ValueError("There is no %s partition" % name)
+        start = datetime.datetime(month.year,month.month,1)
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+        
+        if path is not None:
+            filters = {self.partitioned + '__ge' : start, self.partitioned + '__lt' : end}
+            self.stage((r._asdict() for r in self.fetch(**filters)),path)
+        if not detach:
+            return
+        
+        quote = self.engine.dialect.identifier_preparer.quote
+        archive = quote('%s_archive_%s' % (self.jobreport_table.name,name[1:]))
+        if self._viewlayout():
+            self.connection.execute('ALTER TABLE %s RENAME TO %s' % (quote(self._partitiontable(name).name),archive))
+            self._createview()
+            self._partitioncache = None
+        else:
+            table = quote(self.jobreport_table.name)
+            self.connection.execute('CREATE TABLE %s LIKE %s' % (archive,table))
+            self.connection.execute('ALTER TABLE %s REMOVE PARTITIONING' % archive)
+            self.connection.execute('ALTER TABLE %s EXCHANGE PARTITION %s WITH TABLE %s' % (table,name,archive))
+            self.connection.execute('ALTER TABLE %s DROP PARTITION %s' % (table,name))
+            self._partitioncache = None
+    
+    # Operators usable as Column__op keyword arguments to fetch
+    filterops = {
+        'eq'   : operator.eq,
+        'ne'   : operator.ne,
+        'lt'   : operator.lt,
+        'le'   : operator.le,
+        'gt'   : operator.gt,
+        'ge'   : operator.ge,
+        'in'   : lambda col,value: col.in_(value),
+        'like' : lambda col,value: col.like(value),
+    }
+    
+    def fetch(self,columns=None,orderby='JobID',pagesize=10000,after=None,**kwargs):
+        """
+        Generate read-only job report records that match the column values
+        in kwargs.  A keyword is a column name, optionally followed by a 
+        double underscore and one of the filterops.  A list or tuple value 
+        without an operator means in, e.g.
+        
+            store.fetch(User='akitzmiller', State=['FAILED','TIMEOUT'],
+                        Start__ge=datetime(2014,5,1), CPU_Efficiency__lt=0.5)
+        
+        Results are read pagesize rows at a time using keyset pagination on
+        Cluster, JobID (orderby='JobID') or on Start or End, Cluster, JobID
+        (orderby='Start' or 'End', which skips rows without one), each page
+        through a server side cursor, so memory use does not grow with the
+        result.  If after is a tuple of those key values, results start 
+        after it.  Records are namedtuples of columns, which defaults to 
+        every jobreport column.
+        
+        In a partitioned Store, filters on the partition column limit the
+        query to the partitions that can match.
+        """
+        table = self._fetchsource(kwargs)
+        if table is None:
+            return
+        if columns is None:
+            columns = [c.name for c in table.columns]
+        if orderby == 'JobID':
+            keys = ['Cluster','JobID']
+        elif orderby in ('Start','End'):
+            keys = [orderby,'Cluster','JobID']
+        else:
+            raise ValueError("fetch can only order by JobID, Start or End, not %s" % orderby)
+        
+        record = self._recordclass(tuple(columns))
+        keycols = [table.c[k] for k in keys]
+        selected = [table.c[n] for n in columns] + \
+            [col.label('key_%s' % col.name) for col in keycols]
+        where = self._filters(table,kwargs)
+        if orderby != 'JobID':
+            where.append(table.c[orderby] != None)
+        
+        connection = self.engine.connect().execution_options(stream_results=True)
+        try:
+            last = after
+            while True:
+                query = select(selected).order_by(*keycols).limit(pagesize)
+                for clause in where:
+                    query = query.where(clause)
+                if last is not None:
+                    query = query.where(self._after(keycols,last))
+                result = connection.execute(query)
+                n = 0
+                for row in result:
+                    n += 1
+                    row = tuple(row)
+                    last = row[len(columns):]
+                    yield record(*row[:len(columns)])
+                result.close()
+                if n < pagesize:
+                    break
+        finally:
+            connection.close()
+    
+    def _fetchsource(self,kwargs):
+        """
+        The jobreport table, or for per month tables, a union of only the
+        tables that fetch filters on the partition column can match.  None
+        if no partition can match.  MySQL prunes native partitions itself.
+        """
+        if not self._viewlayout():
+            return self.jobreport_table
+        lower = upper = None
+        for name,value in kwargs.items():
+            if name in (self.partitioned,self.partitioned + '__eq') and isinstance(value,datetime.datetime):
+                lower = upper = value
+            elif name in (self.partitioned + '__ge',self.partitioned + '__gt'):
+                lower = value
+            elif name in (self.partitioned + '__le',self.partitioned + '__lt'):
+                upper = value
+        if lower is None and upper is None:
+            return self.jobreport_table
+        
+        lowername = upname = None
+        if lower is not None:
+            lowername = self._partitionname(lower)
+        if upper is not None:
+            upname = self._partitionname(upper)
+        names = [n for n in self.partitions() if n != 'pnull' and 
+                 (lowername is None or n >= lowername) and (upname is None or n <= upname)]
+        if len(names) == 0:
+            return None
+        selects = [select([self._partitiontable(n)]) for n in names]
+        if len(selects) == 1:
+            return selects[0].alias(self.jobreport_table.name)
+        return union_all(*selects).alias(self.jobreport_table.name)
+    
+    def _recordclass(self,columns):
+        """
+        Cached namedtuple class for a tuple of column names
         """
-        self.metadata.drop_all(checkfirst=True)
+        if columns not in self._recordclasses:
+            self._recordclasses[columns] = namedtuple('JobReportRecord',columns)
+        return self._recordclasses[columns]
     
-    def fetch(self,**kwargs):
+    def _filters(self,table,kwargs):
         """
-        Retrieve an array of JobReport objects using column values
+        List of where clauses for fetch keyword arguments
         """
-        pass
+        where = []
+        for name,value in kwargs.items():
+            if '__' in name:
+                colname,op = name.rsplit('__',1)
+            elif isinstance(value,(list,tuple,set)):
+                colname,op = name,'in'
+            else:
+                colname,op = name,'eq'
+            if colname not in table.c:
+                raise ValueError("Unknown jobreport column %s" % colname)
+            if op not in self.filterops:
+                raise ValueError("Unknown filter operator %s" % op)
+            where.append(self.filterops[op](table.c[colname],value))
+        return where
     
-    def save(self,jobreports,replace=True):
+    def _after(self,keycols,last):
+        """
+        Keyset pagination clause for rows ordered after the key values last
+        """
+        clause = keycols[-1] > last[-1]
+        for col,value in reversed(zip(keycols[:-1],last[:-1])):
+            clause = or_(col > value,and_(col == value,clause))
+        return clause
+    
+    @contextmanager
+    def transaction(self):
+        """
+        Run every save inside the with block in one transaction, e.g. all of 
+        the job reports from one sacct window.  Batches are not committed 
+        individually or retried inside the block; an error rolls back 
+        everything written in it.
+        """
+        if self._intransaction:
+            yield
+            return
+        with self._serialized():
+            trans = self.connection.begin()
+            self._intransaction = True
+            try:
+                yield
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+            finally:
+                self._intransaction = False
+    
+    def _serialized(self):
+        """
+        Context manager held for a write transaction.  With rollups, the 
+        Stores sharing this one's engine take turns, since each computes 
+        its rollup deltas from the rows stored before it writes.  MySQL
+        doesn't need to: the FOR UPDATE read of the stored rows locks their
+        keys, including the gaps for new ones under the default REPEATABLE
+        READ, so a writer of the same jobs waits, or deadlocks and retries.
+        """
+        if not self.rollups or self.engine.dialect.name == 'mysql':
+            return untimed()
+        return self._writelock
+    
+    def save(self,jobreports,replace=True,batchsize=None,batchbytes=None,atomic=False,window=None,
+             cluster=None):
         """
         Store an array of JobReport objects.  Only stores the attributes 
         represented by columns; there can be others that are ignored.
-        If replace is rTrue, then an integrity error results in an
+        If replace is True, then an integrity error results in an
         update.
+        
+        On MySQL, PostgreSQL and SQLite the reports are written in chunks of
+        batchsize using the dialect's native upsert.  Other backends fall 
+        back to an insert per report followed by an update if the key exists.
+        
+        Each chunk is committed in its own transaction and only a failed 
+        chunk is retried.  If atomic is True, all of the job reports are
+        written in one transaction that is retried as a whole.
+        
+        If window is a (starttime,endtime) tuple, it is recorded in the 
+        watermark table once the job reports are written; with atomic, in
+        the same transaction.
+        
+        cluster (default the Store's) is the Cluster of job reports that 
+        don't have one, and of the window.
+        
+        Job reports that are identical to the stored ones are not written.
+        Each batch is validated first (see _validate) and the job reports 
+        that don't fit the jobreport columns are written to the rejected 
+        table in the same transaction instead.
+        
+        Returns a dict with the number of rows 'inserted', 'updated', 
+        'unchanged' and 'rejected', and if the Store dedupes, the number of
+        repeated 'duplicates' dropped
+        """
+        if cluster is None:
+            cluster = self.cluster
+        counts = {'inserted' : 0, 'updated' : 0, 'unchanged' : 0, 'rejected' : 0}
+        deduped = False
+        if self.dedupebytes:
+            counts['duplicates'] = 0
+            jobreports = self.dedupe(jobreports,counts=counts,cluster=cluster)
+            deduped = True
+        if atomic:
+            batches = []
+            rejects = []
+            for batch in self._batches(jobreports,batchsize,batchbytes,deduped,cluster):
+                batch,rejected = self._validate(batch)
+                self._prepare(batch)
+                batches.append(batch)
+                rejects += rejected
+            def saveall(batchcounts):
+                for batch in batches:
+                    self._savebatch(batch,replace,batchcounts)
+                self._reject(rejects,batchcounts)
+                if window is not None:
+                    self._markwindow(window,sum(len(batch) for batch in batches) + len(rejects),cluster)
+            self._retry(saveall,counts)
+        else:
+            jobs = 0
+            for batch in self._batches(jobreports,batchsize,batchbytes,deduped,cluster):
+                batch,rejected = self._validate(batch)
+                self._prepare(batch)
+                def savebatch(batchcounts):
+                    self._savebatch(batch,replace,batchcounts)
+                    self._reject(rejected,batchcounts)
+                self._retry(savebatch,counts)
+                jobs += len(batch) + len(rejected)
+            if window is not None:
+                self._retry(lambda batchcounts: self._markwindow(window,jobs,cluster),counts)
+        self._countmetrics(counts)
+        return counts
+    
+    def _timer(self,stage):
+        """
+        Context manager that times stage if the Store has metrics
+        """
+        if self.metrics is None:
+            return untimed()
+        return self.metrics.timer(stage)
+    
+    def _countmetrics(self,counts):
+        """
+        Add save counts to the metrics counters
+        """
+        if self.metrics is not None:
+            for k,v in counts.items():
+                self.metrics.count(k,v)
+    
+    def dedupe(self,jobreports,maxbytes=None,counts=None,cluster=None):
+        """
+        Generate value dicts for jobreports with repeated keys collapsed to 
+        the last report seen, in the order each key was first seen.  Up to
+        maxbytes (default dedupebytes) of rows are held back; when the 
+        buffer is full the oldest rows are generated to make room, so a key 
+        repeated after that is written again, still in order.  
+        counts['duplicates'] is incremented for each report dropped.
+        cluster is as for save.
+        """
+        if maxbytes is None:
+            maxbytes = self.dedupebytes
+        if counts is None:
+            counts = {}
+        counts.setdefault('duplicates',0)
+        buffered = OrderedDict()
+        size = 0
+        seconds = 0.0
+        for jobreport in jobreports:
+            start = time.time()
+            row = self._values(jobreport,cluster)
+            rowsize = sys.getsizeof(row) + self._rowsize(row)
+            key = self._key(row)
+            old = buffered.get(key)
+            if old is not None:
+                counts['duplicates'] += 1
+                size -= old[1]
+            buffered[key] = (row,rowsize)
+            size += rowsize
+            seconds += time.time() - start
+            while size > maxbytes and len(buffered) > 1:
+                oldest,oldsize = buffered.popitem(last=False)[1]
+                size -= oldsize
+                yield oldest
+        if self.metrics is not None:
+            self.metrics.add('dedupe',seconds)
+        for row,rowsize in buffered.itervalues():
+            yield row
+    
+    def _prepare(self,rows):
+        """
+        Work a batch needs done before its transaction
+        """
+        with self._timer('prepare'):
+            self._batchpartitions(rows)
+            self._lookupids(rows)
+    
+    def _batchpartitions(self,rows):
+        """
+        Create the per month tables or MySQL partitions a batch needs.  This
+        is DDL, so it runs before the batch's transaction.
+        """
+        if self.partitioned is None:
+            return
+        values = [row[self.partitioned] for row in rows if row[self.partitioned] is not None]
+        if len(values) > 0:
+            self.ensurepartitions(min(values),max(values))
+    
+    def _lookupids(self,rows):
+        """
+        Set <column>_id in each of the value dicts to the lookup table id of
+        its dictcolumn values, adding values that aren't in the lookup tables
+        yet.  The additions are committed on their own, so they are seen by
+        other writers and survive a retry.  Ids are cached in the Store, and 
+        in its clones, so only new values cost a select.
+        """
+        if not self.compact:
+            return
+        for name in self.dictcolumns:
+            ids = self._ids[name]
+            local = {}
+            missing = set()
+            for row in rows:
+                value = row[name]
+                if value is None or value in local:
+                    continue
+                id = ids.get(value)
+                if id is None:
+                    missing.add(value)
+                else:
+                    local[value] = id
+            if len(missing) > 0:
+                table = self.lookup_tables[name]
+                found = self._selectids(table,missing)
+                new = missing.difference(found)
+                if len(new) > 0:
+                    self._insertlookups(table,new)
+                    found.update(self._selectids(table,new))
+                local.update(found)
+                # Ids added inside a transaction() block could be rolled back
+                if not self._intransaction:
+                    if len(ids) + len(found) > self.idcachesize:
+                        ids.clear()
+                    ids.update(found)
+            idname = name + '_id'
+            for row in rows:
+                row[idname] = local.get(row[name])
+    
+    def _selectids(self,table,values):
+        """
+        Dict of the values that are in lookup table to their ids
+        """
+        result = self.connection.execute(select([table.c.value,table.c.id]).where(table.c.value.in_(list(values))))
+        return dict((r[0],r[1]) for r in result)
+    
+    def _insertlookups(self,table,values):
+        """
+        Add values to a lookup table, ignoring any that another writer has
+        just added
+        """
+        values = [{'value' : v} for v in values]
+        dialect = self.engine.dialect.name
+        if dialect == 'mysql':
+            self.connection.execute(table.insert().prefix_with('IGNORE'),values)
+        elif dialect == 'sqlite':
+            self.connection.execute(table.insert().prefix_with('OR IGNORE'),values)
+        else:
+            for vals in values:
+                try:
+                    self.connection.execute(table.insert(),vals)
+                except IntegrityError:
+                    pass
+    
+    def _markwindow(self,window,jobs,cluster):
+        """
+        Record a loaded sacct window of a cluster in the watermark table
+        """
+        self.connection.execute(self.watermark_table.insert(),Cluster=cluster,
+            WindowStart=window[0],WindowEnd=window[1],Jobs=jobs,Loaded=datetime.datetime.now())
+    
+    def watermarks(self,cluster=None):
+        """
+        Sorted list of (starttime,endtime) ranges of cluster (default the 
+        Store's) that have been completely loaded, with adjacent and 
+        overlapping windows merged
+        """
+        if cluster is None:
+            cluster = self.cluster
+        wm = self.watermark_table.c
+        result = self.connection.execute(
+            select([wm.WindowStart,wm.WindowEnd]).where(wm.Cluster == cluster).order_by(wm.WindowStart))
+        ranges = []
+        for start,end in result:
+            if len(ranges) > 0 and start <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0],max(end,ranges[-1][1]))
+            else:
+                ranges.append((start,end))
+        return ranges
+    
+    def gaps(self,starttime,endtime,cluster=None):
+        """
+        Sorted list of (starttime,endtime) ranges between starttime and 
+        endtime that are not covered by cluster's (default the Store's) 
+        watermarks
+        """
+        gaps = []
+        for start,end in self.watermarks(cluster):
+            if end <= starttime:
+                continue
+            if start >= endtime:
+                break
+            if start > starttime:
+                gaps.append((starttime,start))
+            starttime = max(starttime,end)
+        if starttime < endtime:
+            gaps.append((starttime,endtime))
+        return gaps
+    
+    def compactwatermarks(self):
+        """
+        Replace the watermark rows with one row per merged range of each
+        cluster, so the table stays small
+        """
+        wm = self.watermark_table
+        def compact(counts):
+            rows = self.connection.execute(select([wm.c.Cluster,wm.c.WindowStart,wm.c.WindowEnd,wm.c.Jobs])).fetchall()
+            ranges = dict((cluster,self.watermarks(cluster)) for cluster in set(row[0] for row in rows))
+            jobs = {}
+            for cluster,start,end,n in rows:
+                for r in ranges[cluster]:
+                    if r[0] <= start and end <= r[1]:
+                        jobs[(cluster,r)] = jobs.get((cluster,r),0) + (n or 0)
+                        break
+            now = datetime.datetime.now()
+            self.connection.execute(wm.delete())
+            values = [{'Cluster' : cluster, 'WindowStart' : r[0], 'WindowEnd' : r[1], 
+                       'Jobs' : jobs.get((cluster,r),0), 'Loaded' : now}
+                      for cluster in sorted(ranges) for r in ranges[cluster]]
+            if len(values) > 0:
+                self.connection.execute(wm.insert(),values)
+        self._retry(compact,{})
+    
+    def bulksave(self,jobreports,replace=True,stagingdir=None,batchsize=50000,keep=False,cluster=None):
         """
-        errorre = re.compile(r'Duplicate entry|UNIQUE constraint failed')
+        Store a large number of JobReport objects, e.g. for a historical 
+        backfill.
+        
+        On MySQL, the reports are streamed to a gzipped, tab separated 
+        staging file in jobreport column order, loaded with LOAD DATA LOCAL
+        INFILE into a temporary staging table and merged into jobreport with
+        a single INSERT ... SELECT ... ON DUPLICATE KEY UPDATE.  Rollups for
+        the months touched are rebuilt in the same transaction.  The 
+        connection needs local_infile=1 (e.g. ?local_infile=1 on the connect
+        string).  The staging file is written to stagingdir and removed 
+        afterwards unless keep is True.
+        
+        Other backends save the reports in batches of batchsize.
+        
+        Reports that fail validation are left out of the staging file and
+        written to the rejected table.  cluster is as for save.
+        
+        Returns the same counts as save.
+        """
+        if self.engine.dialect.name != 'mysql':
+            return self.save(jobreports,replace=replace,batchsize=batchsize,batchbytes=0,cluster=cluster)
+        
+        duplicates = {}
+        if self.dedupebytes:
+            jobreports = self.dedupe(jobreports,counts=duplicates,cluster=cluster)
+        fd,path = tempfile.mkstemp(prefix='jobreport-',suffix='.tsv.gz',dir=stagingdir)
+        os.close(fd)
+        try:
+            rejected = []
+            self.stage(jobreports,path,rejected,cluster)
+            counts = self.loadstaged(path,replace=replace)
+            counts['rejected'] = 0
+            if len(rejected) > 0:
+                self._retry(lambda batchcounts: self._reject(rejected,batchcounts),counts)
+            counts.update(duplicates)
+            self._countmetrics(counts)
+            return counts
+        finally:
+            if not keep:
+                os.remove(path)
+    
+    def stage(self,jobreports,path,rejected=None,cluster=None):
+        """
+        Write JobReports to a gzipped LOAD DATA file at path, one tab separated
+        line per report with columns in jobreport order.  JobReports (or 
+        value dicts) are validated in batches of batchsize, and the (row, 
+        reason) pairs of the ones that fail are appended to rejected, if 
+        given, instead of being written.  cluster is as for save.  Returns 
+        the number of lines written.
+        """
+        columns = self.jobreport_table.columns
+        n = 0
+        out = gzip.open(path,'wb')
+        try:
+            for batch in self._batches(jobreports,batchbytes=0,cluster=cluster):
+                batch,bad = self._validate(batch)
+                if rejected is not None:
+                    rejected += bad
+                self._batchpartitions(batch)
+                for row in batch:
+                    out.write('\t'.join(self._stagevalue(row[c.name]) for c in columns) + '\n')
+                n += len(batch)
+        finally:
+            out.close()
+        return n
+    
+    def _stagevalue(self,value):
+        """
+        Text for a single value in a LOAD DATA file
+        """
+        return stagevalue(value)
+    
+    def loadstaged(self,path,replace=True):
+        """
+        Load a gzipped file written by stage into the jobreport table, using
+        LOAD DATA LOCAL INFILE into a staging table and one set based upsert.
+        MySQL only.  Returns the same counts as save.
+        """
+        table = self.jobreport_table
+        target = table
+        if self.compact:
+            target = self.compact_table
+        quote = self.engine.dialect.identifier_preparer.quote
+        names = [c.name for c in table.columns]
+        cols = ', '.join(quote(n) for n in names)
+        staging = quote(table.name + '_staging')
+        
+        # LOAD DATA can't read gzip, so decompress next to the staging file
+        fd,plainpath = tempfile.mkstemp(prefix='jobreport-',suffix='.tsv',dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            src = gzip.open(path,'rb')
+            dst = open(plainpath,'wb')
+            try:
+                shutil.copyfileobj(src,dst,1024 * 1024)
+            finally:
+                src.close()
+                dst.close()
+            
+            def load(counts):
+                conn = self.connection
+                conn.execute('DROP TEMPORARY TABLE IF EXISTS %s' % staging)
+                conn.execute('CREATE TEMPORARY TABLE %s SELECT * FROM %s WHERE 1 = 0' % (staging,quote(table.name)))
+                conn.execute(text("LOAD DATA LOCAL INFILE :path INTO TABLE %s CHARACTER SET utf8 (%s)" % (staging,cols)),
+                             path=plainpath)
+                
+                on = ' AND '.join('s.%s = j.%s' % (quote(k),quote(k)) for k in self.keycolumns)
+                keys = ', '.join('s.%s' % quote(k) for k in self.keycolumns)
+                
+                # Staged rows identical to the stored ones are left out of the merge
+                fingerprint = quote(self.hashcolumn)
+                unchanged = conn.execute('DELETE s FROM %s s JOIN %s j ON %s AND s.%s = j.%s' %
+                                         (staging,quote(target.name),on,fingerprint,fingerprint)).rowcount
+                
+                total = conn.execute('SELECT COUNT(DISTINCT %s) FROM %s s' % (keys,staging)).scalar()
+                existing = conn.execute('SELECT COUNT(DISTINCT %s) FROM %s s JOIN %s j ON %s' % 
+                                        (keys,staging,quote(target.name),on)).scalar()
+                
+                # Months touched by the staged rows and the rows they replace
+                if self.rollups:
+                    when = lambda alias: 'COALESCE(%s.%s, %s.%s)' % (alias,quote('End'),alias,quote('Start'))
+                    staged = conn.execute('SELECT MIN(%s), MAX(%s) FROM %s s' % 
+                                          (when('s'),when('s'),staging)).first()
+                    replaced = conn.execute('SELECT MIN(%s), MAX(%s) FROM %s s JOIN %s j ON %s' % 
+                                            (when('j'),when('j'),staging,quote(target.name),on)).first()
+                    dates = [d for d in tuple(staged) + tuple(replaced) if d is not None]
+                
+                # A compact Store adds new values to the lookup tables first
+                if self.compact:
+                    for n in names:
+                        if n not in self.dictcolumns:
+                            continue
+                        lookup = quote(self.lookup_tables[n].name)
+                        conn.execute('INSERT IGNORE INTO %s (value) SELECT DISTINCT %s FROM %s WHERE %s IS NOT NULL' %
+                                     (lookup,quote(n),staging,quote(n)))
+                sql = self._mergesql(staging,replace,quote)
+                if self.partitioned is not None:
+                    # Rows whose partition value changes would not be caught as duplicates
+                    col = quote(self.partitioned)
+                    conn.execute('DELETE j FROM %s j JOIN %s s ON %s WHERE j.%s IS NULL OR NOT j.%s <=> s.%s' %
+                                 (quote(table.name),staging,on,col,col,col))
+                conn.execute(sql)
+                conn.execute('DROP TEMPORARY TABLE %s' % staging)
+                if self.rollups and len(dates) > 0:
+                    self.rebuildrollups(min(dates),max(dates))
+                counts['inserted'] += total - existing
+                counts['updated'] += existing
+                counts['unchanged'] += unchanged
+            
+            counts = {'inserted' : 0, 'updated' : 0, 'unchanged' : 0}
+            self._retry(load,counts)
+            return counts
+        finally:
+            os.remove(plainpath)
+    
+    def _mergesql(self,staging,replace,quote):
+        """
+        INSERT ... SELECT of the staging table into jobreport, or for a
+        compact Store, into jobreport_compact joined to the lookup tables
+        for the ids.  Every column is qualified, since the staging table
+        and the lookups share column names with the target.
+        """
+        table = self.jobreport_table
+        target = self.compact_table if self.compact else table
+        names = [c.name for c in table.columns]
+        selected = ['s.%s' % quote(n) for n in names]
+        joins = ''
+        if self.compact:
+            for i,n in enumerate(names):
+                if n not in self.dictcolumns:
+                    continue
+                alias = 'l_%s' % n.lower()
+                joins += ' LEFT JOIN %s %s ON %s.value = s.%s' % (quote(self.lookup_tables[n].name),alias,alias,quote(n))
+                selected[i] = '%s.id' % alias
+        targetnames = [self._compactname(n) if self.compact else n for n in names]
+        sql = 'INSERT INTO %s (%s) SELECT %s FROM %s s%s' % (
+            quote(target.name),', '.join(quote(n) for n in targetnames),', '.join(selected),staging,joins)
+        if replace:
+            column = lambda n: '%s.%s' % (quote(target.name),quote(n))
+            sql += ' ON DUPLICATE KEY UPDATE ' + \
+                ', '.join('%s = VALUES(%s)' % (column(n),column(n)) for n in targetnames if n not in self.keycolumns)
+        return sql
+    
+    def _batches(self,jobreports,batchsize=None,batchbytes=None,values=False,cluster=None):
+        """
+        Generate lists of value dicts bounded by batchsize rows and, if set,
+        by batchbytes approximate bytes.  If values is True, jobreports are
+        already value dicts, e.g. from dedupe.  cluster is as for save.
+        """
+        if batchsize is None:
+            batchsize = self.batchsize
+        if batchbytes is None:
+            batchbytes = self.batchbytes
+        batch = []
+        size = 0
+        timed = self.metrics is not None
+        seconds = 0.0
         for jobreport in jobreports:
-            vals = { c.name:jobreport[c.name] for c in self.jobreport_table.columns }
+            if timed:
+                start = time.time()
+            row = jobreport if values else self._values(jobreport,cluster)
+            if timed:
+                seconds += time.time() - start
+            batch.append(row)
+            size += self._rowsize(row)
+            if len(batch) >= batchsize or (batchbytes and size >= batchbytes):
+                if timed:
+                    self.metrics.add('values',seconds,len(batch))
+                    seconds = 0.0
+                yield batch
+                batch = []
+                size = 0
+        if len(batch) > 0:
+            if timed:
+                self.metrics.add('values',seconds,len(batch))
+            yield batch
+    
+    def _rowsize(self,row):
+        """
+        Approximate number of bytes a value dict sends to the database
+        """
+        size = 0
+        for value in row.values():
+            if isinstance(value,basestring):
+                size += len(value)
+            else:
+                size += 8
+        return size
+    
+    def _retry(self,func,counts):
+        """
+        Call func(batchcounts) in a transaction, rolling back and retrying on
+        operational errors (lost connections, deadlocks, lock wait timeouts).
+        A lost connection is replaced before the retry.  The counts from the
+        successful attempt are added to counts.
+        
+        Inside a transaction() block, or another _retry, func is simply 
+        called; the outer transaction owns the commit.
+        """
+        if self._intransaction:
+            func(counts)
+            return
+        with self._serialized():
+            attempt = 0
+            while True:
+                batchcounts = dict.fromkeys(counts,0)
+                trans = self.connection.begin()
+                self._intransaction = True
+                try:
+                    with self._timer('write'):
+                        func(batchcounts)
+                        start = time.time()
+                        trans.commit()
+                    if self.metrics is not None:
+                        self.metrics.observe('commit_seconds',time.time() - start)
+                    break
+                except OperationalError as e:
+                    try:
+                        trans.rollback()
+                    except Exception:
+                        # The connection is already gone
+                        pass
+                    attempt += 1
+                    if attempt > self.retries:
+                        raise
+                    if self.metrics is not None:
+                        self.metrics.count('retries')
+                    time.sleep(self.retrydelay * attempt)
+                    if e.connection_invalidated:
+                        self.reconnect()
+                except:
+                    trans.rollback()
+                    raise
+                finally:
+                    self._intransaction = False
+            for k,v in batchcounts.items():
+                counts[k] = counts.get(k,0) + v
+    
+    def reconnect(self):
+        """
+        Replace the Store's connection with a new one from the engine's 
+        pool, e.g. after the database has failed over.  SQLAlchemy discards
+        the other pooled connections when it sees a disconnect.
+        """
+        try:
+            self.connection.invalidate()
+        except Exception:
+            pass
+        self.connection = self.engine.connect()
+        self._partitioncache = None
+    
+    def _values(self,jobreport,cluster=None):
+        """
+        Dict of column values for a single JobReport, with its hashcolumn 
+        fingerprint.  A value that can't be read is an Unreadable.  Cluster
+        is cluster (default the Store's) unless jobreport is a value dict 
+        that has one.  A value dict that already has its fingerprint, e.g.
+        from a dump parsing process, is only given its Cluster.
+        """
+        if cluster is None:
+            cluster = self.cluster
+        if isinstance(jobreport,dict):
+            cluster = jobreport.get('Cluster',cluster)
+            if jobreport.get(self.hashcolumn) is not None:
+                row = dict(jobreport)
+                row['Cluster'] = cluster
+                return row
+        row = readvalues(jobreport,self.reportcolumns)
+        row['Cluster'] = cluster
+        row[self.hashcolumn] = self._fingerprint(row)
+        return row
+    
+    def _fingerprint(self,row):
+        """
+        md5 of a value dict's report columns.  Cluster is part of the key
+        rather than the content, so fingerprints don't depend on it.
+        """
+        return fingerprintvalues(row,self.reportcolumns)
+    
+    def _columnchecks(self):
+        """
+        (name, kind, limit, nullable) for each content column, where kind is
+        a validtypes key and limit is a string column's length or the 
+        largest value of an integer column
+        """
+        checks = []
+        for column in self.jobreport_table.columns:
+            if column.name not in self.contentcolumns:
+                continue
+            coltype = column.type
+            if isinstance(coltype,types.String):
+                kind,limit = 'string',coltype.length
+            elif isinstance(coltype,types.BigInteger):
+                kind,limit = 'integer',2 ** 63 - 1
+            elif isinstance(coltype,types.Integer):
+                kind,limit = 'integer',2 ** 31 - 1
+            elif isinstance(coltype,types.Float):
+                kind,limit = 'float',None
+            elif isinstance(coltype,types.DateTime):
+                kind,limit = 'datetime',None
+            else:
+                continue
+            checks.append((column.name,kind,limit,column.nullable))
+        return checks
+    
+    def _validate(self,rows,nullify=False):
+        """
+        Convert and check a batch of value dicts column by column against 
+        the jobreport column types, sizes and nullability.  Returns the rows
+        that pass and a list of (row, reason) for the others.  reason is a 
+        comma separated list of codes and columns, e.g. type:MaxRSS_kB; the
+        codes are null, type, unreadable, length and range.
+        
+        If nullify is True, bad values in nullable columns are set to NULL
+        instead, so only rows with a bad Cluster or JobID are rejected.
+        """
+        with self._timer('validate'):
+            reasons = {}
+            converted = set()
+            for name,kind,limit,nullable in self._checks:
+                for i,code in self._checkcolumn(rows,name,kind,limit,nullable,converted):
+                    reasons.setdefault(i,[]).append((code,name))
+            if len(reasons) == 0 and len(converted) == 0:
+                return rows,[]
+            
+            nullable = set(name for name,kind,limit,isnull in self._checks if isnull)
+            good = []
+            rejected = []
+            for i,row in enumerate(rows):
+                failed = reasons.get(i)
+                if failed is not None and nullify and all(name in nullable for code,name in failed):
+                    for code,name in failed:
+                        row[name] = None
+                    failed = None
+                    converted.add(i)
+                if failed is None:
+                    if i in converted:
+                        row[self.hashcolumn] = self._fingerprint(row)
+                    good.append(row)
+                else:
+                    rejected.append((row,','.join('%s:%s' % f for f in failed)))
+            return good,rejected
+    
+    def _checkcolumn(self,rows,name,kind,limit,nullable,converted):
+        """
+        List of (index, code) for the bad values of one column in a batch.
+        The types and limits are checked for the whole column at once, and 
+        values are only looked at one by one when that fails.  Values that 
+        convert to the column's type are replaced and their index is added
+        to converted.
+        """
+        values = [row[name] for row in rows]
+        bad = []
+        valid = self.validtypes[kind]
+        found = set(map(type,values))
+        found.discard(type(None))
+        if not found.issubset(valid):
+            convert = self.converters[kind]
+            for i,value in enumerate(values):
+                if value is None or type(value) in valid:
+                    continue
+                if isinstance(value,Unreadable):
+                    bad.append((i,'unreadable'))
+                else:
+                    try:
+                        values[i] = rows[i][name] = convert(value)
+                        converted.add(i)
+                        continue
+                    except (ValueError,TypeError,OverflowError):
+                        bad.append((i,'type'))
+                values[i] = None
+        if not nullable:
+            failed = set(i for i,code in bad)
+            bad += [(i,'null') for i,value in enumerate(values) if value is None and i not in failed]
+        
+        present = [value for value in values if value is not None]
+        if len(present) == 0:
+            return bad
+        if kind == 'string':
+            if limit is not None and max(map(len,present)) > limit:
+                bad += [(i,'length') for i,value in enumerate(values) if value is not None and len(value) > limit]
+        elif kind == 'integer':
+            if min(present) < -limit - 1 or max(present) > limit:
+                bad += [(i,'range') for i,value in enumerate(values) 
+                        if value is not None and not -limit - 1 <= value <= limit]
+        elif kind == 'float':
+            # inf and nan make the sum nan, and x - x is only nan for them
+            total = sum(present)
+            if total - total != 0:
+                bad += [(i,'range') for i,value in enumerate(values) if value is not None and value - value != 0]
+        elif kind == 'datetime':
+            if min(present) < self.mindatetime:
+                bad += [(i,'range') for i,value in enumerate(values) if value is not None and value < self.mindatetime]
+        return bad
+    
+    def _reject(self,rejected,counts):
+        """
+        Write (row, reason) pairs from _validate to the rejected table, 
+        replacing earlier rejections of the same keys, and add them to 
+        counts['rejected']
+        """
+        counts['rejected'] = counts.get('rejected',0) + len(rejected)
+        if len(rejected) == 0:
+            return
+        table = self.rejected_table
+        now = datetime.datetime.now()
+        values = []
+        for row,reason in rejected:
+            vals = dict((name,self._text(row[name])) for name in self.contentcolumns)
+            vals['Reason'] = reason[:255]
+            vals['Rejected'] = now
+            values.append(vals)
+        keys = set(self._key(vals) for vals in values if vals['JobID'] is not None)
+        if len(keys) > 0:
+            self.connection.execute(table.delete().where(self._keyclause(table,keys)))
+        self.connection.execute(table.insert(),values)
+    
+    def _text(self,value):
+        """
+        Text for a value in the rejected table
+        """
+        if value is None or isinstance(value,Unreadable):
+            return None
+        if isinstance(value,datetime.datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        if isinstance(value,float):
+            return repr(value)
+        if isinstance(value,unicode):
+            return value
+        return str(value)
+    
+    def reprocess(self,nullify=False,replace=True,batchsize=None):
+        """
+        Validate the rows in the rejected table again, e.g. after --migrate 
+        has widened a column, and save the ones that pass.  Saved rows are
+        deleted from rejected and the others get their new reasons.  With
+        nullify, bad values are saved as NULL (see _validate).  Values that
+        were unreadable stay rejected unless nullify is set.
+        
+        Returns the same counts as save, with the number of rows still
+        'rejected'.
+        """
+        if batchsize is None:
+            batchsize = self.batchsize
+        table = self.rejected_table
+        columns = [table.c.id,table.c.Reason] + [table.c[name] for name in self.contentcolumns]
+        update = table.update().where(table.c.id == bindparam('rejectedid')).values(Reason=bindparam('newreason'))
+        counts = {'inserted' : 0, 'updated' : 0, 'unchanged' : 0, 'rejected' : 0}
+        last = 0
+        while True:
+            page = self.connection.execute(
+                select(columns).where(table.c.id > last).order_by(table.c.id).limit(batchsize)).fetchall()
+            if len(page) == 0:
+                break
+            last = page[-1]['id']
+            rows = []
+            ids = {}
+            for r in page:
+                row = dict((name,r[name]) for name in self.contentcolumns)
+                if row['Cluster'] is None:
+                    row['Cluster'] = self.cluster
+                for reason in (r['Reason'] or '').split(','):
+                    code,_,name = reason.partition(':')
+                    if code == 'unreadable' and name in row:
+                        row[name] = Unreadable(reason)
+                rows.append(row)
+                ids[id(row)] = r['id']
+            good,rejected = self._validate(rows,nullify)
+            for row in good:
+                row[self.hashcolumn] = self._fingerprint(row)
+            self._prepare(good)
+            def save(batchcounts):
+                self._savebatch(good,replace,batchcounts)
+                if len(good) > 0:
+                    self.connection.execute(table.delete().where(table.c.id.in_([ids[id(row)] for row in good])))
+                if len(rejected) > 0:
+                    self.connection.execute(update,[{'rejectedid' : ids[id(row)], 'newreason' : reason[:255]} 
+                                                    for row,reason in rejected])
+                batchcounts['rejected'] += len(rejected)
+            self._retry(save,counts)
+        self._countmetrics(counts)
+        return counts
+    
+    def _savebatch(self,rows,replace,counts):
+        """
+        Write a list of value dicts and add to the inserted / updated / 
+        unchanged counts.  Rows whose fingerprint matches the stored row are
+        not written.
+        """
+        if len(rows) == 0:
+            return
+        existing = self._existing(rows)
+        rows = self._changed(rows,existing,counts)
+        if len(rows) == 0:
+            return
+        keys = set(self._key(row) for row in rows)
+        existing = dict((k,v) for k,v in existing.items() if k in keys)
+        if self.rollups:
+            self._rollupbatch(rows,existing)
+        if self.partitioned is not None:
+            self._savepartitioned(rows,replace,counts,existing)
+            return
+        
+        table = self.jobreport_table
+        if self.compact:
+            table = self.compact_table
+            rows = [self._encode(row) for row in rows]
+        upsert = self._upsert(table)
+        if upsert is None:
+            self._saverows(rows,replace,counts,table)
+            return
+        
+        existing = set(existing)
+        for row in rows:
+            key = self._key(row)
+            if key in existing:
+                counts['updated'] += 1
+            else:
+                counts['inserted'] += 1
+                existing.add(key)
+        
+        if replace:
+            self.connection.execute(upsert,rows)
+        else:
+            self.connection.execute(table.insert(),rows)
+    
+    def _changed(self,rows,existing,counts):
+        """
+        The rows that are new or differ from the stored row, or from an 
+        earlier row in the batch, counting the others as unchanged
+        """
+        current = dict((k,r[self.hashcolumn]) for k,r in existing.items())
+        changed = []
+        for row in rows:
+            key = self._key(row)
+            fingerprint = row[self.hashcolumn]
+            if fingerprint is not None and current.get(key) == fingerprint:
+                counts['unchanged'] = counts.get('unchanged',0) + 1
+                continue
+            current[key] = fingerprint
+            changed.append(row)
+        return changed
+    
+    def _encode(self,row):
+        """
+        jobreport_compact value dict for a value dict with lookup ids
+        """
+        return dict((c.name,row[c.name]) for c in self.compact_table.columns)
+    
+    def _savepartitioned(self,rows,replace,counts,existing):
+        """
+        Write a batch to a partitioned store.  Only the last row for each 
+        key is written.  A stored row whose partition value is missing or 
+        different is deleted first, since it may be in another partition
+        and (Cluster, JobID, partition value) doesn't catch it as a 
+        duplicate.
+        """
+        if not replace and len(existing) > 0:
+            raise ValueError("JobIDs are already stored: %s" % ', '.join(k[1] for k in existing))
+        col = self.partitioned
+        latest = {}
+        for row in rows:
+            key = self._key(row)
+            if key in existing or key in latest:
+                counts['updated'] += 1
+            else:
+                counts['inserted'] += 1
+            latest[key] = row
+        
+        moved = [old for key,old in existing.items() if old[col] is None or old[col] != latest[key][col]]
+        if self._viewlayout():
+            targets = {}
+            for old in moved:
+                targets.setdefault(self._partitionname(old[col]),[]).append(self._key(old))
+            for name,keys in targets.items():
+                table = self._partitiontable(name)
+                self.connection.execute(table.delete().where(self._keyclause(table,keys)))
+            
+            targets = {}
+            for row in latest.values():
+                targets.setdefault(self._partitionname(row[col]),[]).append(row)
+            for name,partrows in targets.items():
+                table = self._partitiontable(name)
+                upsert = self._upsert(table)
+                if upsert is None:
+                    self._saverows(partrows,replace,{'inserted' : 0, 'updated' : 0},table)
+                else:
+                    self.connection.execute(upsert,partrows)
+        else:
+            table = self.jobreport_table
+            if len(moved) > 0:
+                self.connection.execute(table.delete().where(self._keyclause(table,[self._key(old) for old in moved])))
+            self.connection.execute(self._upsert(table),latest.values())
+    
+    def _saverows(self,rows,replace,counts,table=None):
+        """
+        Row at a time insert, catching the duplicate key error and updating
+        """
+        if table is None:
+            table = self.jobreport_table
+        errorre = re.compile(r'Duplicate entry|UNIQUE constraint failed|duplicate key value')
+        for vals in rows:
             try: 
-                insert = self.jobreport_table.insert(values=vals)
+                insert = table.insert(values=vals)
                 self.connection.execute(insert)
+                counts['inserted'] += 1
             except Exception, e:
                 match = errorre.search(str(e))
-                if match is not None:
-                    update = self.jobreport_table.update().where(self.jobreport_table.c.JobID == jobreport["JobID"]).values(vals)
+                if replace and match is not None:
+                    where = [table.c[k] == vals[k] for k in self.keycolumns]
+                    update = table.update().where(and_(*where)).values(vals)
                     self.connection.execute(update)
+                    counts['updated'] += 1
                 else:
                     raise e 
-            
     
+    def _key(self,row):
+        """
+        Tuple of key column values for a row
+        """
+        return tuple(row[k] for k in self.keycolumns)
+    
+    def _keyclause(self,table,keys):
+        """
+        Where clause for the rows of table with any of the (Cluster, JobID)
+        keys, with a JobID in list per cluster
+        """
+        jobids = {}
+        for cluster,jobid in keys:
+            jobids.setdefault(cluster,[]).append(jobid)
+        return or_(*[and_(table.c.Cluster == cluster,table.c.JobID.in_(ids)) for cluster,ids in jobids.items()])
+    
+    def _existing(self,rows):
+        """
+        Dict of the keys from rows that are already in the jobreport table,
+        fetched with a single select, to the stored row's fingerprint, 
+        rollup and partition columns
+        """
+        table = self.jobreport_table
+        keys = set(self._key(row) for row in rows)
+        names = set(self.keycolumns + (self.hashcolumn,))
+        if self.rollups:
+            names.update(('Start','End') + self.rollupgroups + self.rollupsums)
+        if self.partitioned is not None:
+            names.add(self.partitioned)
+        query = select([table.c[n] for n in names]).where(self._keyclause(table,keys))
+        if self.rollups and self.engine.dialect.name == 'mysql':
+            # Another process can't count these keys as new until this commits
+            query = query.with_for_update()
+        result = self.connection.execute(query)
+        return dict((self._key(r),r) for r in result)
+    
+    def _rollupbatch(self,rows,existing):
+        """
+        Add a batch of rows to the rollup tables, first subtracting the 
+        stored values for rows that will be replaced
+        """
+        deltas = {}
+        current = dict(existing)
+        for row in rows:
+            key = self._key(row)
+            if key in current:
+                self._rollupdelta(deltas,current[key],-1)
+            self._rollupdelta(deltas,row,1)
+            current[key] = row
+        
+        for table in (self.daily_table,self.monthly_table):
+            groups = [(group,sums) for (t,group),sums in deltas.items() 
+                      if t is table and any(v != 0 for v in sums)]
+            if len(groups) > 0:
+                self._addrollups(table,groups)
+    
+    def _rollupdelta(self,deltas,row,sign):
+        """
+        Add sign times row's contribution to the daily and monthly deltas
+        """
+        when = row['End'] or row['Start']
+        if when is None:
+            return
+        day = when.date()
+        groups = tuple(row[g] or '' for g in self.rollupgroups)
+        values = [sign] + [sign * (row[c] or 0) for c in self.rollupsums]
+        for table,date in ((self.daily_table,day),(self.monthly_table,day.replace(day=1))):
+            sums = deltas.setdefault((table,(date,) + groups),[0] * len(values))
+            for i,v in enumerate(values):
+                sums[i] += v
+    
+    def _addrollups(self,table,groups):
+        """
+        Add a list of (group,sums) to the rollup table, creating rows as
+        necessary.  group has the period date and the rollupgroups values;
+        sums has Jobs and the rollupsums values.
+        """
+        keys = table.columns.keys()[:len(self.rollupgroups) + 1]
+        names = ['Jobs'] + list(self.rollupsums)
+        values = [dict(zip(keys,group) + zip(names,sums)) for group,sums in groups]
+        upsert = self._upsert(table,keys,additive=True)
+        if upsert is not None:
+            self.connection.execute(upsert,values)
+            return
+        for vals in values:
+            where = and_(*[table.c[k] == vals[k] for k in keys])
+            update = table.update().where(where).values(
+                dict((table.c[n],table.c[n] + vals[n]) for n in names))
+            if self.connection.execute(update).rowcount == 0:
+                self.connection.execute(table.insert(),vals)
+    
+    def rebuildrollups(self,starttime=None,endtime=None):
+        """
+        Recompute the daily and monthly rollups from the jobreport table for
+        the whole months from starttime to endtime, or for everything.
+        """
+        if starttime is not None:
+            starttime = datetime.datetime(starttime.year,starttime.month,1)
+        if endtime is not None:
+            endtime = datetime.datetime(endtime.year,endtime.month,1)
+            endtime = (endtime + datetime.timedelta(days=32)).replace(day=1)
+        
+        jr = self.jobreport_table.c
+        daily = self.daily_table
+        monthly = self.monthly_table
+        when = func.coalesce(jr.End,jr.Start)
+        day = func.date(when)
+        groups = [func.coalesce(jr[g],'') for g in self.rollupgroups]
+        names = ['Day'] + list(self.rollupgroups) + ['Jobs'] + list(self.rollupsums)
+        query = select([day] + groups + [func.count()] + [func.coalesce(func.sum(jr[c]),0) for c in self.rollupsums]) \
+            .where(when != None).group_by(*([day] + groups))
+        
+        month = self._monthof(daily.c.Day)
+        monthgroups = [daily.c[g] for g in self.rollupgroups]
+        monthquery = select([month] + monthgroups + [func.sum(daily.c[n]) for n in names[len(self.rollupgroups) + 1:]]) \
+            .group_by(*([month] + monthgroups))
+        
+        deletedaily = daily.delete()
+        deletemonthly = monthly.delete()
+        if starttime is not None:
+            query = query.where(when >= starttime)
+            monthquery = monthquery.where(daily.c.Day >= starttime.date())
+            deletedaily = deletedaily.where(daily.c.Day >= starttime.date())
+            deletemonthly = deletemonthly.where(monthly.c.Month >= starttime.date())
+        if endtime is not None:
+            query = query.where(when < endtime)
+            monthquery = monthquery.where(daily.c.Day < endtime.date())
+            deletedaily = deletedaily.where(daily.c.Day < endtime.date())
+            deletemonthly = deletemonthly.where(monthly.c.Month < endtime.date())
+        
+        def rebuild(counts):
+            self.connection.execute(deletedaily)
+            self.connection.execute(deletemonthly)
+            self.connection.execute(daily.insert().from_select(names,query))
+            self.connection.execute(monthly.insert().from_select(['Month'] + names[1:],monthquery))
+        self._retry(rebuild,{})
+    
+    def _monthof(self,col):
+        """
+        SQL expression for the first day of the month of a date column
+        """
+        dialect = self.engine.dialect.name
+        if dialect == 'mysql':
+            return func.date_format(col,'%Y-%m-01')
+        if dialect == 'sqlite':
+            return func.strftime('%Y-%m-01',col)
+        return func.date_trunc('month',col)
     
+    def rollup(self,period='day',groupby=('User',),**kwargs):
+        """
+        List of records summed from the daily or monthly rollup tables, 
+        rather than from the jobreport table.  Records have the groupby 
+        columns, Jobs, the summed rollupsums columns and CPU_Efficiency.
+        kwargs filter like fetch, e.g.
+        
+            store.rollup(period='month',groupby=('Month','Partition'),
+                         Month__ge=datetime.date(2014,1,1))
+        """
+        if period == 'day':
+            table = self.daily_table
+        elif period == 'month':
+            table = self.monthly_table
+        else:
+            raise ValueError("Rollup period must be day or month, not %s" % period)
+        groupcols = [table.c[g] for g in groupby]
+        names = ['Jobs'] + list(self.rollupsums)
+        query = select(groupcols + [func.sum(table.c[n]) for n in names]).group_by(*groupcols) \
+            .having(func.sum(table.c.Jobs) != 0).order_by(*groupcols)
+        for clause in self._filters(table,kwargs):
+            query = query.where(clause)
+        
+        record = self._recordclass(tuple(groupby) + tuple(names) + ('CPU_Efficiency',))
+        records = []
+        for row in self.connection.execute(query):
+            row = tuple(row)
+            sums = dict(zip(names,row[len(groupby):]))
+            efficiency = None
+            if sums['CPUTime']:
+                efficiency = sums['TotalCPU'] / sums['CPUTime']
+            records.append(record(*(row + (efficiency,))))
+        return records
+    
+    def _upsert(self,table,keycolumns=None,additive=False):
+        """
+        Native upsert statement for table, suitable for executemany, or 
+        None if the dialect doesn't have one.  All non-key columns are
+        replaced with the new values, or if additive, incremented by them.
+        """
+        if keycolumns is None:
+            keycolumns = self.keycolumns
+        dialect = self.engine.dialect
+        if dialect.name == 'sqlite' and sqlite3.sqlite_version_info < (3,24,0):
+            return None
+        if dialect.name not in ('mysql','sqlite','postgresql'):
+            return None
+        
+        quote = dialect.identifier_preparer.quote
+        names = [c.name for c in table.columns]
+        sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+            quote(table.name),
+            ', '.join(quote(n) for n in names),
+            ', '.join(':%s' % n for n in names),
+        )
+        updates = [n for n in names if n not in keycolumns]
+        if dialect.name == 'mysql':
+            if additive:
+                setter = '%(col)s = %(col)s + VALUES(%(col)s)'
+            else:
+                setter = '%(col)s = VALUES(%(col)s)'
+            sql += " ON DUPLICATE KEY UPDATE "
+        else:
+            # PostgreSQL needs the stored value qualified by the table name
+            if additive:
+                setter = '%(col)s = %(table)s.%(col)s + excluded.%(col)s'
+            else:
+                setter = '%(col)s = excluded.%(col)s'
+            sql += " ON CONFLICT (%s) DO UPDATE SET " % ', '.join(quote(k) for k in keycolumns)
+        sql += ', '.join(setter % {'col' : quote(n), 'table' : quote(table.name)} for n in updates)
+        params = [bindparam(c.name,type_=c.type) for c in table.columns]
+        return text(sql).bindparams(*params)
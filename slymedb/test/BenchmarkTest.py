@@ -0,0 +1,94 @@
+'''
+Tests for the synthetic sacct output and the benchmark runner
+'''
+import unittest
+import os
+import tempfile
+from slymedb import benchmark
+from slymedb.store import Store
+
+
+class Test(unittest.TestCase):
+
+    def testSacctLines(self):
+        """
+        Every job parses into one job report, with pipes in some JobNames,
+        and the same seed gives the same lines
+        """
+        lines = list(benchmark.sacctlines(500,seed=1))
+        self.assertEqual(lines, list(benchmark.sacctlines(500,seed=1)))
+        self.assertTrue(any(line.count('|') > 16 for line in lines))
+        self.assertTrue(any('.batch|' in line for line in lines))
+        jobreports = list(benchmark.getjobreports(500,seed=1))
+        self.assertEqual(len(jobreports), 500)
+        self.assertTrue(any('|' in jr['JobName'] for jr in jobreports))
+
+    def testRun(self):
+        """
+        run reports each phase, and the reload writes nothing
+        """
+        fd,path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        try:
+            results = benchmark.run('sqlite:///%s' % path,300,batchsize=100)
+        finally:
+            os.remove(path)
+        self.assertEqual([r['phase'] for r in results], ['parse','load','reload'])
+        for r in results:
+            self.assertEqual(r['rows'], 300)
+        self.assertTrue(results[2]['statements'] < results[1]['statements'])
+
+        baseline = dict((benchmark._key(r),dict(r)) for r in results)
+        self.assertEqual(benchmark.compare(results,baseline), [])
+        baseline[benchmark._key(results[1])]['statements_per_row'] /= 2
+        self.assertEqual(len(benchmark.compare(results,baseline)), 1)
+
+    # Statements per row for 1000 jobs in batches of 100, (load, reload), by
+    # save path.  The counts don't depend on the machine, so a change to the
+    # save path that sends more statements fails here.
+    statementsperrow = {
+        'upsert'             : (0.040,0.010),
+        'upsert, no rollups' : (0.020,0.010),
+        'upsert, dedupe'     : (0.040,0.010),
+        'compact'            : (0.139,0.010),
+        'partitioned'        : (0.063,0.010),
+        'row at a time'      : (4.690,0.010),
+        'row at a time, no rollups' : (1.010,0.010),
+    }
+
+    def measure(self,**storeoptions):
+        fd,path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        try:
+            results = benchmark.run('sqlite:///%s' % path,1000,batchsize=100,**storeoptions)
+        finally:
+            os.remove(path)
+        return tuple(r['statements_per_row'] for r in results[1:])
+
+    def testStatementsPerRow(self):
+        """
+        No save path sends more statements per row than it did when the 
+        ceilings were recorded
+        """
+        measured = {
+            'upsert'             : self.measure(),
+            'upsert, no rollups' : self.measure(rollups=False),
+            'upsert, dedupe'     : self.measure(dedupebytes=1024 * 1024),
+            'compact'            : self.measure(compact=True),
+            'partitioned'        : self.measure(partitioned='End'),
+        }
+        # The insert then update per row path of backends without an upsert
+        upsert = Store._upsert
+        Store._upsert = lambda self,*args,**kwargs: None
+        try:
+            measured['row at a time'] = self.measure()
+            measured['row at a time, no rollups'] = self.measure(rollups=False)
+        finally:
+            Store._upsert = upsert
+        for path,ceilings in self.statementsperrow.items():
+            for phase,value,ceiling in zip(('load','reload'),measured[path],ceilings):
+                self.assertTrue(value <= ceiling + 1e-9,"%s %s: %.4f statements per row, was %.4f" % (path,phase,value,ceiling))
+
+
+if __name__ == "__main__":
+    unittest.main()
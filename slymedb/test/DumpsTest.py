@@ -0,0 +1,90 @@
+'''
+Tests for loading saved sacct output
+'''
+import unittest
+import os
+import gzip
+import shutil
+import tempfile
+from StringIO import StringIO
+from slymedb import Store
+from slymedb import benchmark
+from slymedb.dumps import DumpLoader, chunks, lines
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory,'sacct.txt')
+        out = open(self.path,'w')
+        out.write('JobID|User|JobName|State|Partition|NCPUS|NNodes|CPUTime|TotalCPU|UserCPU|SystemCPU|ReqMem|MaxRSS|Start|End|NodeList|Elapsed\n')
+        for line in benchmark.sacctlines(1000,seed=2):
+            out.write(line + '\n')
+        out.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testChunks(self):
+        """
+        Chunks cover the file and only start on job lines
+        """
+        ranges = list(chunks(self.path,4096))
+        self.assertTrue(len(ranges) > 10)
+        self.assertEqual(ranges[0][1], 0)
+        self.assertEqual(ranges[-1][2], os.path.getsize(self.path))
+        for previous,current in zip(ranges,ranges[1:]):
+            self.assertEqual(previous[2], current[1])
+        text = open(self.path).read()
+        for path,start,end,chunk in ranges[1:]:
+            self.assertEqual(text[start - 1], '\n')
+            self.assertFalse('.' in text[start:text.index('|',start)])
+        self.assertEqual(sum(len(list(lines(*r))) for r in ranges), len(text.splitlines()) - 1)
+
+    def testGzipChunks(self):
+        """
+        A gzipped dump is split on job boundaries as it is decompressed
+        """
+        gzpath = self.path + '.gz'
+        out = gzip.open(gzpath,'wb')
+        out.write(open(self.path).read())
+        out.close()
+        ranges = list(chunks(gzpath,4096))
+        self.assertTrue(len(ranges) > 10)
+        text = open(self.path).read()
+        self.assertEqual(''.join(chunk for path,start,end,chunk in ranges), text)
+        for path,start,end,chunk in ranges[1:]:
+            self.assertEqual(text[start:end], chunk)
+            self.assertFalse('.' in chunk[:chunk.index('|')])
+        self.assertEqual(sum(len(list(lines(*r))) for r in ranges), len(text.splitlines()) - 1)
+
+    def testDumpLoader(self):
+        """
+        Plain and gzipped dumps are parsed in a pool and saved, with the
+        later file winning for a job that is in both
+        """
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        store = Store(connectstring)
+        store.drop()
+        store.create()
+
+        first = open(self.path).read().splitlines()[1].split('|')
+        first[1] = 'someoneelse'
+        gzpath = os.path.join(self.directory,'later.txt.gz')
+        out = gzip.open(gzpath,'wb')
+        out.write('|'.join(first) + '\n')
+        out.close()
+
+        loader = DumpLoader(store,processes=2,chunkbytes=8192,log=StringIO())
+        counts = loader.run([self.path,gzpath])
+        self.assertEqual((counts['inserted'],counts['updated']), (1000,1))
+        self.assertEqual(len(list(store.fetch(columns=['JobID']))), 1000)
+        job = list(store.fetch(JobID=first[0]))[0]
+        self.assertEqual(job.User, 'someoneelse')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+'''
+Tests for streaming exports
+'''
+import unittest
+import os
+import csv
+import gzip
+import json
+import shutil
+import tempfile
+import datetime
+from StringIO import StringIO
+from slyme import Slurm
+from slymedb import Store
+from slymedb import export
+from slymedb.export import Exporter
+from slymedb.test.JobReportLoadingTest import FakeRunSh
+
+
+text = """
+10048462|akitzmiller|bash|COMPLETED|interact|1|1|02:08:33|08:01.433|06:47.955|01:13.477|2000Mn|2409232K|2014-05-01T11:43:26|2014-05-01T13:51:59|holy2a18206|00:00:10
+10053213|akitzmiller|bash|COMPLETED|interact|1|1|01:04:49|13:29.616|11:09.280|02:20.336|20000Mn|468500K|2014-05-01T13:52:30|2014-05-01T14:57:19|holy2a18206|00:00:10
+10102801|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10
+10213033|akitzmiller|bash|COMPLETED|interact|1|1|01:27:02|00:03.319|00:01.623|00:01.695|2000Mn|5656K|2014-05-05T14:20:40|2014-05-05T15:47:42|holy2a18208|00:00:10
+10384435|akitzmiller|agalmatest.sbatch|FAILED|general|8|1|00:01:36|00:01.590|00:01.220|00:00.369|30000Mn|1024K|2014-06-09T16:01:53|2014-06-09T16:02:05|holy2a04307|00:00:10
+"""
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        self.store = Store(connectstring)
+        self.store.drop()
+        self.store.create()
+        self.store.save(Slurm.getJobReports(execfunc=FakeRunSh(text).runsh_i))
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def readcsv(self,name):
+        return list(csv.reader(gzip.open(os.path.join(self.directory,name))))
+
+    def testCsvResume(self):
+        """
+        Months are split into parts of chunksize rows, and an interrupted
+        export only writes the parts after the last one in the manifest
+        """
+        exporter = Exporter(self.store,self.directory,format='csv',chunksize=2,
+                            columns=['User','NCPUS','End'],log=StringIO())
+        rows = exporter.run(datetime.datetime(2014,5,1),datetime.datetime(2014,7,1))
+        self.assertEqual(rows, 5)
+        may = self.readcsv('month=2014-05/part-00001.csv.gz')
+        self.assertEqual(may, [['JobID','User','NCPUS','End','Cluster'],
+                               ['10102801','akitzmiller','1','2014-05-02 14:30:23',''],
+                               ['10213033','akitzmiller','1','2014-05-05 15:47:42','']])
+        self.assertEqual(len(self.readcsv('month=2014-06/part-00000.csv.gz')), 2)
+
+        path = os.path.join(self.directory,'manifest.json')
+        manifest = json.load(open(path))
+        self.assertEqual(manifest['columns'], [['JobID','string'],['User','string'],['NCPUS','int32'],['End','timestamp'],
+                                               ['Cluster','string']])
+        self.assertEqual([p['rows'] for p in manifest['months']['2014-05']['parts']], [2,2])
+        self.assertEqual(manifest['months']['2014-05']['parts'][0]['last'], ['2014-05-01 14:57:19.000000','','10053213'])
+
+        # As if the export had stopped after the first part of May
+        del manifest['months']['2014-05']['parts'][1]
+        manifest['months']['2014-05']['rows'] = 2
+        manifest['months']['2014-05']['done'] = False
+        json.dump(manifest,open(path,'w'))
+        os.remove(os.path.join(self.directory,'month=2014-05/part-00001.csv.gz'))
+        rows = exporter.run(datetime.datetime(2014,5,1),datetime.datetime(2014,7,1))
+        self.assertEqual(rows, 2)
+        self.assertEqual(self.readcsv('month=2014-05/part-00001.csv.gz'), may)
+
+        self.assertRaises(ValueError,exporter.run,datetime.datetime(2014,5,1),datetime.datetime(2014,8,1))
+
+    @unittest.skipIf(export.pyarrow is None,"pyarrow is not installed")
+    def testParquet(self):
+        """
+        Parquet parts have the jobreport column types
+        """
+        import pyarrow.parquet
+        exporter = Exporter(self.store,self.directory,log=StringIO())
+        exporter.run(datetime.datetime(2014,5,1),datetime.datetime(2014,6,1),State='COMPLETED')
+        table = pyarrow.parquet.read_table(os.path.join(self.directory,'month=2014-05','part-00000.parquet'))
+        self.assertEqual(table.num_rows, 4)
+        self.assertEqual(str(table.schema.field('MaxRSS_kB').type), 'int64')
+        self.assertEqual(str(table.schema.field('End').type), 'timestamp[ms]')
+        ends = table.column('End').to_pylist()
+        self.assertTrue(all(end.month == 5 and end.microsecond == 0 for end in ends))
+
+    @unittest.skipIf(export.pyarrow is None,"pyarrow is not installed")
+    def testArrow(self):
+        """
+        Arrow parts read back with the same schema
+        """
+        exporter = Exporter(self.store,self.directory,format='arrow',log=StringIO())
+        exporter.run(datetime.datetime(2014,5,1),datetime.datetime(2014,6,1),State='COMPLETED')
+        path = os.path.join(self.directory,'month=2014-05','part-00000.arrow')
+        table = export.pyarrow.ipc.open_file(export.pyarrow.memory_map(path)).read_all()
+        self.assertEqual(table.num_rows, 4)
+        self.assertEqual(table.schema, exporter.schema)
+
+
+if __name__ == "__main__":
+    unittest.main()
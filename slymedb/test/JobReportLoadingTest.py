@@ -5,8 +5,13 @@ Created on May 19, 2014
 '''
 import unittest
 import os, re
+import gzip
+import tempfile
+import datetime
 from slyme import Slurm, JobReport
 from slymedb import Store
+from slymedb.metrics import Metrics
+from sqlalchemy import MetaData, Table, Column, inspect, select
 
 """
 Job report text is pipe separated values of the following fields:
@@ -96,6 +101,463 @@ class Test(unittest.TestCase):
         
 
     
+    def testSaveCounts(self):
+        """
+        Batched saves report how many rows were inserted, updated and left 
+        unchanged
+        """
+        text="""
+10053213|akitzmiller|bash|COMPLETED|interact|1|1|01:04:49|13:29.616|11:09.280|02:20.336|20000Mn|468500K|2014-05-01T13:52:30|2014-05-01T14:57:19|holy2a18206|00:00:10
+10102801|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10
+10213033|akitzmiller|bash|COMPLETED|interact|1|1|01:27:02|00:03.319|00:01.623|00:01.695|2000Mn|5656K|2014-05-05T14:20:40|2014-05-05T15:47:42|holy2a18208|00:00:10
+"""
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        
+        # Create database
+        store = Store(connectstring,batchsize=2)
+        store.drop()
+        store.create()
+        
+        lines = text.strip().splitlines()
+        jobreports = Slurm.getJobReports(execfunc = FakeRunSh(lines[0]).runsh_i)
+        counts = store.save(jobreports)
+        self.assertEqual(counts, {'inserted' : 1, 'updated' : 0, 'unchanged' : 0, 'rejected' : 0})
+        
+        # One job is seen again, two are new
+        jobreports = Slurm.getJobReports(execfunc = FakeRunSh(text).runsh_i)
+        counts = store.save(jobreports)
+        self.assertEqual(counts, {'inserted' : 2, 'updated' : 0, 'unchanged' : 1, 'rejected' : 0})
+        
+        # Only the job that changed is written
+        changed = text.replace('03:24:41','03:30:00')
+        jobreports = Slurm.getJobReports(execfunc = FakeRunSh(changed).runsh_i)
+        counts = store.save(jobreports)
+        self.assertEqual(counts, {'inserted' : 0, 'updated' : 1, 'unchanged' : 2, 'rejected' : 0})
+        self.assertEqual(list(store.fetch(JobID='10102801'))[0].CPUTime, 12600)
+        
+        results = store.jobreport_table.select().execute()
+        self.assertEqual(len(results.fetchall()), 3)
+    
+    def testTransactionRollback(self):
+        """
+        Saves inside a failed transaction block are rolled back together
+        """
+        text="""
+10053213|akitzmiller|bash|COMPLETED|interact|1|1|01:04:49|13:29.616|11:09.280|02:20.336|20000Mn|468500K|2014-05-01T13:52:30|2014-05-01T14:57:19|holy2a18206|00:00:10
+10102801|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10
+"""
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        
+        # Create database
+        store = Store(connectstring,batchsize=1)
+        store.drop()
+        store.create()
+        
+        jobreports = Slurm.getJobReports(execfunc = FakeRunSh(text).runsh_i)
+        try:
+            with store.transaction():
+                store.save(jobreports)
+                raise RuntimeError("Window failed")
+        except RuntimeError:
+            pass
+        
+        results = store.jobreport_table.select().execute()
+        self.assertEqual(len(results.fetchall()), 0)
+    
+    def testFetch(self):
+        """
+        fetch filters on column values and pages through the results
+        """
+        text="""
+10048462|akitzmiller|bash|CANCELLED by 0|interact|1|1|02:08:33|08:01.433|06:47.955|01:13.477|2000Mn|2409232K|2014-05-01T11:43:26|2014-05-01T13:51:59|holy2a18206|00:00:10
+10053213|akitzmiller|bash|COMPLETED|interact|1|1|01:04:49|13:29.616|11:09.280|02:20.336|20000Mn|468500K|2014-05-01T13:52:30|2014-05-01T14:57:19|holy2a18206|00:00:10
+10102688|akitzmiller|dusage.sbatch|FAILED|general|4|1|00:01:12|00:00.367|00:00.103|00:00.263|1000Mc||2014-05-02T10:53:11|2014-05-02T10:53:29|holy2a02102|00:00:10
+10102801|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10
+10213033|akitzmiller|bash|COMPLETED|interact|1|1|01:27:02|00:03.319|00:01.623|00:01.695|2000Mn|5656K|2014-05-05T14:20:40|2014-05-05T15:47:42|holy2a18208|00:00:10
+"""
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        
+        # Create database
+        store = Store(connectstring)
+        store.drop()
+        store.create()
+        store.save(Slurm.getJobReports(execfunc = FakeRunSh(text).runsh_i))
+        
+        records = list(store.fetch(Partition='interact',State='COMPLETED',pagesize=2))
+        self.assertEqual([r.JobID for r in records], ['10053213','10102801','10213033'])
+        
+        records = list(store.fetch(columns=['JobID','Start'],orderby='Start',pagesize=1,
+                                   Start__ge=datetime.datetime(2014,5,2),
+                                   Start__lt=datetime.datetime(2014,5,3)))
+        self.assertEqual([r.JobID for r in records], ['10102688','10102801'])
+        self.assertEqual(records[0]._fields, ('JobID','Start'))
+        
+        records = list(store.fetch(JobID=['10048462','10213033']))
+        self.assertEqual(len(records), 2)
+    
+    def testMigrate(self):
+        """
+        migrate adds the indexes, fingerprint and Cluster columns to a 
+        jobreport table created without them, rekeys it on (Cluster, JobID)
+        and rebuilds rollup tables without Cluster
+        """
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        
+        store = Store(connectstring)
+        store.drop()
+        
+        # An old style table with only the JobID constraint and no fingerprints
+        oldtable = Table('jobreport', MetaData(), 
+            *[Column(c.name, c.type, nullable=c.nullable, unique=(c.name == 'JobID')) 
+              for c in store.jobreport_table.columns if c.name not in (store.hashcolumn,'Cluster')])
+        oldtable.create(bind=store.engine)
+        store.engine.execute(oldtable.insert(),JobID='10102801',User='akitzmiller',Partition='interact',
+                             Start=datetime.datetime(2014,5,2,11,5,42),End=datetime.datetime(2014,5,2,14,30,23))
+        olddaily = Table('jobreport_daily', MetaData(),
+            *[Column(c.name, c.type) for c in store.daily_table.columns if c.name != 'Cluster'])
+        olddaily.create(bind=store.engine)
+        
+        store.migrate()
+        store.migrate()
+        indexes = set(ix['name'] for ix in inspect(store.engine).get_indexes('jobreport'))
+        for ix in store.jobreport_table.indexes:
+            self.assertTrue(ix.name in indexes, "%s is missing" % ix.name)
+        columns = [c['name'] for c in inspect(store.engine).get_columns('jobreport')]
+        self.assertTrue(store.hashcolumn in columns)
+        self.assertEqual([(r.Cluster,r.User) for r in store.rollup(groupby=('Cluster','User'))], [('','akitzmiller')])
+        
+        # The same JobID from another cluster is another row
+        text = "10102801|someoneelse|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10"
+        other = Store(connectstring,cluster='odyssey2')
+        counts = other.save(Slurm.getJobReports(execfunc=FakeRunSh(text).runsh_i))
+        self.assertEqual(counts['inserted'], 1)
+        self.assertEqual([(r.Cluster,r.User) for r in store.fetch(JobID='10102801')],
+                         [('','akitzmiller'),('odyssey2','someoneelse')])
+    
+    def testMigratePartitioned(self):
+        """
+        migrate moves the job reports of a table keyed on JobID alone into
+        the per month tables, where JobIDs of other clusters don't collide
+        """
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        
+        store = Store(connectstring,partitioned='Start')
+        store.drop()
+        Store(connectstring).drop()
+        oldtable = Table('jobreport', MetaData(), 
+            *[Column(c.name, c.type, nullable=c.nullable, unique=(c.name == 'JobID')) 
+              for c in store.jobreport_table.columns if c.name not in (store.hashcolumn,'Cluster')])
+        oldtable.create(bind=store.engine)
+        store.engine.execute(oldtable.insert(),JobID='10102801',User='akitzmiller',Partition='interact',
+                             Start=datetime.datetime(2014,5,2,11,5,42),End=datetime.datetime(2014,5,2,14,30,23))
+        
+        store.migrate()
+        self.assertEqual(store.partitions(), ['pnull','p201405'])
+        text = "10102801|someoneelse|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10"
+        other = Store(connectstring,cluster='odyssey2',partitioned='Start')
+        self.assertEqual(other.save(Slurm.getJobReports(execfunc=FakeRunSh(text).runsh_i))['inserted'], 1)
+        self.assertEqual([(r.Cluster,r.User) for r in store.fetch(JobID='10102801')],
+                         [('','akitzmiller'),('odyssey2','someoneelse')])
+        store.drop()
+    
+    def testRekeySQL(self):
+        """
+        On MySQL, unique keys that lack a key column, like the JobID key of 
+        the first tables, are dropped and the key added in one ALTER
+        """
+        from sqlalchemy.dialects import mysql
+        quote = mysql.dialect().identifier_preparer.quote
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        store = Store(connectstring)
+        rekey = lambda uniques,columns: store._rekeysql('jobreport',uniques,columns,'uq_jobreport_key',quote)
+        
+        self.assertEqual(rekey([('JobID',['JobID'])],('Cluster','JobID')),
+                         'ALTER TABLE jobreport DROP INDEX `JobID`, ADD UNIQUE KEY uq_jobreport_key (`Cluster`, `JobID`)')
+        # Partitioned on Start, from the first tables or from (Cluster, JobID)
+        self.assertEqual(rekey([('JobID',['JobID'])],('Cluster','JobID','Start')),
+                         'ALTER TABLE jobreport DROP INDEX `JobID`, '
+                         'ADD UNIQUE KEY uq_jobreport_key (`Cluster`, `JobID`, `Start`)')
+        self.assertEqual(rekey([('uq_jobreport_key',['Cluster','JobID'])],('Cluster','JobID','Start')),
+                         'ALTER TABLE jobreport DROP INDEX uq_jobreport_key, '
+                         'ADD UNIQUE KEY uq_jobreport_key (`Cluster`, `JobID`, `Start`)')
+        self.assertEqual(rekey([('JobID',['JobID']),('uq_jobreport_key',['Cluster','JobID','Start'])],('Cluster','JobID','Start')),
+                         'ALTER TABLE jobreport DROP INDEX `JobID`')
+        self.assertEqual(rekey([('uq_jobreport_key',['Cluster','JobID','Start'])],('Cluster','JobID','Start')), None)
+    
+    def testMigrateCluster(self):
+        """
+        migrate gives the job reports, watermarks and rollups of a database
+        from before the Cluster column the Store's cluster
+        """
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        
+        store = Store(connectstring,cluster='odyssey')
+        store.drop()
+        for table in (store.jobreport_table,store.watermark_table,store.daily_table):
+            old = Table(table.name, MetaData(), 
+                *[Column(c.name, c.type, unique=(c.name == 'JobID')) for c in table.columns if c.name != 'Cluster'])
+            old.create(bind=store.engine)
+        store.engine.execute('INSERT INTO jobreport (JobID, User, Start, End) VALUES '
+                             "('10102801', 'akitzmiller', '2014-05-02 11:05:42', '2014-05-02 14:30:23')")
+        store.engine.execute('INSERT INTO watermark (WindowStart, WindowEnd, Jobs) VALUES '
+                             "('2014-05-01 00:00:00', '2014-05-03 00:00:00', 1)")
+        
+        store.migrate()
+        self.assertEqual([(r.Cluster,r.JobID) for r in store.fetch()], [('odyssey','10102801')])
+        self.assertEqual(store.watermarks(), [(datetime.datetime(2014,5,1),datetime.datetime(2014,5,3))])
+        self.assertEqual(store.watermarks(''), [])
+        self.assertEqual([(r.Cluster,r.Jobs) for r in store.rollup(groupby=('Cluster',))], [('odyssey',1)])
+    
+    def testStage(self):
+        """
+        Staged LOAD DATA files have one escaped line per report, columns in
+        jobreport order
+        """
+        text="""
+11508264|lassance|samtools view IMR_PO_051214.bam | awk '{print }' | sort -u -z > regions|FAILED|interact|1|1|00:00:38|00:00.006|00:00.001|00:00.004|2000Mn|2576K|2014-06-11T11:33:55|2014-06-11T11:34:33|holy2a18205|00:00:38
+10102801|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10
+"""
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        store = Store(connectstring)
+        
+        fd,path = tempfile.mkstemp(suffix='.tsv.gz')
+        os.close(fd)
+        try:
+            n = store.stage(Slurm.getJobReports(execfunc = FakeRunSh(text).runsh_i),path)
+            lines = gzip.open(path).read().splitlines()
+        finally:
+            os.remove(path)
+        self.assertEqual(n, 2)
+        self.assertEqual(len(lines), 2)
+        columns = [c.name for c in store.jobreport_table.columns]
+        fields = dict(zip(columns,lines[1].split('\t')))
+        self.assertEqual(len(lines[1].split('\t')), len(columns))
+        self.assertEqual(fields['JobID'], '10102801')
+        self.assertEqual(fields['Start'], '2014-05-02 11:05:42')
+        self.assertTrue('regions' in lines[0].split('\t')[columns.index('JobName')])
+        self.assertEqual(store._stagevalue(None), '\\N')
+        self.assertEqual(store._stagevalue('a\tb\\c'), 'a\\tb\\\\c')
+    
+    def testMergeSQL(self):
+        """
+        The MySQL merge of a staging table qualifies every column, so the
+        staging table and lookups don't make it ambiguous
+        """
+        from sqlalchemy.dialects import mysql
+        quote = mysql.dialect().identifier_preparer.quote
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        for store in (Store(connectstring),Store(connectstring,compact=True)):
+            sql = store._mergesql('`jobreport_staging`',True,quote)
+            select,update = re.match(r'INSERT INTO .* SELECT (.*) FROM .* ON DUPLICATE KEY UPDATE (.*)$',sql).groups()
+            self.assertTrue(all('.' in c for c in select.split(', ')))
+            target = quote(store.compact_table.name if store.compact else 'jobreport')
+            for assignment in update.split(', '):
+                column = assignment.split(' = ')[0]
+                self.assertTrue(column.startswith(target + '.'),assignment)
+                self.assertEqual(assignment, '%s = VALUES(%s)' % (column,column))
+            self.assertFalse('ON DUPLICATE' in store._mergesql('`jobreport_staging`',False,quote))
+    
+    def testRollups(self):
+        """
+        Replacing a job moves its contribution in the rollup tables, and the
+        incremental rollups match a rebuild
+        """
+        text="""
+10053213|akitzmiller|bash|COMPLETED|interact|1|1|01:04:49|13:29.616|11:09.280|02:20.336|20000Mn|468500K|2014-05-01T13:52:30|2014-05-01T14:57:19|holy2a18206|00:00:10
+10102801|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10
+"""
+        replacement="""
+10102801|akitzmiller|bash|COMPLETED|interact|1|1|04:00:00|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-06-02T14:30:23|holy2a18206|00:00:10
+"""
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        store = Store(connectstring)
+        store.drop()
+        store.create()
+        
+        store.save(Slurm.getJobReports(execfunc = FakeRunSh(text).runsh_i))
+        store.save(Slurm.getJobReports(execfunc = FakeRunSh(replacement).runsh_i))
+        
+        months = store.rollup(period='month',groupby=('Month',))
+        self.assertEqual([(r.Month,r.Jobs) for r in months], 
+                         [(datetime.date(2014,5,1),1),(datetime.date(2014,6,1),1)])
+        self.assertEqual(months[1].CPUTime, Slurm.slurm_time_interval_to_seconds("04:00:00"))
+        
+        daily = sorted(tuple(r) for r in store.daily_table.select().execute() if r.Jobs != 0)
+        monthly = sorted(tuple(r) for r in store.monthly_table.select().execute() if r.Jobs != 0)
+        store.rebuildrollups()
+        self.assertEqual(sorted(tuple(r) for r in store.daily_table.select().execute()), daily)
+        self.assertEqual(sorted(tuple(r) for r in store.monthly_table.select().execute()), monthly)
+    
+    def testPartitioned(self):
+        """
+        A job whose End changes moves to the new month's partition, fetch 
+        prunes to matching partitions, and archived months drop out
+        """
+        text="""
+10053213|akitzmiller|bash|COMPLETED|interact|1|1|01:04:49|13:29.616|11:09.280|02:20.336|20000Mn|468500K|2014-05-01T13:52:30|2014-05-01T14:57:19|holy2a18206|00:00:10
+10102801|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10
+"""
+        replacement="""
+10102801|akitzmiller|bash|COMPLETED|interact|1|1|04:00:00|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-06-02T14:30:23|holy2a18206|00:00:10
+"""
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        store = Store(connectstring,partitioned='End')
+        store.drop()
+        store.create()
+        
+        store.save(Slurm.getJobReports(execfunc = FakeRunSh(text).runsh_i))
+        counts = store.save(Slurm.getJobReports(execfunc = FakeRunSh(replacement).runsh_i))
+        self.assertEqual(counts, {'inserted' : 0, 'updated' : 1, 'unchanged' : 0, 'rejected' : 0})
+        self.assertEqual(store.partitions(), ['pnull','p201405','p201406'])
+        
+        self.assertEqual(sorted(r.JobID for r in store.fetch()), ['10053213','10102801'])
+        june = list(store.fetch(End__ge=datetime.datetime(2014,6,1)))
+        self.assertEqual([r.JobID for r in june], ['10102801'])
+        
+        store.archive(datetime.datetime(2014,5,1))
+        self.assertEqual(store.partitions(), ['pnull','p201406'])
+        self.assertEqual([r.JobID for r in store.fetch()], ['10102801'])
+        store.connection.execute('DROP TABLE jobreport_archive_201405')
+        store.drop()
+    
+    def testCompact(self):
+        """
+        A compact Store keeps each string once in its lookup table, reads 
+        back through the jobreport view and can convert a wide table
+        """
+        text="""
+10053213|akitzmiller|bash|COMPLETED|interact|1|1|01:04:49|13:29.616|11:09.280|02:20.336|20000Mn|468500K|2014-05-01T13:52:30|2014-05-01T14:57:19|holy2a18206|00:00:10
+10102801|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10
+10102688|lassance|dusage.sbatch|FAILED|general|4|1|00:01:12|00:00.367|00:00.103|00:00.263|1000Mc||2014-05-02T10:53:11|2014-05-02T10:53:29|holy2a02102|00:00:10
+"""
+        replacement="""
+10102801|akitzmiller|bash|TIMEOUT|general|1|1|04:00:00|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10
+"""
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        store = Store(connectstring,compact=True)
+        store.drop()
+        wide = Store(connectstring)
+        wide.create()
+        wide.save(Slurm.getJobReports(execfunc = FakeRunSh(text).runsh_i))
+        expected = sorted(wide.fetch())
+        
+        store.migrate()
+        self.assertEqual(sorted(store.fetch()), expected)
+        
+        store.drop()
+        store.create()
+        store.save(Slurm.getJobReports(execfunc = FakeRunSh(text).runsh_i))
+        self.assertEqual(sorted(store.fetch()), expected)
+        counts = store.clone().save(Slurm.getJobReports(execfunc = FakeRunSh(replacement).runsh_i))
+        self.assertEqual(counts, {'inserted' : 0, 'updated' : 1, 'unchanged' : 0, 'rejected' : 0})
+        
+        users = store.lookup_tables['User'].select().execute().fetchall()
+        self.assertEqual(sorted(r.value for r in users), ['akitzmiller','lassance'])
+        job = list(store.fetch(JobID='10102801'))[0]
+        self.assertEqual((job.State,job.Partition,job.CPUTime,job.CancelledBy), ('TIMEOUT','general',14400,None))
+        store.drop()
+    
+    def testDedupe(self):
+        """
+        Repeated JobIDs are collapsed to the last report before writing, 
+        and a full buffer writes its oldest rows first
+        """
+        text="""
+10102801|akitzmiller|bash|RUNNING|interact|1|1|01:00:00|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|Unknown|holy2a18206|00:00:10
+10053213|akitzmiller|bash|COMPLETED|interact|1|1|01:04:49|13:29.616|11:09.280|02:20.336|20000Mn|468500K|2014-05-01T13:52:30|2014-05-01T14:57:19|holy2a18206|00:00:10
+10102801|akitzmiller|bash|RUNNING|interact|1|1|02:00:00|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|Unknown|holy2a18206|00:00:10
+10102801|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10
+"""
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        store = Store(connectstring,dedupebytes=1024 * 1024)
+        store.drop()
+        store.create()
+        
+        counts = store.save(Slurm.getJobReports(execfunc = FakeRunSh(text).runsh_i))
+        self.assertEqual(counts, {'inserted' : 2, 'updated' : 0, 'unchanged' : 0, 'rejected' : 0, 'duplicates' : 2})
+        job = list(store.fetch(JobID='10102801'))[0]
+        self.assertEqual((job.State,job.CPUTime), ('COMPLETED',12281))
+        
+        counts = {}
+        rows = list(store.dedupe(Slurm.getJobReports(execfunc = FakeRunSh(text).runsh_i),maxbytes=1,counts=counts))
+        self.assertEqual([r['CPUTime'] for r in rows], [3600,3889,12281])
+        self.assertEqual(counts, {'duplicates' : 1})
+    
+    def testRejected(self):
+        """
+        Reports that don't fit the jobreport columns go to the rejected 
+        table with their reasons, the rest are saved, and reprocess can save
+        the rejected ones with NULLs
+        """
+        text="""
+10048462|akitzmiller|bash|COMPLETED|interact|1|1|02:08:33|08:01.433|06:47.955|01:13.477|2000Mn|2409232K|2014-05-01T11:43:26|2014-05-01T13:51:59|holy2a18206|00:00:10
+10053213|akitzmiller|bash|COMPLETED|interact|1|1|01:04:49|13:29.616|11:09.280|02:20.336|20000Mn|468500K|2014-05-01T13:52:30|2014-05-01T14:57:19|holy2a18206|00:00:10
+10102801|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10
+10384435|akitzmiller|agalmatest.sbatch|FAILED|general|8|1|00:01:36|00:01.590|00:01.220|00:00.369|30000Mn|1024K|2014-05-09T16:01:53|2014-05-09T16:02:05|holy2a04307|00:00:10
+"""
+        class BadMaxRSS(dict):
+            def __getitem__(self,name):
+                if name == 'MaxRSS_kB':
+                    raise ValueError("Can't parse MaxRSS 16?")
+                return dict.__getitem__(self,name)
+        
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        metrics = Metrics()
+        store = Store(connectstring,metrics=metrics)
+        store.drop()
+        store.create()
+        
+        jobreports = list(Slurm.getJobReports(execfunc = FakeRunSh(text).runsh_i))
+        jobreports[1]['JobName'] = 'x' * 300
+        jobreports[2]['NCPUS'] = '4'
+        jobreports[3] = BadMaxRSS(jobreports[3])
+        counts = store.save(jobreports)
+        self.assertEqual(counts, {'inserted' : 2, 'updated' : 0, 'unchanged' : 0, 'rejected' : 2})
+        self.assertEqual(metrics.summary()['counters']['rejected'], 2)
+        self.assertEqual(list(store.fetch(JobID='10102801'))[0].NCPUS, 4)
+        rejected = store.rejected_table
+        reasons = select([rejected.c.JobID,rejected.c.Reason]).order_by(rejected.c.JobID).execute().fetchall()
+        self.assertEqual([tuple(r) for r in reasons], [('10053213','length:JobName'),('10384435','unreadable:MaxRSS_kB')])
+        
+        # Nothing has changed, so they are still rejected
+        counts = store.reprocess()
+        self.assertEqual((counts['inserted'],counts['rejected']), (0,2))
+        
+        counts = store.reprocess(nullify=True)
+        self.assertEqual((counts['inserted'],counts['rejected']), (2,0))
+        self.assertEqual(len(rejected.select().execute().fetchall()), 0)
+        job = list(store.fetch(JobID='10384435'))[0]
+        self.assertEqual((job.MaxRSS_kB,job.NCPUS,job.Start), (None,8,datetime.datetime(2014,5,9,16,1,53)))
+        self.assertEqual(list(store.fetch(JobID='10053213'))[0].JobName, None)
+    
     def testJobWithPipes(self):
         text="""
 11508264|lassance|samtools view IMR_PO_051214.bam | awk '{print }' | sort -u -z > regions|FAILED|interact|1|1|00:00:38|00:00.006|00:00.001|00:00.004|2000Mn|2576K|2014-06-11T11:33:55|2014-06-11T11:34:33|holy2a18205|00:00:38       
@@ -0,0 +1,319 @@
+'''
+Tests for the pipelined sacct loader
+'''
+import unittest
+import os
+import json
+import tempfile
+import datetime
+from StringIO import StringIO
+from slyme import Slurm
+from slyme.util import ShError
+from slymedb import Store
+from slymedb.loader import Loader, AdaptiveWindows, Poller, windows
+from slymedb.metrics import Metrics
+from slymedb.test.JobReportLoadingTest import FakeRunSh
+
+
+class Test(unittest.TestCase):
+
+    def getStore(self):
+        connectstring = os.environ.get('SLYMEDB_TEST_CONNECT_STRING')
+        if not connectstring:
+            raise Exception("SLYMEDB_TEST_CONNECT_STRING must be set for testing")
+        store = Store(connectstring)
+        store.drop()
+        store.create()
+        return store
+
+    def testWindows(self):
+        """
+        Windows cover the range and the last one is clipped
+        """
+        start = datetime.datetime(2014,5,1)
+        end = datetime.datetime(2014,5,3,12)
+        result = list(windows(start,end,datetime.timedelta(days=1)))
+        self.assertEqual(len(result), 3)
+        self.assertEqual(result[0], (start,datetime.datetime(2014,5,2)))
+        self.assertEqual(result[-1][1], end)
+
+    def testLoader(self):
+        """
+        Each window's reports are fetched and saved
+        """
+        text = {
+            '2014-05-01 00:00:00' : "10048462|akitzmiller|bash|COMPLETED|interact|1|1|02:08:33|08:01.433|06:47.955|01:13.477|2000Mn|2409232K|2014-05-01T11:43:26|2014-05-01T13:51:59|holy2a18206|00:00:10",
+            '2014-05-02 00:00:00' : "10102801|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10",
+            '2014-05-03 00:00:00' : "10102801|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10",
+        }
+        def getjobreports(**params):
+            return Slurm.getJobReports(execfunc=FakeRunSh(text[params['starttime']]).runsh_i)
+
+        store = self.getStore()
+        loader = Loader(store,fetchers=2,writers=2,queuedepth=1,getjobreports=getjobreports,log=StringIO())
+        counts = loader.run(windows(datetime.datetime(2014,5,1),datetime.datetime(2014,5,4),datetime.timedelta(days=1)))
+        self.assertEqual(counts['inserted'] + counts['updated'] + counts['unchanged'], 3)
+        self.assertEqual(loader.failed, [])
+        self.assertEqual(len(list(store.fetch())), 2)
+        self.assertEqual(store.watermarks(), [(datetime.datetime(2014,5,1),datetime.datetime(2014,5,4))])
+
+    def testRollupsWithWriters(self):
+        """
+        A job saved by several writers at once is counted once in the 
+        rollups
+        """
+        line = "10102801|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10"
+        def getjobreports(**params):
+            return Slurm.getJobReports(execfunc=FakeRunSh(line).runsh_i)
+
+        store = self.getStore()
+        loader = Loader(store,fetchers=4,writers=4,getjobreports=getjobreports,log=StringIO())
+        loader.run(windows(datetime.datetime(2014,5,1),datetime.datetime(2014,5,9),datetime.timedelta(days=1)))
+        self.assertEqual(loader.failed, [])
+        loaded = [tuple(r) for r in store.rollup(groupby=('Day','User'))]
+        self.assertEqual(loaded[0][2], 1)
+        store.rebuildrollups()
+        self.assertEqual([tuple(r) for r in store.rollup(groupby=('Day','User'))], loaded)
+
+    def testMetrics(self):
+        """
+        A load records its stages, counts, commit latencies and windows,
+        and writes them as JSON and a Prometheus textfile
+        """
+        line = "%s|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10"
+        def getjobreports(**params):
+            return Slurm.getJobReports(execfunc=FakeRunSh(line % params['starttime'][8:10]).runsh_i)
+
+        store = self.getStore()
+        metrics = Metrics()
+        loader = Loader(store,fetchers=2,writers=1,getjobreports=getjobreports,log=StringIO(),
+                        metrics=metrics,profile=True)
+        loader.run(windows(datetime.datetime(2014,5,1),datetime.datetime(2014,5,4),datetime.timedelta(days=1)))
+        self.assertEqual(len(loader.profiles), 3)
+
+        summary = metrics.summary()
+        for stage in ('ratelimit','fetch','save','values','write','database'):
+            self.assertTrue(stage in summary['stages'], "%s is missing" % stage)
+        self.assertEqual(summary['counters']['inserted'], 3)
+        self.assertEqual(summary['counters']['windows'], 3)
+        self.assertEqual(summary['histograms']['commit_seconds']['count'], 3)
+        self.assertEqual(len(summary['slowest_windows']), 3)
+
+        fd,path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            metrics.writejson(path)
+            self.assertEqual(json.load(open(path))['counters']['windows'], 3)
+            metrics.writeprometheus(path)
+            text = open(path).read()
+            self.assertTrue('slymedb_stage_seconds_total{stage="fetch"}' in text)
+            self.assertTrue('slymedb_rows_per_window_bucket{le="+Inf"} 3.0' in text)
+        finally:
+            os.remove(path)
+
+    def testWriterCantConnect(self):
+        """
+        A writer that can't get a connection fails its windows and stops
+        the load instead of leaving the fetchers blocked
+        """
+        line = "%s|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10"
+        def getjobreports(**params):
+            return Slurm.getJobReports(execfunc=FakeRunSh(line % params['starttime'][8:10]).runsh_i)
+        def clone():
+            raise RuntimeError("Database is down")
+
+        store = self.getStore()
+        store.clone = clone
+        loader = Loader(store,fetchers=2,writers=1,queuedepth=1,getjobreports=getjobreports,log=StringIO())
+        loader.run(windows(datetime.datetime(2014,5,1),datetime.datetime(2014,5,10),datetime.timedelta(days=1)))
+        self.assertTrue(len(loader.failed) > 0)
+        self.assertTrue(loader.stopping.is_set())
+        self.assertEqual(store.watermarks(), [])
+
+    def testAllWindowsFail(self):
+        """
+        The counts have every key save returns even when no window is saved
+        """
+        def getjobreports(**params):
+            raise ShError("sacct: error: slurmdbd: Connection refused")
+
+        store = self.getStore()
+        loader = Loader(store,fetchers=2,writers=1,getjobreports=getjobreports,log=StringIO())
+        counts = loader.run(windows(datetime.datetime(2014,5,1),datetime.datetime(2014,5,4),datetime.timedelta(days=1)))
+        self.assertEqual(len(loader.failed), 3)
+        self.assertEqual(counts, {'inserted' : 0, 'updated' : 0, 'unchanged' : 0, 'rejected' : 0})
+        self.assertEqual(store.watermarks(), [])
+
+    def testAdaptiveWindows(self):
+        """
+        Windows grow when they are quiet, shrink when they are busy and 
+        split down to minsize
+        """
+        day = datetime.timedelta(days=1)
+        start = datetime.datetime(2014,5,1)
+        planner = AdaptiveWindows([(start,start + 30 * day)],size=day,
+                                  minsize=datetime.timedelta(hours=6),maxsize=4 * day,
+                                  targetjobs=1000,targetseconds=60)
+        window = planner.next()
+        self.assertEqual(window, (start,start + day))
+        planner.done(window,10,1)
+        self.assertEqual(planner.size, 2 * day)
+        window = planner.next()
+        planner.done(window,100000,1)
+        self.assertEqual(planner.size, day)
+
+        window = planner.next()
+        self.assertTrue(planner.split(window))
+        half = planner.next()
+        self.assertEqual(half, (window[0],window[0] + datetime.timedelta(hours=12)))
+        self.assertTrue(planner.split(half))
+        self.assertFalse(planner.split(planner.next()))
+
+    def testSplitOnSacctError(self):
+        """
+        A window that sacct fails on is split and both halves are loaded
+        """
+        line = "%s|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10"
+        def getjobreports(**params):
+            if params['starttime'] == '2014-05-01 00:00:00' and params['endtime'] == '2014-05-02 00:00:00':
+                raise ShError("sacct: error: Socket timed out")
+            return Slurm.getJobReports(execfunc=FakeRunSh(line % params['starttime'][8:10]).runsh_i)
+
+        store = self.getStore()
+        day = datetime.timedelta(days=1)
+        planner = AdaptiveWindows([(datetime.datetime(2014,5,1),datetime.datetime(2014,5,2))],
+                                  size=day,minsize=datetime.timedelta(hours=1))
+        loader = Loader(store,fetchers=1,getjobreports=getjobreports,log=StringIO())
+        loader.run(planner)
+        self.assertEqual(loader.failed, [])
+        self.assertEqual(store.gaps(datetime.datetime(2014,5,1),datetime.datetime(2014,5,2)), [])
+
+    def testTruncatedWindow(self):
+        """
+        What sacct printed before a print.c:179 error on a window that 
+        can't be split is saved, but the window is failed rather than 
+        marked as loaded
+        """
+        line = "10102801|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10"
+        def getjobreports(**params):
+            for jr in Slurm.getJobReports(execfunc=FakeRunSh(line).runsh_i):
+                yield jr
+            raise ShError("sacct: error: print.c:179 print_fields_str: buffer overflow")
+
+        store = self.getStore()
+        window = (datetime.datetime(2014,5,1),datetime.datetime(2014,5,2))
+        loader = Loader(store,fetchers=1,getjobreports=getjobreports,log=StringIO())
+        counts = loader.run([window])
+        self.assertEqual(counts['inserted'], 1)
+        self.assertEqual(loader.failed, [(None,window)])
+        self.assertEqual(store.watermarks(), [])
+
+    def testPoller(self):
+        """
+        Each cycle loads only the windows since the last one, up to lag
+        seconds ago, and a reconnected store carries on
+        """
+        line = "%s|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10"
+        requested = []
+        def getjobreports(**params):
+            requested.append((params['starttime'],params['endtime']))
+            return Slurm.getJobReports(execfunc=FakeRunSh(line % params['starttime'][8:10]).runsh_i)
+
+        store = self.getStore()
+        clock = [datetime.datetime(2014,5,3,0,1)]
+        cycles = []
+        def after(counts):
+            cycles.append(counts)
+            if len(cycles) == 1:
+                store.reconnect()
+                clock[0] += datetime.timedelta(days=1)
+            else:
+                poller.stop()
+        poller = Poller(store,datetime.datetime(2014,5,1),interval=0,lag=60,
+                        planner={'size' : datetime.timedelta(days=1)},
+                        loader={'getjobreports' : getjobreports},
+                        after=after,log=StringIO(),now=lambda: clock[0])
+        poller.run()
+        self.assertEqual(poller.cycles, 2)
+        self.assertEqual(requested, [('2014-05-01 00:00:00','2014-05-02 00:00:00'),
+                                     ('2014-05-02 00:00:00','2014-05-03 00:00:00'),
+                                     ('2014-05-03 00:00:00','2014-05-04 00:00:00')])
+        self.assertEqual(cycles[1]['inserted'], 1)
+        self.assertEqual(len(list(store.fetch())), 3)
+        self.assertEqual(store.watermarks(), [(datetime.datetime(2014,5,1),datetime.datetime(2014,5,4))])
+
+    def testPollerFinishedStates(self):
+        """
+        The Poller only asks sacct for ended jobs, so a job that is running
+        when its window is loaded is stored by the window it ends in
+        """
+        running = "10102801|akitzmiller|bash|RUNNING|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-01T11:05:42|Unknown|holy2a18206|00:00:10"
+        completed = "10102801|akitzmiller|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-01T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10"
+        def getjobreports(**params):
+            # Like sacct, only the jobs in one of the states during the window
+            line = running if params['starttime'].startswith('2014-05-01') else completed
+            if line.split('|')[3] not in params['state'].split(','):
+                line = ''
+            return Slurm.getJobReports(execfunc=FakeRunSh(line).runsh_i)
+
+        store = self.getStore()
+        clock = [datetime.datetime(2014,5,2,0,1)]
+        def after(counts):
+            if len(list(store.fetch())) == 0:
+                self.assertEqual(store.watermarks(), [(datetime.datetime(2014,5,1),datetime.datetime(2014,5,2))])
+                clock[0] += datetime.timedelta(days=1)
+            else:
+                poller.stop()
+        poller = Poller(store,datetime.datetime(2014,5,1),interval=0,lag=60,
+                        planner={'size' : datetime.timedelta(days=1)},
+                        loader={'getjobreports' : getjobreports},
+                        after=after,log=StringIO(),now=lambda: clock[0])
+        poller.run()
+        self.assertEqual(poller.cycles, 2)
+        self.assertEqual([(r.State,r.End) for r in store.fetch()], [('COMPLETED',datetime.datetime(2014,5,2,14,30,23))])
+
+    def testClusters(self):
+        """
+        Several clusters load at once into their own rows and watermarks,
+        each with its own fetchers and sacct clusters parameter
+        """
+        line = "10102801|%s|bash|COMPLETED|interact|1|1|03:24:41|00:18.743|00:08.706|00:10.036|2000Mn|26968K|2014-05-02T11:05:42|2014-05-02T14:30:23|holy2a18206|00:00:10"
+        requested = []
+        def getjobreports(**params):
+            requested.append((params['clusters'],params['starttime']))
+            return Slurm.getJobReports(execfunc=FakeRunSh(line % params['clusters']).runsh_i)
+
+        store = self.getStore()
+        d = lambda day: datetime.datetime(2014,5,day)
+        loader = Loader(store,fetchers=1,writers=2,getjobreports=getjobreports,log=StringIO(),
+                        clusters={'odyssey' : {'fetchers' : 2}})
+        counts = loader.run({'odyssey' : windows(d(1),d(4),datetime.timedelta(days=1)),
+                             'cannon' : [(d(1),d(2))]})
+        self.assertEqual(loader.failed, [])
+        self.assertEqual(counts['inserted'] + counts['updated'] + counts['unchanged'], 4)
+        self.assertEqual(sorted(requested)[:2], [('cannon','2014-05-01 00:00:00'),('odyssey','2014-05-01 00:00:00')])
+        self.assertEqual([(r.Cluster,r.User) for r in store.fetch()], [('cannon','cannon'),('odyssey','odyssey')])
+        self.assertEqual(store.watermarks('odyssey'), [(d(1),d(4))])
+        self.assertEqual(store.gaps(d(1),d(4),'cannon'), [(d(2),d(4))])
+        self.assertEqual(store.watermarks(), [])
+        store.compactwatermarks()
+        self.assertEqual(store.watermarks('cannon'), [(d(1),d(2))])
+        self.assertEqual(len(store.rollup(groupby=('Cluster',))), 2)
+
+    def testGaps(self):
+        """
+        gaps returns the ranges the watermark table doesn't cover
+        """
+        store = self.getStore()
+        d = lambda day: datetime.datetime(2014,5,day)
+        store.save([],window=(d(1),d(3)))
+        store.save([],window=(d(3),d(4)))
+        store.save([],window=(d(6),d(7)))
+        self.assertEqual(store.gaps(d(2),d(10)), [(d(4),d(6)),(d(7),d(10))])
+        store.compactwatermarks()
+        self.assertEqual(store.watermarks(), [(d(1),d(4)),(d(6),d(7))])
+        self.assertEqual(len(store.watermark_table.select().execute().fetchall()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()